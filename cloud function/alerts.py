@@ -0,0 +1,245 @@
+# Imports
+import json
+import time
+import uuid
+import random
+import threading
+
+from datetime import datetime
+from typing import Callable
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+
+# HTTP status codes of the responses worth retrying
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+
+def serialize_alert(payload: dict) -> dict:
+    """
+    Converts an alert payload to JSON serializable form fields.
+
+    requests form-encodes bytes and strings the same way and other values with str(), so the serialized payload is
+    posted exactly like the original one, and can be stored in the outbox.
+
+    Args:
+        payload (dict): The alert payload.
+
+    Returns:
+        dict: The form fields of the payload, None values are dropped as requests does.
+    """
+
+    return {
+        key: value.decode() if isinstance(value, bytes) else str(value)
+        for key, value in payload.items()
+        if value is not None
+    }
+
+
+class AlertDelivery:
+    """
+    Delivers the alerts to Node-RED.
+
+    Alerts are posted through a persistent, pooled HTTP session with strict timeouts, and retried a bounded number of
+    times with full jitter backoff. Alerts that still cannot be delivered are written to a durable outbox of Cloud
+    Storage objects, drained later by drain.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        bucket_factory: Callable,
+        outbox_prefix: str,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 10.0,
+        max_attempts: int = 3,
+        initial_backoff: float = 0.5,
+        max_backoff: float = 4.0,
+        pool_size: int = 10,
+        sleep: Callable = time.sleep,
+    ) -> None:
+        """
+        Args:
+            url (str): The URL of the Node-RED endpoint.
+            bucket_factory (Callable): Returns the Cloud Storage bucket of the outbox.
+            outbox_prefix (str): The prefix of the outbox objects in the bucket.
+            connect_timeout (float, optional): The connection timeout of a request in seconds.
+            read_timeout (float, optional): The read timeout of a request in seconds.
+            max_attempts (int, optional): The number of attempts to post an alert before it goes to the outbox.
+            initial_backoff (float, optional): The maximum delay in seconds before the first retry, doubled at each retry.
+            max_backoff (float, optional): The maximum delay in seconds between two attempts.
+            pool_size (int, optional): The maximum number of pooled connections.
+            sleep (Callable, optional): The function used to wait between two attempts.
+        """
+
+        self.url = url
+        self.bucket_factory = bucket_factory
+        self.outbox_prefix = outbox_prefix
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_attempts = max_attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+
+        # Keep the connections alive across the alerts of a warm instance
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # Whether this instance queued alerts that may still be in the outbox
+        self.pending = False
+        self.lock = threading.Lock()
+
+        # The alerts are sent by concurrent threads, and the outbox is drained under the lock above
+        self.stats_lock = threading.Lock()
+        self.stats = {"delivered": 0, "retries": 0, "queued": 0, "drained": 0, "dropped": 0}
+
+    def count(self, name: str) -> None:
+        """Increments a delivery statistic."""
+
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def post(self, fields: dict, max_attempts: int = None) -> bool:
+        """
+        Posts serialized alert fields to Node-RED, retrying the transient failures.
+
+        Args:
+            fields (dict): The serialized alert, see serialize_alert.
+            max_attempts (int, optional): The number of attempts, max_attempts of the delivery by default.
+
+        Returns:
+            bool: Whether the alert was delivered. Raises ValueError if Node-RED rejected it.
+        """
+
+        for attempt in range(max_attempts or self.max_attempts):
+
+            if attempt > 0:
+                self.count("retries")
+                self.sleep(random.uniform(0, min(self.max_backoff, self.initial_backoff * 2 ** (attempt - 1))))
+
+            try:
+                response = self.session.post(self.url, data=fields, timeout=self.timeout)
+                status_code = response.status_code
+            except (requests.ConnectionError, requests.Timeout) as error:
+                response = None
+                status_code = repr(error)
+
+            print(
+                json.dumps(
+                    {
+                        "message": "Alert delivery attempt",
+                        "alert_id": fields.get("alert_id"),
+                        "attempt": attempt + 1,
+                        "status": status_code,
+                    }
+                )
+            )
+
+            if response is None:
+                continue
+
+            if response.status_code < 300:
+                self.count("delivered")
+                return True
+
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                raise ValueError(f"Node-RED rejected the alert with status {response.status_code}")
+
+        return False
+
+    def send(self, payload: dict) -> bool:
+        """
+        Delivers an alert, or writes it to the outbox if Node-RED cannot be reached.
+
+        Args:
+            payload (dict): The alert payload.
+
+        Returns:
+            bool: Whether the alert was delivered right away.
+        """
+
+        # Identify the alert in the delivery logs, the outbox and Node-RED
+        fields = serialize_alert(payload)
+        fields.setdefault("alert_id", uuid.uuid4().hex)
+
+        try:
+            if self.post(fields):
+                return True
+        except ValueError as error:
+            # Retrying a rejected alert would not help
+            self.count("dropped")
+            print(error)
+            return False
+
+        self.enqueue(fields)
+
+        return False
+
+    def enqueue(self, fields: dict) -> None:
+        """
+        Writes serialized alert fields to the outbox.
+
+        Args:
+            fields (dict): The serialized alert, see serialize_alert.
+        """
+
+        # Object names sort in the order the alerts were queued
+        blob_name = f"{self.outbox_prefix}{datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex}.json"
+
+        self.bucket_factory().blob(blob_name).upload_from_string(
+            json.dumps(fields), content_type="application/json", if_generation_match=0
+        )
+
+        self.count("queued")
+        self.pending = True
+        print(f"Alert queued in the outbox: {blob_name}.")
+
+    def drain(self, max_alerts: int = 100) -> dict:
+        """
+        Delivers the alerts of the outbox, oldest first, and deletes the delivered ones.
+
+        Draining stops at the first alert that still cannot be delivered, so that the alerts keep their order.
+
+        Args:
+            max_alerts (int, optional): The maximum number of alerts to deliver.
+
+        Returns:
+            dict: The delivery statistics.
+        """
+
+        with self.lock:
+            bucket = self.bucket_factory()
+            blobs = list(bucket.list_blobs(prefix=self.outbox_prefix, max_results=max_alerts))
+
+            for blob in blobs:
+                try:
+                    fields = json.loads(blob.download_as_text())
+                except NotFound:
+                    # Already drained by another instance
+                    continue
+
+                try:
+                    delivered = self.post(fields, max_attempts=1)
+                except ValueError as error:
+                    self.count("dropped")
+                    print(f"Dropping {blob.name}: {error}")
+                    delivered = True
+
+                if not delivered:
+                    break
+
+                try:
+                    blob.delete(if_generation_match=blob.generation)
+                except (NotFound, PreconditionFailed):
+                    pass
+
+                self.count("drained")
+            else:
+                self.pending = len(blobs) == max_alerts
+
+        return self.stats
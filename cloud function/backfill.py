@@ -0,0 +1,238 @@
+"""
+Reprocesses the media of a prefix of the input bucket, e.g. after changing the thresholds or the drawing logic.
+
+Each media goes through the same pipeline as get_predictions, in a pool of worker processes sharing a bound on the
+concurrent API calls. The alerts are not sent unless --alerts is given. Progress is checkpointed to a local file, so
+that an interrupted run resumes where it stopped.
+
+Usage:
+    python backfill.py cam1/ --workers 4 --api-concurrency 8
+    python backfill.py cam1/ --dry-run
+"""
+
+# Imports
+import os
+import json
+import time
+import argparse
+import multiprocessing
+
+from pathlib import Path
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from typing import List
+
+from config import IMAGE_EXTENSIONS, VIDEO_EXTENSIONS
+
+
+def list_media(prefix: str, limit: int = None) -> List[dict]:
+    """
+    Lists the images and videos of a prefix of the input bucket, as upload event payloads.
+
+    Args:
+        prefix (str): The prefix of the media names, e.g. "cam1/".
+        limit (int, optional): The maximum number of media to list.
+
+    Returns:
+        List[dict]: The event payload of each media, with its name, contentType, size, hashes and timeCreated.
+    """
+
+    from utils import get_input_bucket
+
+    events = []
+    for blob in get_input_bucket().list_blobs(prefix=prefix):
+        if Path(blob.name).suffix.lower() not in IMAGE_EXTENSIONS + VIDEO_EXTENSIONS:
+            continue
+
+        events.append(
+            {
+                "name": blob.name,
+                "contentType": blob.content_type,
+                "size": str(blob.size),
+                "md5Hash": blob.md5_hash,
+                "crc32c": blob.crc32c,
+                "timeCreated": blob.time_created.astimezone(timezone.utc).replace(tzinfo=None).isoformat(),
+            }
+        )
+
+        if limit is not None and len(events) >= limit:
+            break
+
+    return events
+
+
+def load_checkpoint(path: str) -> set:
+    """
+    Reads the names of the media already processed from a checkpoint file.
+
+    Args:
+        path (str): The path of the checkpoint file, one JSON record per processed media.
+
+    Returns:
+        set: The names of the media processed successfully.
+    """
+
+    if not os.path.exists(path):
+        return set()
+
+    with open(path) as checkpoint:
+        records = [json.loads(line) for line in checkpoint if line.strip()]
+
+    return {record["name"] for record in records if record["status"] == "ok"}
+
+
+def init_worker(semaphore) -> None:
+    """
+    Initializes a worker process, bounding its API calls with the semaphore shared by all the workers.
+
+    Args:
+        semaphore (multiprocessing.BoundedSemaphore): The semaphore bounding the concurrent API calls.
+    """
+
+    import utils
+
+    utils.API_SEMAPHORE = semaphore
+
+
+def process_event(event: dict) -> dict:
+    """
+    Runs the pipeline of a media in a worker process, with the upload time of the media as its timestamp.
+
+    Args:
+        event (dict): The event payload of the media, see list_media.
+
+    Returns:
+        dict: The checkpoint record of the media, with its name, status, size and processing time.
+    """
+
+    from main import process_media
+    from utils import get_bigquery_sink
+
+    start = time.perf_counter()
+
+    try:
+        process_media(event, datetime.fromisoformat(event["timeCreated"]), deferred=False)
+        get_bigquery_sink().flush_due()
+        status, error = "ok", None
+    except Exception as exception:
+        status, error = "error", repr(exception)
+
+    return {
+        "name": event["name"],
+        "status": status,
+        "error": error,
+        "size": int(event["size"]),
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def summarize(events: List[dict], processed: set) -> dict:
+    """
+    Measures a backfill without running it.
+
+    Args:
+        events (List[dict]): The listed media, see list_media.
+        processed (set): The names of the media already processed.
+
+    Returns:
+        dict: The number of media and bytes left to process, by type and by camera trap.
+    """
+
+    todo = [event for event in events if event["name"] not in processed]
+    cameras = {}
+    for event in todo:
+        camera_trap_name = event["name"].split("/")[0]
+        cameras[camera_trap_name] = cameras.get(camera_trap_name, 0) + 1
+
+    return {
+        "listed": len(events),
+        "already_processed": len(events) - len(todo),
+        "images": sum(Path(event["name"]).suffix.lower() in IMAGE_EXTENSIONS for event in todo),
+        "videos": sum(Path(event["name"]).suffix.lower() in VIDEO_EXTENSIONS for event in todo),
+        "bytes": sum(int(event["size"]) for event in todo),
+        "cameras": cameras,
+    }
+
+
+def main(args=None) -> None:
+    """
+    Runs the backfill command line.
+
+    Args:
+        args (List[str], optional): The command line arguments, sys.argv by default.
+    """
+
+    parser = argparse.ArgumentParser(description="Reprocess the media of a prefix of the input bucket.")
+    parser.add_argument("prefix", help='prefix of the media names, e.g. "cam1/"')
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--api-concurrency", type=int, default=8, help="maximum number of concurrent API calls")
+    parser.add_argument("--checkpoint", help="checkpoint file, backfill-<prefix>.jsonl by default")
+    parser.add_argument("--limit", type=int, help="maximum number of media to list")
+    parser.add_argument("--dry-run", action="store_true", help="only measure what would be processed")
+    parser.add_argument("--alerts", action="store_true", help="send the alerts to Node-RED")
+    args = parser.parse_args(args)
+
+    checkpoint_path = args.checkpoint or f"backfill-{args.prefix.strip('/').replace('/', '_') or 'all'}.jsonl"
+
+    # List the media left to process
+    start = time.perf_counter()
+    events = list_media(args.prefix, args.limit)
+    processed = load_checkpoint(checkpoint_path)
+    summary = summarize(events, processed)
+    summary["listing_seconds"] = round(time.perf_counter() - start, 3)
+    print(json.dumps({"message": "Backfill plan", "prefix": args.prefix, "checkpoint": checkpoint_path, **summary}))
+
+    if args.dry_run:
+        return
+
+    todo = [event for event in events if event["name"] not in processed]
+
+    # The workers read the alerts switch from their environment when they import the config. The past media are
+    # scored against the live backgrounds of the motion pre-filter, but never blended in them
+    os.environ["ALERTS_ENABLED"] = "true" if args.alerts else "false"
+    os.environ["MOTION_FILTER_UPDATE_BACKGROUNDS"] = "false"
+
+    # Spawn the workers, so that they do not inherit the gRPC state of this process
+    context = multiprocessing.get_context("spawn")
+    semaphore = context.BoundedSemaphore(args.api_concurrency)
+
+    start = time.perf_counter()
+    counts = {"ok": 0, "error": 0}
+    processed_bytes = 0
+
+    with open(checkpoint_path, "a") as checkpoint, ProcessPoolExecutor(
+        max_workers=args.workers, mp_context=context, initializer=init_worker, initargs=(semaphore,)
+    ) as executor:
+
+        futures = [executor.submit(process_event, event) for event in todo]
+
+        for index, future in enumerate(as_completed(futures), 1):
+            record = future.result()
+
+            # Checkpoint the media as soon as it is processed
+            checkpoint.write(json.dumps(record) + "\n")
+            checkpoint.flush()
+
+            counts[record["status"]] += 1
+            processed_bytes += record["size"]
+            print(f"[{index}/{len(todo)}] {record['name']}: {record['status']} in {record['seconds']}s {record['error'] or ''}")
+
+    seconds = time.perf_counter() - start
+    print(
+        json.dumps(
+            {
+                "message": "Backfill done",
+                "prefix": args.prefix,
+                "processed": counts["ok"],
+                "failed": counts["error"],
+                "seconds": round(seconds, 3),
+                "media_per_second": round(len(todo) / seconds, 3) if seconds else None,
+                "bytes_per_second": round(processed_bytes / seconds) if seconds else None,
+            }
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""
+Fixtures of the benchmarks: in-process fakes of the Google Cloud services and Node-RED, synthetic media, per-stage
+timings, peak RSS and temporary files usage.
+"""
+
+# Imports
+import os
+import sys
+import time
+import tempfile
+import functools
+import threading
+
+from pathlib import Path
+
+import pytest
+
+# The cloud function modules are imported from the parent folder, as in the Cloud Functions runtime
+FUNCTION_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(FUNCTION_DIR))
+
+import main
+import utils
+
+# The fixtures shared with the tests
+from fakes import image_response, video_response, cloud_fakes  # noqa: F401
+from fakes import upload_camera_traps_metadata
+
+
+# Stages of the pipeline timed by the benchmarks, looked up in the namespace of main
+STAGES = [
+    "passes_motion_filter",
+    "get_media_metadata",
+    "get_image_response",
+    "get_video_response",
+    "get_keyframes_response",
+    "bigquery_insert",
+    "bigquery_insert_detections",
+    "get_image_outputs",
+    "get_video_outputs",
+    "draw_bounding_boxes",
+    "annotate_video",
+    "annotate_video_thumbnail",
+    "defer_annotated_video",
+    "update_metadata",
+    "send_to_node_red",
+]
+
+# Results printed in the terminal summary
+REPORTS = []
+
+
+
+@pytest.fixture
+def cloud(cloud_fakes, monkeypatch):
+    """
+    Replaces the Google Cloud clients and the Node-RED endpoint of the cloud function with in-process fakes, with a
+    "benchmark" camera trap.
+
+    Returns:
+        SimpleNamespace: The fake storage, bigquery, vision, video and node_red clients.
+    """
+
+    # Process the videos synchronously, as a single invocation
+    monkeypatch.setattr(main, "VIDEO_PIPELINE_MODE", "sync")
+    monkeypatch.setattr(main, "IMAGE_INGESTION_MODE", "single")
+
+    upload_camera_traps_metadata("benchmark")
+
+    return cloud_fakes
+
+
+class StageTimer:
+    """Times the calls to the stages of the pipeline."""
+
+    def __init__(self) -> None:
+        self.seconds = {}
+        self.calls = {}
+
+    def wrap(self, name: str, function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+                self.calls[name] = self.calls.get(name, 0) + 1
+
+        return timed
+
+    def milliseconds_per_call(self) -> dict:
+        return {name: round(1000 * self.seconds[name] / self.calls[name], 3) for name in self.seconds}
+
+
+@pytest.fixture
+def stages(monkeypatch):
+    """Times each stage of the pipeline called through main."""
+
+    timer = StageTimer()
+    for name in STAGES:
+        monkeypatch.setattr(main, name, timer.wrap(name, getattr(main, name)))
+
+    return timer
+
+
+def read_peak_rss() -> int:
+    """Returns the peak resident set size of the process in bytes, since the last reset_peak_rss."""
+
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+
+    return 0
+
+
+def reset_peak_rss() -> None:
+    """Resets the peak resident set size of the process, when the kernel allows it."""
+
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def get_directory_size(path: str) -> int:
+    """Returns the total size in bytes of the regular files under a directory."""
+
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.stat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+
+    return total
+
+
+class ResourceMonitor:
+    """Measures the peak RSS of the process and the peak size of its temporary directory."""
+
+    def __init__(self, directory: str, interval: float = 0.005) -> None:
+        self.directory = directory
+        self.interval = interval
+        self.peak_tmp_bytes = 0
+        self.peak_rss_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self) -> None:
+        while not self._stop.is_set():
+            self.peak_tmp_bytes = max(self.peak_tmp_bytes, get_directory_size(self.directory))
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> "ResourceMonitor":
+        reset_peak_rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak_tmp_bytes = max(self.peak_tmp_bytes, get_directory_size(self.directory))
+        self.peak_rss_bytes = read_peak_rss()
+
+
+@pytest.fixture
+def resources(monkeypatch, tmp_path):
+    """
+    Points the temporary files of the cloud function to a directory of the benchmark, and measures its peak size and
+    the peak RSS of the process while the benchmark runs.
+    """
+
+    directory = tmp_path / "tmp"
+    directory.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(directory))
+
+    return ResourceMonitor(str(directory))
+
+
+@pytest.fixture
+def measure(request, benchmark, stages, resources):
+    """
+    Runs a benchmark while timing its stages and measuring its resources, and reports them in the benchmark extra info
+    and in the terminal summary.
+
+    Returns:
+        Callable: Runs benchmark.pedantic with the given function, arguments and number of rounds.
+    """
+
+    def run(function, *args, rounds: int = 3, setup=None, **kwargs):
+        with resources:
+            result = benchmark.pedantic(
+                function, args=args, kwargs=kwargs, setup=setup, rounds=rounds, iterations=1, warmup_rounds=1
+            )
+
+        report = {
+            "stages_ms": stages.milliseconds_per_call(),
+            "peak_rss_mb": round(resources.peak_rss_bytes / 2**20, 1),
+            "peak_tmp_mb": round(resources.peak_tmp_bytes / 2**20, 2),
+        }
+        benchmark.extra_info.update(report)
+        REPORTS.append((request.node.name, report))
+
+        return result
+
+    return run
+
+
+@pytest.fixture(scope="session")
+def media_dir(tmp_path_factory) -> Path:
+    """The directory of the synthetic media, generated once per session."""
+    return tmp_path_factory.mktemp("media")
+
+
+def reset_calls(cloud, clear_response_cache: bool) -> None:
+    """
+    Resets the API calls and alerts recorded by the fakes before a benchmark round, so that each round is checked on
+    its own whatever the number of rounds.
+
+    Args:
+        cloud (SimpleNamespace): The fakes, see the cloud fixture.
+        clear_response_cache (bool): Whether to delete the cached responses, so that the round calls the APIs.
+    """
+
+    cloud.vision.calls = 0
+    cloud.video.calls = 0
+    cloud.node_red.alerts.clear()
+
+    if clear_response_cache:
+        bucket = utils.get_output_bucket()
+        bucket.delete_blobs(list(bucket.list_blobs(prefix=utils.RESPONSE_CACHE_PREFIX)))
+
+
+def pytest_terminal_summary(terminalreporter) -> None:
+    """Prints the per-stage timings, peak RSS and temporary files usage of the benchmarks."""
+
+    if not REPORTS:
+        return
+
+    terminalreporter.section("benchmark stages and resources")
+    for name, report in REPORTS:
+        terminalreporter.write_line(f"{name}: peak RSS {report['peak_rss_mb']} MB, peak /tmp {report['peak_tmp_mb']} MB")
+        for stage, milliseconds in sorted(report["stages_ms"].items(), key=lambda item: -item[1]):
+            terminalreporter.write_line(f"    {stage:<28} {milliseconds:>10.3f} ms")
@@ -0,0 +1,408 @@
+"""
+In-process fakes of Cloud Storage, Vision, Video Intelligence, BigQuery and Node-RED, so that the benchmarks and the
+tests drive the cloud function end to end without network or credentials, the fixtures installing them shared by the
+conftest.py of both folders, and synthetic camera trap media.
+
+The fakes only implement what the cloud function uses, and answer with the recorded responses of the responses folder.
+"""
+
+# Imports
+import io
+import base64
+import hashlib
+import threading
+
+import pytest
+import requests
+
+from pathlib import Path
+from types import SimpleNamespace
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+
+RESPONSES_DIR = Path(__file__).resolve().parent / "responses"
+
+
+class FakeBlob:
+    """A Cloud Storage object held in memory."""
+
+    def __init__(self, bucket: "FakeBucket", name: str) -> None:
+        self.bucket = bucket
+        self.name = name
+        self.content_type = None
+
+    @property
+    def _object(self):
+        return self.bucket.objects.get(self.name)
+
+    @property
+    def generation(self) -> int:
+        return self._object[1] if self._object else None
+
+    @property
+    def size(self) -> int:
+        return len(self._object[0]) if self._object else None
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None, **kwargs) -> None:
+        if isinstance(data, str):
+            data = data.encode()
+
+        with self.bucket.lock:
+            if if_generation_match is not None and (self.generation or 0) != if_generation_match:
+                raise PreconditionFailed(f"{self.name} does not match generation {if_generation_match}")
+
+            self.bucket.generation += 1
+            self.bucket.objects[self.name] = (bytes(data), self.bucket.generation)
+            self.content_type = content_type
+
+    def upload_from_file(self, file, content_type=None, **kwargs) -> None:
+        self.upload_from_string(file.read(), content_type=content_type, **kwargs)
+
+    def upload_from_filename(self, filename: str, content_type=None, **kwargs) -> None:
+        with open(filename, "rb") as file:
+            self.upload_from_string(file.read(), content_type=content_type, **kwargs)
+
+    def download_as_bytes(self, start=None, end=None, **kwargs) -> bytes:
+        if self._object is None:
+            raise NotFound(f"{self.name} does not exist")
+
+        data = self._object[0]
+        if start is not None:
+            data = data[start : None if end is None else end + 1]
+
+        return data
+
+    def download_as_text(self, **kwargs) -> str:
+        return self.download_as_bytes(**kwargs).decode()
+
+    def download_to_filename(self, filename: str, **kwargs) -> None:
+        with open(filename, "wb") as file:
+            file.write(self.download_as_bytes())
+
+    def open(self, mode: str = "rb", chunk_size: int = None, **kwargs):
+        return io.BytesIO(self.download_as_bytes())
+
+    def exists(self, **kwargs) -> bool:
+        return self._object is not None
+
+    def delete(self, if_generation_match=None, **kwargs) -> None:
+        with self.bucket.lock:
+            if self._object is None:
+                raise NotFound(f"{self.name} does not exist")
+            if if_generation_match is not None and self.generation != if_generation_match:
+                raise PreconditionFailed(f"{self.name} does not match generation {if_generation_match}")
+
+            del self.bucket.objects[self.name]
+
+
+class FakeBucket:
+    """A Cloud Storage bucket held in memory."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.objects = {}
+        self.generation = 0
+        self.lock = threading.RLock()
+
+    def blob(self, name: str, **kwargs) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def get_blob(self, name: str, **kwargs) -> FakeBlob:
+        return FakeBlob(self, name) if name in self.objects else None
+
+    def list_blobs(self, prefix: str = "", max_results: int = None, **kwargs) -> list:
+        blobs = [FakeBlob(self, name) for name in sorted(self.objects) if name.startswith(prefix)]
+        return blobs[:max_results] if max_results else blobs
+
+    def delete_blobs(self, blobs: list, on_error=None, **kwargs) -> None:
+        for blob in blobs:
+            try:
+                blob.delete()
+            except NotFound:
+                if on_error is None:
+                    raise
+                on_error(blob)
+
+
+class FakeStorageClient:
+    """A Cloud Storage client whose buckets are held in memory."""
+
+    def __init__(self) -> None:
+        self.buckets = {}
+
+    def bucket(self, name: str) -> FakeBucket:
+        return self.buckets.setdefault(name, FakeBucket(name))
+
+
+class FakeBigQueryClient:
+    """A BigQuery client keeping the inserted rows in memory."""
+
+    def __init__(self) -> None:
+        self.rows = {}
+
+    def insert_rows_json(self, table_id: str, rows: list, row_ids: list = None, **kwargs) -> list:
+        self.rows.setdefault(table_id, []).extend(rows)
+        return []
+
+
+class FakeVisionClient:
+    """A Vision API client answering every image with the same recorded response."""
+
+    def __init__(self, response) -> None:
+        self.response = response
+        self.calls = 0
+
+    def annotate_image(self, request, **kwargs):
+        self.calls += 1
+        return self.response
+
+    def batch_annotate_images(self, requests=None, **kwargs):
+        from google.cloud.vision import BatchAnnotateImagesResponse
+
+        self.calls += len(requests)
+        return BatchAnnotateImagesResponse(responses=[self.response for _ in requests])
+
+
+class FakeVideoClient:
+    """
+    A Video Intelligence API client answering every video with the same recorded response.
+
+    Its operations are done as soon as they are submitted, and can be read back through transport.operations_client.
+    """
+
+    def __init__(self, response) -> None:
+        self.response = response
+        self.calls = 0
+        self.operations = {}
+        self.transport = SimpleNamespace(operations_client=SimpleNamespace(get_operation=self.get_operation))
+
+    def annotate_video(self, request, **kwargs):
+        from google.longrunning.operations_pb2 import Operation
+        from google.cloud.videointelligence import AnnotateVideoResponse
+
+        self.calls += 1
+        name = f"projects/benchmark/locations/local/operations/{self.calls}"
+
+        operation = Operation(name=name, done=True)
+        operation.response.Pack(AnnotateVideoResponse.pb(self.response))
+        self.operations[name] = operation
+
+        return SimpleNamespace(
+            operation=SimpleNamespace(name=name),
+            result=lambda timeout=None: self.response,
+        )
+
+    def get_operation(self, name: str, **kwargs):
+        if name not in self.operations:
+            raise NotFound(f"Operation {name} does not exist")
+
+        return self.operations[name]
+
+
+class FakeNodeRedAdapter(requests.adapters.BaseAdapter):
+    """A requests transport adapter accepting every alert, mounted on the session of the alert delivery."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.alerts = []
+
+    def send(self, request, **kwargs) -> requests.Response:
+        self.alerts.append(request.body)
+
+        response = requests.Response()
+        response.status_code = 200
+        response.request = request
+        response.url = request.url
+        response._content = b"OK"
+
+        return response
+
+    def close(self) -> None:
+        pass
+
+
+def install_fakes(monkeypatch, image_response, video_response) -> SimpleNamespace:
+    """
+    Replaces the Google Cloud clients and the Node-RED endpoint of the cloud function with in-process fakes.
+
+    Args:
+        monkeypatch (pytest.MonkeyPatch): Undoes the replacements after the test.
+        image_response (AnnotateImageResponse): The answer of the fake Vision API.
+        video_response (AnnotateVideoResponse): The answer of the fake Video Intelligence API.
+
+    Returns:
+        SimpleNamespace: The fake storage, bigquery, vision, video and node_red clients.
+    """
+
+    import utils
+
+    storage_client = FakeStorageClient()
+    bigquery_client = FakeBigQueryClient()
+    vision_client = FakeVisionClient(image_response)
+    video_client = FakeVideoClient(video_response)
+    node_red = FakeNodeRedAdapter()
+
+    monkeypatch.setattr(utils, "get_storage_client", lambda: storage_client)
+    monkeypatch.setattr(utils, "get_bigquery_client", lambda: bigquery_client)
+    monkeypatch.setattr(utils, "get_vision_client", lambda: vision_client)
+    monkeypatch.setattr(utils, "get_video_client", lambda: video_client)
+
+    # Rebuild the cached buckets, sink and alert delivery on the fakes
+    clear_cached_clients()
+
+    delivery = utils.get_alert_delivery()
+    delivery.session.mount("https://", node_red)
+    delivery.session.mount("http://", node_red)
+
+    # Reset the in-process caches
+    utils.CAMERA_TRAPS_METADATA_CACHE.update({"generation": None, "checked_at": 0.0, "cameras": {}})
+
+    return SimpleNamespace(
+        storage=storage_client,
+        bigquery=bigquery_client,
+        vision=vision_client,
+        video=video_client,
+        node_red=node_red,
+    )
+
+
+def clear_cached_clients() -> None:
+    """Clears the buckets, sink and alert delivery cached by the cloud function."""
+
+    import utils
+
+    for getter in [
+        utils.get_input_bucket,
+        utils.get_output_bucket,
+        utils.get_jobs_bucket,
+        utils.get_bigquery_sink,
+        utils.get_alert_delivery,
+    ]:
+        getter.cache_clear()
+
+
+@pytest.fixture(scope="session")
+def image_response():
+    """The recorded Vision API response of a camera trap image."""
+
+    from google.cloud.vision import AnnotateImageResponse
+
+    return AnnotateImageResponse.from_json((RESPONSES_DIR / "image_response.json").read_text())
+
+
+@pytest.fixture(scope="session")
+def video_response():
+    """The recorded Video Intelligence API response of a camera trap video."""
+
+    from google.cloud.videointelligence import AnnotateVideoResponse
+
+    return AnnotateVideoResponse.from_json((RESPONSES_DIR / "video_response.json").read_text())
+
+
+@pytest.fixture
+def cloud_fakes(monkeypatch, image_response, video_response):
+    """
+    Installs the fakes for a test, see install_fakes, and clears the clients cached on them afterwards.
+
+    Returns:
+        SimpleNamespace: The fake storage, bigquery, vision, video and node_red clients.
+    """
+
+    yield install_fakes(monkeypatch, image_response, video_response)
+
+    clear_cached_clients()
+
+
+def upload_camera_traps_metadata(camera_trap_name: str) -> None:
+    """Writes a camera traps metadata file with a single camera trap to the fake output bucket."""
+
+    import utils
+
+    utils.get_output_bucket().blob(utils.CAMERA_TRAPS_METADATA_FILE).upload_from_string(
+        "name,longitude,latitude,url,last_detection,last_activation\n"
+        f"{camera_trap_name},23.5,-19.2,https://example.org/{camera_trap_name},,\n"
+    )
+
+
+def upload_media(path: Path, name: str, content_type: str) -> dict:
+    """
+    Uploads a media file to the fake input bucket.
+
+    Returns:
+        dict: The upload event payload of the media.
+    """
+
+    import utils
+
+    blob = utils.get_input_bucket().blob(name)
+    blob.upload_from_filename(str(path), content_type=content_type)
+
+    # Cloud Storage events carry the base64 encoded MD5 hash of the object, the response cache is keyed by it
+    md5_hash = base64.b64encode(hashlib.md5(path.read_bytes()).digest()).decode()
+
+    return {"name": name, "contentType": content_type, "size": str(blob.size), "md5Hash": md5_hash}
+
+
+def upload_image(directory: Path, name: str = "test/image.jpg") -> dict:
+    """
+    Uploads a synthetic 640x480 JPEG image to the fake input bucket, see make_image.
+
+    Returns:
+        dict: The upload event payload of the image.
+    """
+
+    path = directory / Path(name).name
+    make_image(path, 640, 480)
+
+    return upload_media(path, name, "image/jpeg")
+
+
+def make_image(path: Path, width: int, height: int) -> int:
+    """
+    Writes a synthetic camera trap JPEG image: textured background and a few bright shapes.
+
+    Returns:
+        int: The size of the image in bytes.
+    """
+
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(width * height)
+    image = rng.integers(40, 160, (height // 8, width // 8, 3), dtype=np.uint8)
+    image = cv2.resize(image, (width, height), interpolation=cv2.INTER_CUBIC)
+    for index in range(3):
+        center = (int(width * (0.2 + 0.3 * index)), int(height * 0.55))
+        cv2.ellipse(image, center, (width // 10, height // 8), 0, 0, 360, (230, 230, 230), -1)
+
+    cv2.imwrite(str(path), image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+
+    return path.stat().st_size
+
+
+def make_video(path: Path, width: int, height: int, seconds: float, frame_rate: int = 30) -> int:
+    """
+    Writes a synthetic camera trap MP4 video: textured background and a moving shape.
+
+    Returns:
+        int: The size of the video in bytes.
+    """
+
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(width * height)
+    background = rng.integers(40, 160, (height // 8, width // 8, 3), dtype=np.uint8)
+    background = cv2.resize(background, (width, height), interpolation=cv2.INTER_CUBIC)
+
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"mp4v"), frame_rate, (width, height))
+    frame_count = int(seconds * frame_rate)
+    for index in range(frame_count):
+        frame = background.copy()
+        center = (int(width * (0.1 + 0.8 * index / frame_count)), height // 2)
+        cv2.circle(frame, center, height // 8, (230, 230, 230), -1)
+        writer.write(frame)
+    writer.release()
+
+    return path.stat().st_size
@@ -0,0 +1,89 @@
+"""
+Benchmarks of the image pipeline of the cloud function.
+"""
+
+# Imports
+import pytest
+
+import main
+import utils
+
+from conftest import reset_calls
+from fakes import make_image, upload_media
+from response_model import ImageResult
+
+pytest.importorskip("pytest_benchmark")
+
+
+IMAGE_SIZES = {"vga": (640, 480), "1080p": (1920, 1080), "12mp": (4000, 3000)}
+
+
+@pytest.fixture(scope="module", params=list(IMAGE_SIZES))
+def image_file(request, media_dir):
+    """A synthetic JPEG image of each size."""
+
+    width, height = IMAGE_SIZES[request.param]
+    path = media_dir / f"image-{request.param}.jpg"
+    if not path.exists():
+        make_image(path, width, height)
+
+    return path
+
+
+@pytest.mark.parametrize("response_cache", ["miss", "hit"])
+def test_get_predictions_image(cloud, measure, image_file, response_cache):
+    """Runs get_predictions end to end on an uploaded image, calling the Vision API or reusing its cached response."""
+
+    event = upload_media(image_file, f"benchmark/{image_file.name}", "image/jpeg")
+
+    # Cache the response of the image before the rounds that reuse it
+    if response_cache == "hit":
+        main.get_predictions(event, None)
+
+    measure(
+        main.get_predictions, event, None, rounds=5, setup=lambda: reset_calls(cloud, response_cache == "miss")
+    )
+
+    assert cloud.vision.calls == (1 if response_cache == "miss" else 0)
+    assert len(cloud.node_red.alerts) == 1
+
+
+def test_get_image_outputs(benchmark, image_response):
+    """Parses and summarizes a recorded Vision API response."""
+
+    best_detection, image_outputs = benchmark(lambda: utils.get_image_outputs(ImageResult(image_response)))
+
+    assert best_detection == "Zebra"
+
+
+def test_draw_bounding_boxes(cloud, measure, image_file, image_response):
+    """Draws the bounding boxes of a recorded response on an image and encodes its preview."""
+
+    event = upload_media(image_file, f"benchmark/{image_file.name}", "image/jpeg")
+    _, image_outputs = utils.get_image_outputs(ImageResult(image_response))
+
+    def draw():
+        media = utils.Media(event["name"], event["size"])
+        return utils.draw_bounding_boxes(media, image_outputs["bounding_boxes"])
+
+    preview = measure(draw, rounds=5)
+
+    assert len(preview) > 0
+
+
+def test_preprocess_image(cloud, measure, image_file, monkeypatch):
+    """Masks, crops and downscales an image before it is sent inline to the Vision API."""
+
+    event = upload_media(image_file, f"benchmark/{image_file.name}", "image/jpeg")
+    monkeypatch.setattr(utils, "IMAGE_PREPROCESSING_MODE", "on")
+    preprocessing = utils.get_image_preprocessing("benchmark")
+    preprocessing["masks"] = ((0.0, 0.9, 1.0, 1.0),)
+
+    def preprocess():
+        media = utils.Media(event["name"], event["size"])
+        return utils.preprocess_image(media, preprocessing)
+
+    sent_media, transform = measure(preprocess, rounds=5)
+
+    assert max(transform["sent_size"]) <= utils.IMAGE_PREPROCESSING_MAX_EDGE
+    assert sent_media.inline
@@ -0,0 +1,82 @@
+"""
+Benchmarks of the video pipeline of the cloud function.
+"""
+
+# Imports
+import pytest
+
+import main
+import utils
+
+from conftest import reset_calls
+from fakes import make_video, upload_media
+from response_model import VideoResult
+
+pytest.importorskip("pytest_benchmark")
+
+
+VIDEO_SIZES = {"240p-3s": (320, 240, 3), "720p-5s": (1280, 720, 5)}
+
+
+@pytest.fixture(scope="module", params=list(VIDEO_SIZES))
+def video_file(request, media_dir):
+    """A synthetic MP4 video of each size."""
+
+    width, height, seconds = VIDEO_SIZES[request.param]
+    path = media_dir / f"video-{request.param}.mp4"
+    if not path.exists():
+        make_video(path, width, height, seconds)
+
+    return path
+
+
+@pytest.mark.parametrize("response_cache", ["miss", "hit"])
+@pytest.mark.parametrize("annotation_mode", ["thumbnail", "full"])
+def test_get_predictions_video(cloud, measure, monkeypatch, video_file, annotation_mode, response_cache):
+    """
+    Runs get_predictions end to end on an uploaded video, rendering the annotated video or only its thumbnail, and
+    calling the Video Intelligence API or reusing its cached response.
+    """
+
+    monkeypatch.setattr(main, "VIDEO_ANNOTATION_MODE", annotation_mode)
+    event = upload_media(video_file, f"benchmark/{video_file.name}", "video/mp4")
+
+    # Cache the response of the video before the rounds that reuse it
+    if response_cache == "hit":
+        main.get_predictions(event, None)
+
+    measure(
+        main.get_predictions, event, None, rounds=3, setup=lambda: reset_calls(cloud, response_cache == "miss")
+    )
+
+    assert cloud.video.calls == (1 if response_cache == "miss" else 0)
+    assert len(cloud.node_red.alerts) == 1
+
+
+def test_get_video_outputs(benchmark, video_response):
+    """Parses and summarizes a recorded Video Intelligence API response."""
+
+    best_detection, summary = benchmark(lambda: utils.get_video_outputs(VideoResult(video_response)))
+
+    assert best_detection == "zebra"
+
+
+def test_annotate_video(cloud, measure, video_file, video_response):
+    """Renders the annotated video of a recorded response."""
+
+    event = upload_media(video_file, f"benchmark/{video_file.name}", "video/mp4")
+
+    thumbnail = measure(utils.annotate_video, VideoResult(video_response), event["name"], rounds=3)
+
+    assert len(thumbnail) > 0
+    assert utils.get_output_bucket().get_blob(event["name"]) is not None
+
+
+def test_annotate_video_thumbnail(cloud, measure, video_file, video_response):
+    """Annotates the thumbnail frame of a recorded response."""
+
+    event = upload_media(video_file, f"benchmark/{video_file.name}", "video/mp4")
+
+    thumbnail = measure(utils.annotate_video_thumbnail, VideoResult(video_response), event["name"], rounds=3)
+
+    assert len(thumbnail) > 0
@@ -0,0 +1,513 @@
+# Imports
+import json
+import time
+import uuid
+import random
+import threading
+
+from datetime import datetime, timezone
+from collections import defaultdict
+from typing import Callable, List
+
+from google.api_core import exceptions
+
+
+# Exceptions of a write request that are worth retrying
+TRANSIENT_EXCEPTIONS = (
+    exceptions.TooManyRequests,
+    exceptions.InternalServerError,
+    exceptions.BadGateway,
+    exceptions.ServiceUnavailable,
+    exceptions.GatewayTimeout,
+    ConnectionError,
+    TimeoutError,
+)
+
+# Reasons of a row error that are worth retrying, "stopped" rows were valid but part of a failed request
+TRANSIENT_REASONS = {"backendError", "internalError", "rateLimitExceeded", "timeout", "stopped"}
+
+
+class InsertAllTransport:
+    """Writes rows with the BigQuery streaming insert API."""
+
+    def __init__(self, client_factory: Callable) -> None:
+        """
+        Args:
+            client_factory (Callable): Returns the BigQuery client to use.
+        """
+
+        self.client_factory = client_factory
+
+    def write(self, table_id: str, rows: List[dict], row_ids: List[str]) -> List[dict]:
+        """
+        Writes rows to a table.
+
+        Args:
+            table_id (str): The ID of the table, as "project.dataset.table".
+            rows (List[dict]): The rows to write.
+            row_ids (List[str]): Unique IDs of the rows, used by BigQuery to drop the duplicates of retried rows.
+
+        Returns:
+            List[dict]: The row errors, as {"index": int, "errors": [{"reason": str, "message": str}]}.
+        """
+
+        return self.client_factory().insert_rows_json(table_id, rows, row_ids=row_ids)
+
+
+class StorageWriteTransport:
+    """
+    Writes rows to the default stream of the BigQuery Storage Write API.
+
+    Requires the google-cloud-bigquery-storage package. The protobuf schema of each table is derived from its BigQuery
+    schema once, on the first write.
+    """
+
+    # Protobuf types of the BigQuery types, TIMESTAMP values are written as microseconds since the epoch
+    PROTO_TYPES = {
+        "STRING": "TYPE_STRING",
+        "BYTES": "TYPE_BYTES",
+        "INTEGER": "TYPE_INT64",
+        "INT64": "TYPE_INT64",
+        "FLOAT": "TYPE_DOUBLE",
+        "FLOAT64": "TYPE_DOUBLE",
+        "BOOLEAN": "TYPE_BOOL",
+        "BOOL": "TYPE_BOOL",
+        "TIMESTAMP": "TYPE_INT64",
+        "DATETIME": "TYPE_STRING",
+        "DATE": "TYPE_STRING",
+        "NUMERIC": "TYPE_STRING",
+        "JSON": "TYPE_STRING",
+    }
+
+    def __init__(self, client_factory: Callable) -> None:
+        """
+        Args:
+            client_factory (Callable): Returns the BigQuery client used to get the schema of the tables.
+        """
+
+        from google.cloud import bigquery_storage_v1
+
+        self.client_factory = client_factory
+        self.write_client = bigquery_storage_v1.BigQueryWriteClient()
+        self.tables = {}
+
+    def get_table(self, table_id: str):
+        """
+        Returns the default stream name, protobuf descriptor, message class and schema of a table.
+
+        Args:
+            table_id (str): The ID of the table, as "project.dataset.table".
+
+        Returns:
+            tuple: The stream name, the DescriptorProto of the rows, their message class and the BigQuery schema.
+        """
+
+        if table_id in self.tables:
+            return self.tables[table_id]
+
+        from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+        schema = self.client_factory().get_table(table_id).schema
+
+        # Describe the rows of the table as a protobuf message
+        descriptor_proto = descriptor_pb2.DescriptorProto(name="Row")
+        for number, field in enumerate(schema, start=1):
+            if field.field_type not in self.PROTO_TYPES:
+                raise ValueError(f"Unsupported type {field.field_type} of {table_id}.{field.name}")
+
+            descriptor_proto.field.add(
+                name=field.name,
+                number=number,
+                type=getattr(descriptor_pb2.FieldDescriptorProto, self.PROTO_TYPES[field.field_type]),
+                label=descriptor_pb2.FieldDescriptorProto.LABEL_REPEATED
+                if field.mode == "REPEATED"
+                else descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL,
+            )
+
+        file_proto = descriptor_pb2.FileDescriptorProto(name="row.proto", package="sink")
+        file_proto.message_type.add().CopyFrom(descriptor_proto)
+
+        pool = descriptor_pool.DescriptorPool()
+        pool.Add(file_proto)
+        descriptor = pool.FindMessageTypeByName("sink.Row")
+
+        if hasattr(message_factory, "GetMessageClass"):
+            row_class = message_factory.GetMessageClass(descriptor)
+        else:
+            row_class = message_factory.MessageFactory(pool).GetPrototype(descriptor)
+
+        project, dataset, table = table_id.split(".")
+        stream_name = f"{self.write_client.table_path(project, dataset, table)}/streams/_default"
+
+        self.tables[table_id] = (stream_name, descriptor_proto, row_class, schema)
+
+        return self.tables[table_id]
+
+    @staticmethod
+    def to_proto_value(field, value):
+        """Converts a JSON row value to the protobuf representation of its BigQuery type."""
+
+        if value is None:
+            return None
+
+        if field.field_type == "TIMESTAMP":
+            if isinstance(value, str):
+                value = datetime.fromisoformat(value)
+            if value.tzinfo is None:
+                value = value.replace(tzinfo=timezone.utc)
+            return int(value.timestamp() * 1_000_000)
+
+        if field.field_type in ["DATETIME", "DATE", "NUMERIC"]:
+            return str(value)
+
+        if field.field_type == "JSON" and not isinstance(value, str):
+            return json.dumps(value)
+
+        return value
+
+    def write(self, table_id: str, rows: List[dict], row_ids: List[str]) -> List[dict]:
+        """
+        Writes rows to a table, see InsertAllTransport.write. The default stream does not deduplicate rows.
+        """
+
+        from google.cloud.bigquery_storage_v1 import types, writer
+
+        stream_name, descriptor_proto, row_class, schema = self.get_table(table_id)
+
+        # Serialize the rows
+        serialized_rows = []
+        for row in rows:
+            message = row_class()
+            for field in schema:
+                value = row.get(field.name)
+                if value is None:
+                    continue
+                if field.mode == "REPEATED":
+                    getattr(message, field.name).extend(
+                        self.to_proto_value(field, item) for item in value
+                    )
+                else:
+                    setattr(message, field.name, self.to_proto_value(field, value))
+            serialized_rows.append(message.SerializeToString())
+
+        request_template = types.AppendRowsRequest(
+            write_stream=stream_name,
+            proto_rows=types.AppendRowsRequest.ProtoData(
+                writer_schema=types.ProtoSchema(proto_descriptor=descriptor_proto)
+            ),
+        )
+
+        append_rows_stream = writer.AppendRowsStream(self.write_client, request_template)
+
+        try:
+            request = types.AppendRowsRequest(
+                proto_rows=types.AppendRowsRequest.ProtoData(
+                    rows=types.ProtoRows(serialized_rows=serialized_rows)
+                )
+            )
+            response = append_rows_stream.send(request).result()
+        finally:
+            append_rows_stream.close()
+
+        return [
+            {"index": row_error.index, "errors": [{"reason": row_error.code.name, "message": row_error.message}]}
+            for row_error in response.row_errors
+        ]
+
+
+class InMemoryTransport:
+    """
+    Keeps the written rows in memory, to test the sink offline.
+
+    Failures can be scripted: each write pops the next item of failures, and raises it if it is an exception or
+    returns it as the row errors if it is a list.
+    """
+
+    def __init__(self, failures: list = None) -> None:
+        """
+        Args:
+            failures (list, optional): The scripted failures of the next writes.
+        """
+
+        self.tables = defaultdict(list)
+        self.failures = list(failures or [])
+        self.requests = 0
+
+    def write(self, table_id: str, rows: List[dict], row_ids: List[str]) -> List[dict]:
+        """
+        Writes rows to a table, see InsertAllTransport.write.
+        """
+
+        self.requests += 1
+
+        if self.failures:
+            failure = self.failures.pop(0)
+            if isinstance(failure, BaseException):
+                raise failure
+
+            # Only the rows without errors are written
+            failed = {error["index"] for error in failure}
+            self.tables[table_id].extend(row for index, row in enumerate(rows) if index not in failed)
+            return failure
+
+        self.tables[table_id].extend(rows)
+        return []
+
+
+class BigQuerySink:
+    """
+    Buffers BigQuery rows per table, and writes them in batches.
+
+    A table is flushed when its buffer reaches max_rows rows or max_bytes bytes, or when its oldest row is older than
+    max_age seconds. Rows failing with a transient error are retried with exponential backoff and jitter, and kept
+    in the buffer for the next flush if they still fail. Rows rejected by BigQuery are logged with their error, so
+    that they can be recovered from the logs. A batch whose write fails with a permanent error, e.g. a missing table,
+    is written to a dead-letter object of Cloud Storage, or kept for the next flush if it cannot be. The other tables
+    are still written.
+    """
+
+    def __init__(
+        self,
+        transport,
+        max_rows: int = 500,
+        max_bytes: int = 5 * 1024 * 1024,
+        max_age: float = 0.0,
+        max_attempts: int = 5,
+        initial_backoff: float = 0.5,
+        max_backoff: float = 8.0,
+        sleep: Callable = time.sleep,
+        clock: Callable = time.monotonic,
+        bucket_factory: Callable = None,
+        dead_letter_prefix: str = "bigquery-dead-letter/",
+    ) -> None:
+        """
+        Args:
+            transport: The transport writing the rows, with a write(table_id, rows, row_ids) method.
+            max_rows (int, optional): The number of buffered rows of a table that triggers a flush.
+            max_bytes (int, optional): The JSON size of the buffered rows of a table that triggers a flush.
+            max_age (float, optional): The age in seconds of the oldest row of a table after which it is due for a
+                                       flush, 0 flushes all the rows on every call to flush_due.
+            max_attempts (int, optional): The number of attempts of a flush before the rows are kept for the next one.
+            initial_backoff (float, optional): The delay in seconds before the first retry, doubled at each retry.
+            max_backoff (float, optional): The maximum delay in seconds between two attempts.
+            sleep (Callable, optional): The function used to wait between two attempts.
+            clock (Callable, optional): The monotonic clock used to compute the age of the rows.
+            bucket_factory (Callable, optional): Returns the Cloud Storage bucket of the dead-letter objects, the
+                                                 failed batches are kept for the next flush without it.
+            dead_letter_prefix (str, optional): The prefix of the dead-letter objects in the bucket.
+        """
+
+        self.transport = transport
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_attempts = max_attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.clock = clock
+        self.bucket_factory = bucket_factory
+        self.dead_letter_prefix = dead_letter_prefix
+
+        # Buffered (row, row_id, size) of each table, and the time their oldest row was added
+        self.buffers = defaultdict(list)
+        self.buffered_bytes = defaultdict(int)
+        self.oldest = {}
+
+        self.lock = threading.Lock()
+        self.stats = {
+            "rows": 0,
+            "requests": 0,
+            "retries": 0,
+            "rejected_rows": 0,
+            "requeued_rows": 0,
+            "dead_letter_rows": 0,
+        }
+
+    def count(self, name: str, value: int = 1) -> None:
+        """Increments a statistic of the sink, the tables are written by concurrent threads."""
+
+        with self.lock:
+            self.stats[name] += value
+
+    def add(self, table_id: str, row: dict, row_id: str = None) -> None:
+        """
+        Buffers a row, and flushes its table if the buffer is full.
+
+        Args:
+            table_id (str): The ID of the table, as "project.dataset.table".
+            row (dict): The row, as a JSON serializable dictionary.
+            row_id (str, optional): A unique ID of the row, a random one is generated by default.
+        """
+
+        size = len(json.dumps(row, default=str))
+
+        with self.lock:
+            self.buffers[table_id].append((row, row_id or uuid.uuid4().hex, size))
+            self.buffered_bytes[table_id] += size
+            self.oldest.setdefault(table_id, self.clock())
+
+            full = (
+                len(self.buffers[table_id]) >= self.max_rows
+                or self.buffered_bytes[table_id] >= self.max_bytes
+                or (self.max_age > 0 and self.clock() - self.oldest[table_id] >= self.max_age)
+            )
+
+        if full:
+            self.flush(table_id)
+
+    def flush_due(self) -> None:
+        """
+        Flushes the tables whose oldest row is older than max_age.
+        """
+
+        now = self.clock()
+
+        with self.lock:
+            tables = [table_id for table_id, oldest in self.oldest.items() if now - oldest >= self.max_age]
+
+        for table_id in tables:
+            self.flush(table_id)
+
+    def flush(self, table_id: str = None) -> None:
+        """
+        Writes the buffered rows of a table, or of all the tables.
+
+        Args:
+            table_id (str, optional): The ID of the table to flush, all the tables are flushed by default.
+        """
+
+        with self.lock:
+            tables = [table_id] if table_id is not None else list(self.buffers)
+            batches = {table: self.buffers.pop(table, []) for table in tables}
+            for table in tables:
+                self.buffered_bytes.pop(table, None)
+                self.oldest.pop(table, None)
+
+        for table, batch in batches.items():
+            if batch:
+                self.write(table, batch)
+
+    def write(self, table_id: str, batch: list) -> None:
+        """
+        Writes a batch of buffered rows, retrying the transient errors.
+
+        Args:
+            table_id (str): The ID of the table.
+            batch (list): The (row, row_id, size) to write.
+        """
+
+        pending = batch
+
+        for attempt in range(self.max_attempts):
+
+            if attempt > 0:
+                self.count("retries")
+                backoff = min(self.max_backoff, self.initial_backoff * 2 ** (attempt - 1))
+                self.sleep(backoff * random.uniform(0.5, 1.0))
+
+            self.count("requests")
+
+            try:
+                errors = self.transport.write(
+                    table_id, [row for row, _, _ in pending], [row_id for _, row_id, _ in pending]
+                )
+            except TRANSIENT_EXCEPTIONS as error:
+                print(f"Transient error while inserting rows into {table_id}: {error}")
+                continue
+            except Exception as error:
+                # Retrying would not help, e.g. the table does not exist or the function may not write to it
+                self.dead_letter(table_id, pending, error)
+                return
+
+            # Split the failed rows between the transient and the permanent errors
+            transient = set()
+            for error in errors:
+                if all(reason.get("reason") in TRANSIENT_REASONS for reason in error["errors"]):
+                    transient.add(error["index"])
+                else:
+                    self.count("rejected_rows")
+                    print(
+                        json.dumps(
+                            {
+                                "message": "Rejected BigQuery row",
+                                "table_id": table_id,
+                                "row": pending[error["index"]][0],
+                                "errors": error["errors"],
+                            },
+                            default=str,
+                        )
+                    )
+
+            failed = {error["index"] for error in errors}
+            self.count("rows", len(pending) - len(failed))
+
+            if len(pending) > len(failed):
+                print(f"{len(pending) - len(failed)} new rows have been added to {table_id}.")
+
+            pending = [pending[index] for index in sorted(transient)]
+
+            if not pending:
+                return
+
+        # Keep the rows that still fail for the next flush
+        self.requeue(table_id, pending)
+
+    def requeue(self, table_id: str, batch: list) -> None:
+        """
+        Puts rows back at the head of the buffer of their table, for the next flush.
+
+        Args:
+            table_id (str): The ID of the table.
+            batch (list): The (row, row_id, size) to keep.
+        """
+
+        print(f"Keeping {len(batch)} rows of {table_id} for the next flush.")
+
+        with self.lock:
+            self.stats["requeued_rows"] += len(batch)
+            self.buffers[table_id][:0] = batch
+            self.buffered_bytes[table_id] += sum(size for _, _, size in batch)
+            self.oldest.setdefault(table_id, self.clock())
+
+    def dead_letter(self, table_id: str, batch: list, error: Exception) -> None:
+        """
+        Writes a batch that failed with a permanent error to a dead-letter object, or requeues it if it cannot be.
+
+        Args:
+            table_id (str): The ID of the table.
+            batch (list): The (row, row_id, size) that could not be written.
+            error (Exception): The error of the write.
+        """
+
+        print(
+            json.dumps(
+                {"message": "BigQuery write failed", "table_id": table_id, "rows": len(batch), "error": repr(error)}
+            )
+        )
+
+        if self.bucket_factory is None:
+            self.requeue(table_id, batch)
+            return
+
+        # Object names sort in the order the batches failed
+        blob_name = f"{self.dead_letter_prefix}{table_id}/{datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex}.json"
+        dead_letter = {
+            "table_id": table_id,
+            "error": repr(error),
+            "rows": [row for row, _, _ in batch],
+            "row_ids": [row_id for _, row_id, _ in batch],
+        }
+
+        try:
+            self.bucket_factory().blob(blob_name).upload_from_string(
+                json.dumps(dead_letter, default=str), content_type="application/json", if_generation_match=0
+            )
+        except Exception as upload_error:
+            print(f"Could not write the dead-letter object {blob_name}: {upload_error!r}")
+            self.requeue(table_id, batch)
+            return
+
+        self.count("dead_letter_rows", len(batch))
+        print(f"{len(batch)} rows of {table_id} written to {blob_name}.")
+
@@ -1,3 +1,5 @@
+import os
+
 from google.cloud import vision, videointelligence
 
 PROJECT = "smart-parks-cameras"
@@ -5,6 +7,10 @@ PROJECT = "smart-parks-cameras"
 INPUT_BUCKET_NAME = "camera-traps-media"
 OUTPUT_BUCKET_NAME = "models-outputs"
 
+# Bucket of the render jobs and of the video annotation results, the only objects handle_job_object processes. It is
+# kept apart from the output bucket so that its trigger does not fire on every object written there
+JOBS_BUCKET_NAME = "models-jobs"
+
 IMAGE_EXTENSIONS = [".jpeg", ".jpg", ".png", ".gif", ".raw", ".bmp", ".pdf", ".webp", ".ico", ".tiff"]
 VIDEO_EXTENSIONS = [".mov", ".mpeg4", ".mp4", ".avi"]
 
@@ -24,4 +30,208 @@ VIDEO_USE_CASES = {
     "people_detection": videointelligence.Feature.PERSON_DETECTION
 }
 
-CAMERA_TRAPS_METADATA_PATH = f"gs://{OUTPUT_BUCKET_NAME}/metadata.csv"
+# Post-processing steps of a media: "bigquery" stores the API response, "detections" its flattened detections,
+# "annotation" draws the bounding boxes on the media and "alert" sends it to Node-RED
+POST_PROCESSING_STEPS = ["bigquery", "detections", "annotation", "alert"]
+
+# The use cases (keys of IMAGE_USE_CASES and VIDEO_USE_CASES) requested for the media of a camera trap and the
+# post-processing steps run on them are selected by the use_cases and steps columns of the camera traps metadata, as
+# ";" separated lists. All of them are used when a column is empty
+CAMERA_TRAPS_METADATA_FILE = "metadata.csv"
+CAMERA_TRAPS_METADATA_PATH = f"gs://{OUTPUT_BUCKET_NAME}/{CAMERA_TRAPS_METADATA_FILE}"
+
+# Minimum number of seconds between two generation checks of the camera traps metadata file
+CAMERA_TRAPS_METADATA_REVALIDATE_SECONDS = 30
+
+# Prefix of the append-only camera traps activation records in the output bucket
+ACTIVATIONS_PREFIX = "activations/"
+
+# Format of the activation times written to the activation records and the metadata file, with the microseconds even
+# when they are 0
+ACTIVATION_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# Maximum number of attempts to materialize the activations into the metadata file
+COMPACTION_MAX_ATTEMPTS = 5
+
+# Minimum confidence of the object tracks drawn on the annotated videos
+VIDEO_CONFIDENCE_THRESHOLD = 0.6
+
+# Maximum distance in seconds between a video frame and the annotated frames drawn on it
+VIDEO_FRAME_TIME_DELTA = 0.05
+
+# x264 preset and constant rate factor of the annotated videos
+VIDEO_ENCODING_PRESET = "veryfast"
+VIDEO_ENCODING_CRF = 23
+
+# Size in bytes of the range downloads in which the videos are streamed to the decoder, see serve_video_ranges
+VIDEO_STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+
+# "full" renders the annotated video before sending the alert; "thumbnail" only annotates the frame sent with the alert
+# and defers the annotated video to a render job under RENDER_JOBS_PREFIX in the jobs bucket. "thumbnail" requires the
+# jobs bucket and handle_job_object to be deployed with a Cloud Storage trigger on it, otherwise the render jobs cannot
+# be written and the annotated videos are never rendered
+VIDEO_ANNOTATION_MODE = "full"
+
+# Frame sent with the alert when no object track is confident enough
+VIDEO_THUMBNAIL_FRAME = 60
+
+# Prefix of the deferred annotated video render jobs in the jobs bucket
+RENDER_JOBS_PREFIX = "render-jobs/"
+
+# "sync" waits for the result in get_predictions; "async" submits the video annotation and returns, the video is
+# processed by handle_job_object when the API writes its result under VIDEO_RESULTS_PREFIX in the jobs bucket.
+# "async" requires handle_job_object to be deployed with a Cloud Storage trigger on that bucket, and
+# check_video_operations to be scheduled, otherwise the videos are never processed
+VIDEO_PIPELINE_MODE = "sync"
+VIDEO_RESULTS_PREFIX = "video-results/"
+
+# Prefix of the records of the submitted video annotations in the output bucket, and age in seconds after which a
+# record still there is reported as stuck by check_video_operations
+VIDEO_OPERATIONS_PREFIX = "video-operations/"
+VIDEO_OPERATION_STUCK_SECONDS = 30 * 60
+
+# "video_intelligence" analyzes the videos with the Video Intelligence API, "keyframes" sends KEYFRAMES_COUNT keyframes
+# of each video to the Vision API in one batch request, "auto" does so for the videos up to
+# KEYFRAMES_MAX_DURATION_SECONDS long. Overridden per camera trap by the video_analysis column of the metadata
+VIDEO_ANALYSIS_MODE = "video_intelligence"
+KEYFRAMES_MAX_DURATION_SECONDS = 15
+
+# Number of keyframes, "uniform" (evenly spaced) or "scene" (largest scene changes) selection, frames per second
+# considered, and maximum edge in pixels of the keyframes sent to the Vision API
+KEYFRAMES_COUNT = 8
+KEYFRAMES_SELECTION = "uniform"
+KEYFRAMES_SAMPLE_FPS = 2
+KEYFRAMES_MAX_EDGE = 1280
+
+# Vision API features requested for the keyframes, by use case (keys of VIDEO_USE_CASES). The person tracks are built
+# from the localized objects, only the Person ones are kept without object_detection
+KEYFRAMES_USE_CASES = {
+    "object_detection": vision.Feature.Type.OBJECT_LOCALIZATION,
+    "label_detection": vision.Feature.Type.LABEL_DETECTION,
+    "people_detection": vision.Feature.Type.OBJECT_LOCALIZATION
+}
+
+# Images up to this size in bytes are sent to the Vision API as inline content (the API accepts 10 MB requests)
+VISION_INLINE_MAX_BYTES = 8 * 1024 * 1024
+
+# "on" preprocesses the images before sending them inline to the Vision API: the masks of their camera trap (masks
+# column of the camera traps metadata) are filled, they are cropped to its region of interest (roi column), and
+# downscaled to IMAGE_PREPROCESSING_MAX_EDGE pixels on their longest edge. The returned coordinates are mapped back to
+# the original images. "off" sends the original images
+IMAGE_PREPROCESSING_MODE = "off"
+IMAGE_PREPROCESSING_MAX_EDGE = 1600
+IMAGE_PREPROCESSING_JPEG_QUALITY = 90
+
+# "single" annotates each image when it is uploaded, "batch" queues it under PENDING_IMAGES_PREFIX in the output bucket
+# and the queued images are annotated together by annotate_pending_images
+IMAGE_INGESTION_MODE = "single"
+PENDING_IMAGES_PREFIX = "pending-images/"
+
+# Runs a pending image is kept for when its annotation or processing fails, after which it is moved under
+# FAILED_IMAGES_PREFIX in the output bucket to be inspected and queued again by hand
+PENDING_IMAGES_MAX_ATTEMPTS = 5
+FAILED_IMAGES_PREFIX = "failed-images/"
+
+# Images per Vision batch request (the API accepts up to 16), inline bytes per batch request, and images annotated
+# per annotate_pending_images run
+VISION_BATCH_SIZE = 16
+VISION_BATCH_MAX_INLINE_BYTES = 8 * 1024 * 1024
+PENDING_IMAGES_MAX = 128
+
+# Prefix of the cached API responses in the output bucket, keyed by the hash of the media and the requested features,
+# and number of seconds a cached response is reused for
+RESPONSE_CACHE_PREFIX = "response-cache/"
+RESPONSE_CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# Local motion pre-filter: "off" calls the APIs for every media, "audit" scores the media and logs the decision without
+# skipping anything, "skip" skips the media whose motion score is below the threshold of its camera trap
+MOTION_FILTER_MODE = "off"
+
+# Fraction of changed pixels under which a media is considered empty, overridden by the motion_threshold column of
+# the camera traps metadata
+MOTION_FILTER_DEFAULT_THRESHOLD = 0.002
+
+# Width in pixels of the downsampled grayscale frames, and intensity difference of a changed pixel
+MOTION_FILTER_WIDTH = 160
+MOTION_FILTER_PIXEL_DELTA = 25
+
+# Frames per second compared in the videos
+MOTION_FILTER_VIDEO_FPS = 2
+
+# Prefix of the camera traps backgrounds the images are compared to, and weight of each image in its camera background
+BACKGROUNDS_PREFIX = "backgrounds/"
+MOTION_FILTER_BACKGROUND_ALPHA = 0.2
+
+# Maximum number of attempts to update a background that other invocations update concurrently
+MOTION_FILTER_BACKGROUND_MAX_ATTEMPTS = 5
+
+# Whether the images are blended in the backgrounds, disabled with MOTION_FILTER_UPDATE_BACKGROUNDS=false, e.g. when
+# reprocessing past media, so that old images do not alter the live backgrounds
+MOTION_FILTER_UPDATE_BACKGROUNDS = os.environ.get("MOTION_FILTER_UPDATE_BACKGROUNDS", "true").lower() != "false"
+
+# Dataset of the operational telemetry, kept apart from the detections, and table of the motion pre-filter decisions
+MONITORING_DATASET = "monitoring"
+MOTION_FILTER_TABLE = "motion_filter"
+
+# Maximum edge in pixels, byte budget and JPEG qualities of the image previews sent with the alerts
+PREVIEW_MAX_EDGE = 1280
+PREVIEW_MAX_BYTES = 200 * 1024
+PREVIEW_QUALITIES = [85, 75, 60, 45]
+
+# BigQuery sink: "insert_all" uses the streaming insert API, "storage_write" the Storage Write API
+# (requires google-cloud-bigquery-storage)
+BIGQUERY_SINK_TRANSPORT = "insert_all"
+
+# A table is written when it has this many buffered rows or bytes
+BIGQUERY_SINK_MAX_ROWS = 500
+BIGQUERY_SINK_MAX_BYTES = 5 * 1024 * 1024
+
+# Rows older than this are written at the end of each invocation. With 0, every invocation writes its rows before
+# returning; a higher value batches rows across the invocations of a warm instance, but the rows still buffered
+# when the instance is shut down without notice are lost
+BIGQUERY_SINK_MAX_AGE_SECONDS = 0
+
+# Number of attempts of a write before its failing rows are kept for the next one
+BIGQUERY_SINK_MAX_ATTEMPTS = 5
+
+# Prefix of the batches of rows that BigQuery refused, e.g. because their table does not exist, in the output bucket
+BIGQUERY_DEAD_LETTER_PREFIX = "bigquery-dead-letter/"
+
+# Threads running the independent stages that follow an API response concurrently: the BigQuery inserts, the
+# annotation, the metadata update and the alert. With 1, the stages run one after another
+POST_ANNOTATION_WORKERS = 8
+
+# Table of the flattened detections, one row per object, face or person
+DETECTIONS_DATASET = "detections"
+DETECTIONS_TABLE = "objects"
+
+# Minimum likelihood (3 is POSSIBLE) of the face emotions and headwear counted in the summaries and detections tags
+FACE_LIKELIHOOD_THRESHOLD = 3
+
+# Node-RED endpoint receiving the alerts, can be overridden with the NODE_RED_URL environment variable
+NODE_RED_URL = os.environ.get("NODE_RED_URL", "https://nodered-xgwild.smartparks.org/artefact")
+
+# Whether the alerts are sent, can be disabled with ALERTS_ENABLED=false, e.g. when reprocessing past media
+ALERTS_ENABLED = os.environ.get("ALERTS_ENABLED", "true").lower() != "false"
+
+# Timeouts in seconds and number of attempts of an alert before it is written to the outbox
+NODE_RED_CONNECT_TIMEOUT = 3.05
+NODE_RED_READ_TIMEOUT = 10
+NODE_RED_MAX_ATTEMPTS = 3
+
+# Prefix of the undelivered alerts in the output bucket, number of alerts delivered per drain_alerts_outbox run, and
+# number of alerts delivered by the instance that queued them once Node-RED answers again, kept small since it delays
+# the alert stage of the media being processed
+ALERTS_OUTBOX_PREFIX = "alerts-outbox/"
+ALERTS_OUTBOX_DRAIN_MAX = 100
+ALERTS_OUTBOX_INLINE_DRAIN_MAX = 5
+
+# "on" sends a minimal person alert as soon as the API response shows a person or a face with at least this
+# confidence, before the enrichment stages (BigQuery rows, annotated media, metadata update). The full alert follows,
+# linked to it by their alert_id. "off" only sends the full alert
+PERSON_FAST_LANE_MODE = "off"
+PERSON_FAST_LANE_THRESHOLD = 0.6
+
+# Export of the per-stage timing spans: "log" only logs them as structured log entries, "otel" also records them
+# with the globally configured OpenTelemetry tracer provider, and "cloud_trace" exports them to Cloud Trace
+TELEMETRY_EXPORTER = os.environ.get("TELEMETRY_EXPORTER", "log")
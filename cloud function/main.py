@@ -1,48 +1,107 @@
 # Imports
+import json
+import time
+
 from pathlib import Path
 
 from datetime import datetime
 
-from google.cloud.vision import AnnotateImageResponse
-from google.cloud.videointelligence import AnnotateVideoResponse
-
-from config import (
-    PROJECT,
-    IMAGE_USE_CASES,
-    VIDEO_USE_CASES,
-    INPUT_BUCKET_NAME,
-    OUTPUT_BUCKET_NAME,
-    IMAGE_EXTENSIONS,
-    VIDEO_EXTENSIONS,
-)
-
-from utils import (
-    get_image_response,
-    get_video_response,
-    get_camera_trap_metadata,
-    send_to_node_red,
-    get_image_outputs,
-    get_video_outputs,
-    draw_bounding_boxes,
-    bigquery_insert,
-    annotate_video,
-    update_metadata,
-)
+from telemetry import trace, span, traced, timed_imports, EAGER_IMPORT_TIMES
 
+# Time the eager imports, logged with the lazy ones by log_import_times
+with timed_imports("google.cloud+config"):
+    from google.api_core.exceptions import NotFound, PreconditionFailed
 
-def get_predictions(event, context):
+    from response_model import ImageResult, VideoResult
+
+    from config import (
+        PROJECT,
+        IMAGE_USE_CASES,
+        INPUT_BUCKET_NAME,
+        OUTPUT_BUCKET_NAME,
+        IMAGE_EXTENSIONS,
+        VIDEO_EXTENSIONS,
+        VIDEO_ANNOTATION_MODE,
+        IMAGE_INGESTION_MODE,
+        PENDING_IMAGES_MAX,
+        RENDER_JOBS_PREFIX,
+        VIDEO_PIPELINE_MODE,
+        VIDEO_RESULTS_PREFIX,
+        VIDEO_OPERATION_STUCK_SECONDS,
+        ALERTS_OUTBOX_DRAIN_MAX,
+        TELEMETRY_EXPORTER,
+    )
+
+with timed_imports("utils"):
+    from utils import (
+        Media,
+        get_image_response,
+        get_image_responses,
+        get_image_preprocessing,
+        preprocess_image,
+        restore_image_response,
+        enqueue_pending_image,
+        list_pending_images,
+        retry_pending_image,
+        get_response_cache_key,
+        get_cached_response,
+        put_cached_response,
+        log_response_cache_stats,
+        log_camera_traps_metadata_cache_stats,
+        passes_motion_filter,
+        get_video_analysis_mode,
+        get_keyframes_cache_key,
+        get_keyframes_response,
+        get_video_response,
+        submit_video_annotation,
+        get_video_operation_record,
+        load_video_result,
+        finish_video_operation,
+        list_video_operation_records,
+        get_video_operation,
+        get_camera_trap_metadata,
+        get_camera_trap_profile,
+        send_to_node_red,
+        get_person_alert,
+        send_person_alert,
+        get_image_outputs,
+        get_video_outputs,
+        draw_bounding_boxes,
+        bigquery_insert,
+        bigquery_insert_detections,
+        get_image_detections,
+        get_video_detections,
+        annotate_video,
+        annotate_video_thumbnail,
+        defer_annotated_video,
+        render_annotated_video,
+        update_metadata,
+        compact_metadata,
+        log_import_times,
+        get_bigquery_sink,
+        get_alert_delivery,
+        get_task_graph,
+        IMPORT_TIMES,
+    )
+
+IMPORT_TIMES.update(EAGER_IMPORT_TIMES)
+
+
+@traced
+def get_media_metadata(media_name: str, content_type: str, size: int, timestamp: datetime) -> dict:
     """
-    Triggered by a change to a Cloud Storage bucket.
+    Builds the metadata dictionary of an uploaded image/video, sent to Node-RED with the alert.
 
     Args:
-         event (dict): Event payload.
-         context (google.cloud.functions.Context): Metadata for the event.
+         media_name (str): The name of the media file in the input bucket.
+         content_type (str): The content type of the media file.
+         size (int): The size of the media file in bytes.
+         timestamp (datetime): The time at which the upload was processed.
+
+    Returns:
+         dict: The metadata dictionary.
     """
-    
-    # Get the name of the image/video file to annotate
-    media_name = event["name"]
-    print(f"Processing: {media_name}.")
-    
+
     # Get the camera_trap_name
     camera_trap_name = media_name.split("/")[0]
     print(camera_trap_name)
@@ -53,74 +112,569 @@ def get_predictions(event, context):
     # Create a GCS URI for the input file
     gcs_uri = "gs://" + f"{INPUT_BUCKET_NAME}/" + media_name
     
-    # Get the current timestamp
-    timestamp = datetime.now()
-    
     # Create a metadata dictionary
-    metadata = {
+    return {
         "camera_trap_name": camera_trap_name,
         "longitude": longitude,
         "latitude": latitude,
         "timestamp": timestamp,
         "media_name": media_name.split("/")[1],
-        "type": event["contentType"],
-        "size": event["size"],
+        "type": content_type,
+        "size": size,
         "input_url": gcs_uri,
     }
+
+
+@traced
+def process_image_response(media: Media, result: ImageResult, metadata: dict) -> None:
+    """
+    Stores, annotates and sends the Vision API response of an image.
+
+    Args:
+         media (Media): The image file in the input bucket.
+         result (ImageResult): The Vision API response of the image, parsed once.
+         metadata (dict): The metadata dictionary of the image, see get_media_metadata.
+    """
+
+    camera_trap_name = metadata["camera_trap_name"]
+    timestamp = metadata["timestamp"]
+    gcs_uri = metadata["input_url"]
+
+    # Only run the post-processing steps of the camera trap
+    steps = get_camera_trap_profile(camera_trap_name)["steps"]
+
+    # The independent stages run concurrently, each one as soon as the stages it depends on are done
+    graph = get_task_graph()
+
+    # Send a person alert first, the enrichment stages run meanwhile and are linked to it by its alert_id
+    person_alert = get_person_alert(metadata, result) if "alert" in steps else None
+    alert_id = metadata.get("alert_id")
+    if person_alert is not None:
+        graph.add("send_person_alert", lambda: send_person_alert(person_alert))
+
+    # Insert the API response into BigQuery
+    if "bigquery" in steps:
+        graph.add("bigquery_insert", lambda: bigquery_insert(PROJECT, "images", camera_trap_name, timestamp.strftime("%Y-%m-%d %H:%M:%S"), gcs_uri, result.json, alert_id))
+
+    # Insert the flattened detections into BigQuery
+    if "detections" in steps:
+        graph.add("bigquery_insert_detections", lambda: bigquery_insert_detections(PROJECT, camera_trap_name, timestamp.strftime("%Y-%m-%d %H:%M:%S"), gcs_uri, "image", get_image_detections(result), alert_id))
+    
+    # Get the best detection and image outputs
+    graph.add("get_image_outputs", lambda: get_image_outputs(result))
+    
+    # Draw bounding boxes on the image
+    if "annotation" in steps:
+        graph.add("draw_bounding_boxes", lambda outputs: draw_bounding_boxes(media, outputs[1]["bounding_boxes"]), after=["get_image_outputs"])
+    
+    # Update the camera trap metadata with the best detection and timestamp
+    graph.add("update_metadata", lambda outputs: update_metadata(camera_trap_name, outputs[0], timestamp, alert_id), after=["get_image_outputs"])
+    
+    # Add the summary and annotated image, if any, to the metadata dictionary, and send it to Node-RED once the person
+    # alert, if any, was sent or failed
+    def send_alert(outputs, annotated_image=None):
+        metadata["summary"] = outputs[1]["summary"]
+        metadata["image"] = annotated_image
+        return send_to_node_red(metadata)
+
+    if "alert" in steps:
+        graph.add(
+            "send_to_node_red",
+            send_alert,
+            after=[name for name in ["get_image_outputs", "draw_bounding_boxes"] if name in graph.stages],
+            wait_for=[name for name in ["send_person_alert"] if name in graph.stages],
+        )
+
+    graph.run()
+
+
+@traced
+def process_video_response(media_name: str, result: VideoResult, metadata: dict) -> None:
+    """
+    Stores, annotates and sends the Video Intelligence API response of a video.
+
+    Args:
+         media_name (str): The name of the video file in the input bucket.
+         result (VideoResult): The Video Intelligence API response of the video, parsed once.
+         metadata (dict): The metadata dictionary of the video, see get_media_metadata.
+    """
+
+    camera_trap_name = metadata["camera_trap_name"]
+    timestamp = metadata["timestamp"]
+    gcs_uri = metadata["input_url"]
+
+    # Only run the post-processing steps of the camera trap
+    steps = get_camera_trap_profile(camera_trap_name)["steps"]
+
+    # The independent stages run concurrently, each one as soon as the stages it depends on are done
+    graph = get_task_graph()
+
+    # Send a person alert first, the enrichment stages run meanwhile and are linked to it by its alert_id
+    person_alert = get_person_alert(metadata, result) if "alert" in steps else None
+    alert_id = metadata.get("alert_id")
+    if person_alert is not None:
+        graph.add("send_person_alert", lambda: send_person_alert(person_alert))
+
+    # Insert the API response into BigQuery
+    if "bigquery" in steps:
+        graph.add("bigquery_insert", lambda: bigquery_insert(PROJECT, "videos", camera_trap_name, timestamp.strftime("%Y-%m-%d %H:%M:%S"), gcs_uri, result.json, alert_id))
+
+    # Insert the flattened detections into BigQuery
+    if "detections" in steps:
+        graph.add("bigquery_insert_detections", lambda: bigquery_insert_detections(PROJECT, camera_trap_name, timestamp.strftime("%Y-%m-%d %H:%M:%S"), gcs_uri, "video", get_video_detections(result), alert_id))
+    
+    # Get the best detection and video response
+    graph.add("get_video_outputs", lambda: get_video_outputs(result))
+    
+    if "annotation" in steps and VIDEO_ANNOTATION_MODE == "thumbnail":
+        # Only annotate the frame sent with the alert, the annotated video is rendered by a separate job
+        graph.add("annotate", lambda: annotate_video_thumbnail(result, media_name))
+        graph.add("defer_annotated_video", lambda: defer_annotated_video(result, media_name))
+    elif "annotation" in steps:
+        # Annotate the video with bounding boxes and get its annotated thumbnail frame
+        graph.add("annotate", lambda: annotate_video(result, media_name))
+    
+    # Update the camera trap metadata with the best detection and timestamp
+    graph.add("update_metadata", lambda outputs: update_metadata(camera_trap_name, outputs[0], timestamp, alert_id), after=["get_video_outputs"])
+    
+    # Add the summary and annotated image, if any, to the metadata dictionary, and send it to Node-RED once the person
+    # alert, if any, was sent or failed
+    def send_alert(outputs, annotated_first_frame=None):
+        metadata["summary"] = outputs[1]
+        metadata["image"] = annotated_first_frame
+        return send_to_node_red(metadata)
+
+    if "alert" in steps:
+        graph.add(
+            "send_to_node_red",
+            send_alert,
+            after=[name for name in ["get_video_outputs", "annotate"] if name in graph.stages],
+            wait_for=[name for name in ["send_person_alert"] if name in graph.stages],
+        )
+
+    graph.run()
+
+
+@traced
+def complete_video_annotation(result_name: str) -> None:
+    """
+    Processes the result of a video annotation submitted by get_predictions in async mode, and deletes its record and
+    result file.
+
+    Args:
+         result_name (str): The name of the result written by the Video Intelligence API in the jobs bucket.
+    """
+
+    media_name = result_name[len(VIDEO_RESULTS_PREFIX) : -len(".json")]
+
+    # A result without record was already processed, or was not submitted by get_predictions
+    record = get_video_operation_record(media_name)
+    if record is None:
+        print(f"No operation record for {media_name}, skipping.")
+        return
+
+    # Read the result from the finished operation
+    result = load_video_result(record)
+
+    # Cache the response for the next uploads of the same video
+    put_cached_response(record.get("cache_key"), result.json)
+
+    # Create a metadata dictionary from the upload event fields
+    metadata = get_media_metadata(media_name, record["contentType"], record["size"], record["timestamp"])
+
+    # Store, annotate and send the response
+    process_video_response(media_name, result, metadata)
+
+    finish_video_operation(media_name)
+
+    # Log the annotation latency of the video
+    print(
+        json.dumps(
+            {
+                "message": "Video annotation completed",
+                "media_name": media_name,
+                "operation": record["operation"],
+                "seconds": round((datetime.now() - record["submitted_at"]).total_seconds(), 3),
+            }
+        )
+    )
+
+
+def process_media(event: dict, timestamp: datetime, deferred: bool = True) -> None:
+    """
+    Runs the pipeline of an image/video uploaded to the input bucket.
+
+    Args:
+         event (dict): The upload event payload, with the name, contentType, size and hashes of the media.
+         timestamp (datetime): The timestamp of the media.
+         deferred (bool, optional): Whether images may be queued in batch mode and videos submitted in async mode. With
+                                    False, the media is fully processed before returning, e.g. by the backfill tool.
+    """
+    
+    # Get the name of the image/video file to annotate
+    media_name = event["name"]
+    print(f"Processing: {media_name}.")
     
     # Get the file extension
     extension = Path(media_name).suffix.lower()
+
+    # Download the media at most once, for the motion pre-filter, the Vision API and the bounding boxes
+    media = Media(media_name, event["size"])
+
+    # Only request the features used for the camera trap
+    profile = get_camera_trap_profile(media_name.split("/")[0])
     
+    # If the media shows no motion, skip it before calling the APIs
+    if extension in IMAGE_EXTENSIONS + VIDEO_EXTENSIONS and not passes_motion_filter(
+        PROJECT, media, "image" if extension in IMAGE_EXTENSIONS else "video", timestamp
+    ):
+        print(f"Skipped without motion: {media_name}.")
+
+    # If the file is an image, queue it for the next batch in batch mode
+    elif extension in IMAGE_EXTENSIONS and deferred and IMAGE_INGESTION_MODE == "batch":
+
+        preprocessing = get_image_preprocessing(media_name.split("/")[0])
+        cache_key = get_response_cache_key(
+            "images", event, profile["image_features"], preprocessing and preprocessing["signature"]
+        )
+        enqueue_pending_image(media_name, event["contentType"], event["size"], timestamp, cache_key, profile["image_use_cases"])
+        print(f"Queued for batch annotation: {media_name}.")
+
     # If the file is an image, process it
-    if extension in IMAGE_EXTENSIONS:
-        
-        # Call the Vision API
-        response = get_image_response(gcs_uri, IMAGE_USE_CASES.values())
-        
-        # Insert the API response into BigQuery
-        bigquery_insert(PROJECT, "images", camera_trap_name, timestamp.strftime("%Y-%m-%d %H:%M:%S"), gcs_uri, AnnotateImageResponse.to_json(response))
-        
-        # Get the best detection and image outputs
-        best_detection, image_outputs = get_image_outputs(response)
+    elif extension in IMAGE_EXTENSIONS:
         
-        # Draw bounding boxes on the image
-        annotated_image = draw_bounding_boxes(media_name, image_outputs["bounding_boxes"])
-        
-        # Add the summary and annotated image to the metadata dictionary
-        metadata["summary"] = image_outputs["summary"]
-        metadata["image"] = annotated_image
-        
-        # Update the camera trap metadata with the best detection and timestamp
-        update_metadata(camera_trap_name, best_detection, timestamp)
+        # Create a metadata dictionary
+        metadata = get_media_metadata(media_name, event["contentType"], event["size"], timestamp)
+
+        # Reuse the response of the same image uploaded before, or call the Vision API on the preprocessed image
+        preprocessing = get_image_preprocessing(media_name.split("/")[0])
+        cache_key = get_response_cache_key(
+            "images", event, profile["image_features"], preprocessing and preprocessing["signature"]
+        )
+        result = get_cached_response(cache_key, ImageResult)
+        if result is None:
+            sent_media, transform = preprocess_image(media, preprocessing)
+            response = get_image_response(sent_media, profile["image_features"])
+            result = ImageResult(restore_image_response(response, transform))
+            put_cached_response(cache_key, result.json)
         
-        # Send the metadata to Node-RED
-        send_to_node_red(metadata)
+        # Store, annotate and send the response
+        process_image_response(media, result, metadata)
     
     # If the file is a video, process it
     elif extension in VIDEO_EXTENSIONS:
-        
-        # Call the Video Intelligence API 
-        response = get_video_response(gcs_uri, VIDEO_USE_CASES.values())
-        
-        # Insert the API response into BigQuery
-        bigquery_insert(PROJECT, "videos", camera_trap_name, timestamp.strftime("%Y-%m-%d %H:%M:%S"), gcs_uri, AnnotateVideoResponse.to_json(response))
-        
-        # Get the best detection and video response
-        best_detection, summary= get_video_outputs(response)
-        
-        # Annotate the first frame of the video with bounding boxes
-        annotated_first_frame = annotate_video(response, media_name)
-        
-        # Add the summary and annotated image to the metadata dictionary
-        metadata["summary"] = summary
-        metadata["image"] = annotated_first_frame
-        
-        # Update the camera trap metadata with the best detection and timestamp
-        update_metadata(camera_trap_name, best_detection, timestamp)
-        
-        # Send the metadata to Node-RED
-        send_to_node_red(metadata)
+
+        # Analyze a few keyframes with the Vision API instead, if the camera trap or the length of the video call for it,
+        # reusing the keyframes response of the same video uploaded before with the same mode and use cases
+        result = None
+        mode = get_video_analysis_mode(media_name.split("/")[0])
+        if mode in ("keyframes", "auto"):
+            keyframes_cache_key = get_keyframes_cache_key(event, mode, profile["video_use_cases"])
+            result = get_cached_response(keyframes_cache_key, VideoResult)
+            if result is None:
+                response = get_keyframes_response(media, mode, profile["video_use_cases"])
+                if response is not None:
+                    result = VideoResult(response)
+                    put_cached_response(keyframes_cache_key, result.json)
+
+        # Otherwise reuse the Video Intelligence response of the same video uploaded before
+        cache_key = get_response_cache_key("videos", event, profile["video_features"])
+        if result is None:
+            result = get_cached_response(cache_key, VideoResult)
+
+        # Submit its annotation, it is processed when the result lands in the output bucket
+        if result is None and deferred and VIDEO_PIPELINE_MODE == "async":
+            submit_video_annotation(media_name, profile["video_features"], event["contentType"], event["size"], timestamp, cache_key)
+
+        else:
+            # Create a metadata dictionary
+            metadata = get_media_metadata(media_name, event["contentType"], event["size"], timestamp)
+
+            # Call the Video Intelligence API
+            if result is None:
+                result = VideoResult(get_video_response(metadata["input_url"], profile["video_features"]))
+                put_cached_response(cache_key, result.json)
+
+            # Store, annotate and send the response
+            process_video_response(media_name, result, metadata)
     
     # If the file is not an image or video, print an error message
     else:
         print(f"File extension {extension} not supported")
+
+
+def get_predictions(event, context):
+    """
+    Triggered by a change to a Cloud Storage bucket.
+
+    Args:
+         event (dict): Event payload.
+         context (google.cloud.functions.Context): Metadata for the event.
+    """
+
+    # Time each stage of the invocation, with the camera trap, type and size of the media as attributes
+    extension = Path(event["name"]).suffix.lower()
+    media_type = "image" if extension in IMAGE_EXTENSIONS else "video" if extension in VIDEO_EXTENSIONS else None
+
+    try:
+        with trace(
+            "get_predictions",
+            TELEMETRY_EXPORTER,
+            camera_trap_name=event["name"].split("/")[0],
+            media_type=media_type,
+            size=int(event["size"]),
+        ):
+
+            try:
+                # Process the media with the current timestamp
+                process_media(event, datetime.now())
+
+            finally:
+                # Write the buffered BigQuery rows that are due, including the ones of the stages that succeeded when
+                # another one failed
+                with span("flush_bigquery"):
+                    get_bigquery_sink().flush_due()
+
+    finally:
+        # Log the response and metadata cache counters and the time spent importing modules, including the ones
+        # imported lazily by this invocation
+        log_response_cache_stats()
+        log_camera_traps_metadata_cache_stats()
+        log_import_times()
+
+
+def annotate_pending_images(event, context):
+    """
+    Triggered periodically by a Cloud Scheduler job publishing to Pub/Sub.
+
+    Annotates the images queued by get_predictions in batch mode with Vision batch requests, and processes each
+    response like get_predictions does. A pending image is removed once processed. The ones whose annotation or
+    processing failed, or left by a failed run, are annotated by the next runs, see retry_pending_image.
+
+    Args:
+         event (dict): Event payload.
+         context (google.cloud.functions.Context): Metadata for the event.
+    """
+
+    # Time each stage of the invocation
+    try:
+        with trace("annotate_pending_images", TELEMETRY_EXPORTER, media_type="image"):
+
+            try:
+                start = time.perf_counter()
+
+                # Collect the pending images
+                pending_images = list_pending_images(PENDING_IMAGES_MAX)
+                if not pending_images:
+                    print("No pending images.")
+                    return
+
+                medias = [Media(pending_image["name"], pending_image["size"]) for _, pending_image in pending_images]
+
+                # Reuse the responses of the images uploaded before
+                results = [get_cached_response(pending_image.get("cache_key"), ImageResult) for _, pending_image in pending_images]
+                errors = [None] * len(pending_images)
+                uncached = [index for index, result in enumerate(results) if result is None]
+
+                # Group the other images by the use cases requested for their camera trap
+                groups = {}
+                for index in uncached:
+                    use_cases = tuple(pending_images[index][1].get("use_cases") or IMAGE_USE_CASES)
+                    groups.setdefault(use_cases, []).append(index)
+
+                # Preprocess the other images for the Vision API
+                sent = {}
+                for index in uncached:
+                    sent[index] = preprocess_image(medias[index], get_image_preprocessing(medias[index].name.split("/")[0]))
+
+                # Call the Vision API in batches for each group
+                for use_cases, indices in groups.items():
+                    features = [IMAGE_USE_CASES[use_case] for use_case in use_cases]
+                    responses = get_image_responses([sent[index][0] for index in indices], features)
+                    for index, response in zip(indices, responses):
+                        if response.error.message:
+                            errors[index] = response.error.message
+                        else:
+                            results[index] = ImageResult(restore_image_response(response, sent[index][1]))
+                            put_cached_response(pending_images[index][1].get("cache_key"), results[index].json)
+
+                # Fan the responses out to the image processing steps
+                failures = 0
+                for (blob, pending_image), media, result, error in zip(pending_images, medias, results, errors):
+                    print(f"Processing: {media.name}.")
+
+                    if error:
+                        print(f"Vision API error for {media.name}: {error}")
+                    else:
+                        try:
+                            metadata = get_media_metadata(media.name, pending_image["contentType"], media.size, pending_image["timestamp"])
+                            process_image_response(media, result, metadata)
+                        except Exception as exception:
+                            error = repr(exception)
+                            print(f"Could not process {media.name}: {error}")
+
+                    # Keep the failed image for the next runs
+                    if error:
+                        failures += 1
+                        retry_pending_image(blob, pending_image, error)
+                        continue
+
+                    # Remove the pending image, unless it was queued again or removed by another run meanwhile
+                    try:
+                        blob.delete(if_generation_match=blob.generation)
+                    except (NotFound, PreconditionFailed):
+                        pass
+
+            finally:
+                # Write the buffered BigQuery rows that are due, including the ones of the images processed when
+                # another one failed
+                with span("flush_bigquery"):
+                    get_bigquery_sink().flush_due()
+
+            seconds = time.perf_counter() - start
+            print(
+                json.dumps(
+                    {
+                        "message": "Pending images annotated",
+                        "images": len(pending_images),
+                        "failures": failures,
+                        "seconds": round(seconds, 3),
+                        "images_per_second": round(len(pending_images) / seconds, 2),
+                    }
+                )
+            )
+
+    finally:
+        # Log the response and metadata cache counters and the time spent importing modules, including the ones
+        # imported lazily by this invocation
+        log_response_cache_stats()
+        log_camera_traps_metadata_cache_stats()
+        log_import_times()
+
+
+def compact_camera_traps_metadata(event, context):
+    """
+    Triggered periodically by a Cloud Scheduler job publishing to Pub/Sub.
+
+    Materializes the latest activation of each camera trap into metadata.csv.
+
+    Args:
+         event (dict): Event payload.
+         context (google.cloud.functions.Context): Metadata for the event.
+    """
+
+    state = compact_metadata()
+    print(f"Compacted the activations of {len(state)} camera traps.")
+
+
+def handle_job_object(event, context):
+    """
+    Triggered by a change to the jobs Cloud Storage bucket.
+
+    Runs the deferred jobs written to the bucket by get_predictions and processes the video annotation results written
+    by the Video Intelligence API, any other object is ignored.
+
+    Args:
+         event (dict): Event payload.
+         context (google.cloud.functions.Context): Metadata for the event.
+    """
+
+    object_name = event["name"]
+
+    # All the other objects are ignored, without tracing the invocation
+    if not object_name.startswith((RENDER_JOBS_PREFIX, VIDEO_RESULTS_PREFIX)):
+        return
+
+    # Time each stage of the invocation
+    try:
+        with trace("handle_job_object", TELEMETRY_EXPORTER, media_type="video"):
+
+            try:
+                # Render an annotated video
+                if object_name.startswith(RENDER_JOBS_PREFIX):
+                    print(f"Rendering: {object_name}.")
+                    render_annotated_video(object_name)
+
+                # Process the result of a video annotation
+                else:
+                    print(f"Processing: {object_name}.")
+                    complete_video_annotation(object_name)
+
+            finally:
+                # Write the buffered BigQuery rows that are due, including the ones of the stages that succeeded when
+                # another one failed
+                with span("flush_bigquery"):
+                    get_bigquery_sink().flush_due()
+
+    finally:
+        # Log the response and metadata cache counters and the time spent importing modules, including the ones
+        # imported lazily by this invocation
+        log_response_cache_stats()
+        log_camera_traps_metadata_cache_stats()
+        log_import_times()
+
+
+def drain_alerts_outbox(event, context):
+    """
+    Triggered periodically by a Cloud Scheduler job publishing to Pub/Sub.
+
+    Delivers the alerts that could not be sent to Node-RED when they were raised.
+
+    Args:
+         event (dict): Event payload.
+         context (google.cloud.functions.Context): Metadata for the event.
+    """
+
+    stats = get_alert_delivery().drain(ALERTS_OUTBOX_DRAIN_MAX)
+    print(f"Alerts outbox drained: {stats}")
+
+
+def check_video_operations(event, context):
+    """
+    Triggered periodically by a Cloud Scheduler job publishing to Pub/Sub.
+
+    Reports the video annotations submitted more than VIDEO_OPERATION_STUCK_SECONDS ago whose result was not processed.
+    Failed operations are reported and their record is deleted. Results written by the API without triggering
+    handle_job_object are processed.
+
+    Args:
+         event (dict): Event payload.
+         context (google.cloud.functions.Context): Metadata for the event.
+    """
+
+    stats = {"pending": 0, "stuck": 0, "failed": 0, "recovered": 0, "errors": 0}
+
+    for record in list_video_operation_records():
+        stats["pending"] += 1
+
+        age = (datetime.now() - record["submitted_at"]).total_seconds()
+        if age < VIDEO_OPERATION_STUCK_SECONDS:
+            continue
+
+        # A record that cannot be completed is left pending, so that the next sweep retries it
+        try:
+            operation = get_video_operation(record["operation"])
+
+            # The operation failed, the video will not be processed
+            if operation.done and operation.error.code:
+                stats["failed"] += 1
+                print(json.dumps({"message": "Video annotation failed", "media_name": record["name"], "operation": record["operation"], "error": operation.error.message}))
+                finish_video_operation(record["name"])
+
+            # The operation succeeded but its result was not processed
+            elif operation.done:
+                complete_video_annotation(f"{VIDEO_RESULTS_PREFIX}{record['name']}.json")
+                stats["recovered"] += 1
+
+            else:
+                stats["stuck"] += 1
+                print(json.dumps({"message": "Video annotation stuck", "media_name": record["name"], "operation": record["operation"], "age_seconds": round(age)}))
+
+        except Exception as error:
+            stats["errors"] += 1
+            print(json.dumps({"message": "Video annotation not completed", "media_name": record["name"], "operation": record["operation"], "error": repr(error)}))
+
+    print(f"Video operations: {stats}")
+
+    # Write the buffered BigQuery rows that are due
+    get_bigquery_sink().flush_due()
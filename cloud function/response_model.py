@@ -0,0 +1,220 @@
+# Imports
+from array import array
+
+from google.cloud.vision import AnnotateImageResponse
+from google.cloud.videointelligence import AnnotateVideoResponse
+
+
+# Likelihood fields of a face annotation, by tag
+FACE_LIKELIHOODS = {
+    "joy": "joy_likelihood",
+    "sorrow": "sorrow_likelihood",
+    "anger": "anger_likelihood",
+    "surprise": "surprise_likelihood",
+    "headwear": "headwear_likelihood",
+}
+
+
+def get_seconds(duration) -> float:
+    """
+    Converts a protobuf Duration, such as the time offset of a frame, to seconds.
+
+    Args:
+        duration (google.protobuf.duration_pb2.Duration): The duration.
+
+    Returns:
+        float: The duration in seconds.
+    """
+
+    return duration.seconds + duration.nanos / 1e9
+
+
+class ImageObject:
+    """An object localized by the Vision API, with its normalized (x, y) vertices."""
+
+    __slots__ = ("label", "score", "vertices")
+
+    def __init__(self, label: str, score: float, vertices: tuple) -> None:
+        self.label = label
+        self.score = score
+        self.vertices = vertices
+
+
+class Face:
+    """A face detected by the Vision API, with the likelihood of each tag, from 0 (UNKNOWN) to 5 (VERY_LIKELY)."""
+
+    __slots__ = ("confidence", "likelihoods")
+
+    def __init__(self, confidence: float, likelihoods: dict) -> None:
+        self.confidence = confidence
+        self.likelihoods = likelihoods
+
+
+class ImageResult:
+    """
+    The Vision API response of an image, parsed once from the protobuf message.
+
+    The response is serialized to JSON at most once, when it is first stored, and only if it was not read from JSON.
+    """
+
+    __slots__ = ("response", "objects", "faces", "_json")
+
+    def __init__(self, response: AnnotateImageResponse, response_json: str = None) -> None:
+        """
+        Args:
+            response (AnnotateImageResponse): The response of the Vision API.
+            response_json (str, optional): The response serialized with to_json, if it was read from JSON.
+        """
+
+        self.response = response
+        self._json = response_json
+
+        # Read the raw protobuf message, its fields are not wrapped on access
+        message = AnnotateImageResponse.pb(response)
+
+        self.objects = [
+            ImageObject(
+                annotation.name,
+                annotation.score,
+                tuple((vertex.x, vertex.y) for vertex in annotation.bounding_poly.normalized_vertices),
+            )
+            for annotation in message.localized_object_annotations
+        ]
+
+        self.faces = [
+            Face(
+                annotation.detection_confidence,
+                {tag: getattr(annotation, field) for tag, field in FACE_LIKELIHOODS.items()},
+            )
+            for annotation in message.face_annotations
+        ]
+
+    @classmethod
+    def from_json(cls, response_json: str) -> "ImageResult":
+        """
+        Parses a response serialized with to_json, e.g. a cached one.
+
+        Args:
+            response_json (str): The serialized response.
+
+        Returns:
+            ImageResult: The parsed response, that keeps its JSON.
+        """
+
+        return cls(AnnotateImageResponse.from_json(response_json, ignore_unknown_fields=True), response_json)
+
+    @property
+    def json(self) -> str:
+        """The response serialized with to_json, as stored in BigQuery and in the response cache."""
+
+        if self._json is None:
+            self._json = AnnotateImageResponse.to_json(self.response)
+
+        return self._json
+
+
+class VideoTrack:
+    """
+    An object track of the Video Intelligence API.
+
+    The frame times in seconds and the normalized (left, top, right, bottom) boxes of the frames are held in flat
+    arrays, 4 box coordinates per frame.
+    """
+
+    __slots__ = ("label", "confidence", "times", "boxes")
+
+    def __init__(self, label: str, confidence: float, times: array, boxes: array) -> None:
+        self.label = label
+        self.confidence = confidence
+        self.times = times
+        self.boxes = boxes
+
+
+class PersonDetection:
+    """A person detected by the Video Intelligence API, with the first frame of its most confident track."""
+
+    __slots__ = ("confidence", "time", "box")
+
+    def __init__(self, confidence: float, time: float, box: tuple) -> None:
+        self.confidence = confidence
+        self.time = time
+        self.box = box
+
+
+class VideoResult:
+    """
+    The Video Intelligence API response of a video, parsed once from the protobuf message.
+
+    The response is serialized to JSON at most once, when it is first stored, and only if it was not read from JSON.
+    """
+
+    __slots__ = ("response", "tracks", "people", "shots", "_json")
+
+    def __init__(self, response: AnnotateVideoResponse, response_json: str = None) -> None:
+        """
+        Args:
+            response (AnnotateVideoResponse): The response of the Video Intelligence API.
+            response_json (str, optional): The response serialized with to_json, if it was read from JSON.
+        """
+
+        self.response = response
+        self._json = response_json
+
+        # Read the raw protobuf message, its fields are not wrapped on access
+        result = AnnotateVideoResponse.pb(response).annotation_results[0]
+
+        self.tracks = []
+        for annotation in result.object_annotations:
+            times = array("d")
+            boxes = array("f")
+            for frame in annotation.frames:
+                box = frame.normalized_bounding_box
+                times.append(get_seconds(frame.time_offset))
+                boxes.extend((box.left, box.top, box.right, box.bottom))
+
+            self.tracks.append(VideoTrack(annotation.entity.description, annotation.confidence, times, boxes))
+
+        # The start time of each shot, one shot per keyframe in the responses built from keyframes
+        self.shots = array("d", (get_seconds(shot.start_time_offset) for shot in result.shot_annotations))
+
+        self.people = []
+        for annotation in result.person_detection_annotations:
+            track = max(annotation.tracks, key=lambda track: track.confidence, default=None)
+
+            if track is None or not track.timestamped_objects:
+                confidence = track.confidence if track is not None else 0.0
+                self.people.append(PersonDetection(confidence, 0.0, (0.0, 0.0, 0.0, 0.0)))
+                continue
+
+            timestamped_object = track.timestamped_objects[0]
+            box = timestamped_object.normalized_bounding_box
+            self.people.append(
+                PersonDetection(
+                    track.confidence,
+                    get_seconds(timestamped_object.time_offset),
+                    (box.left, box.top, box.right, box.bottom),
+                )
+            )
+
+    @classmethod
+    def from_json(cls, response_json: str) -> "VideoResult":
+        """
+        Parses a response serialized with to_json, e.g. a cached one or a render job.
+
+        Args:
+            response_json (str): The serialized response.
+
+        Returns:
+            VideoResult: The parsed response, that keeps its JSON.
+        """
+
+        return cls(AnnotateVideoResponse.from_json(response_json, ignore_unknown_fields=True), response_json)
+
+    @property
+    def json(self) -> str:
+        """The response serialized with to_json, as stored in BigQuery, in the response cache and in render jobs."""
+
+        if self._json is None:
+            self._json = AnnotateVideoResponse.to_json(self.response)
+
+        return self._json
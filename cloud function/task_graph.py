@@ -0,0 +1,124 @@
+# Imports
+import json
+import time
+import contextvars
+
+from concurrent.futures import Executor, FIRST_COMPLETED, wait
+from typing import Callable, Iterable
+
+
+class StageError(Exception):
+    """Raised by TaskGraph.run when stages of the graph failed, with the error of each failed stage."""
+
+    def __init__(self, errors: dict) -> None:
+        """
+        Args:
+            errors (dict): The exception raised by each failed stage, by stage name.
+        """
+
+        super().__init__(f"Stages failed: {', '.join(f'{name} ({error!r})' for name, error in errors.items())}")
+        self.errors = errors
+
+
+class TaskGraph:
+    """
+    Runs the stages of a pipeline concurrently on an executor, each stage as soon as the stages it depends on are done.
+
+    A stage is called with the results of its dependencies, in the order they were given. The stages depending on a
+    failed stage are skipped, the independent ones still run. A stage can also wait for other stages without depending
+    on them: it runs once they are done, whether they succeeded or not, and does not receive their results. The stages run in a copy of the context of the caller,
+    so that they are traced as its children.
+    """
+
+    def __init__(self, executor: Executor) -> None:
+        """
+        Args:
+            executor (Executor): The executor running the stages, e.g. a thread pool shared by the invocations.
+        """
+
+        self.executor = executor
+        self.stages = {}
+
+    def add(self, name: str, function: Callable, after: Iterable[str] = (), wait_for: Iterable[str] = ()) -> None:
+        """
+        Adds a stage to the graph.
+
+        Args:
+            name (str): The name of the stage, unique in the graph.
+            function (Callable): The stage, called with the results of the stages it depends on.
+            after (Iterable[str], optional): The names of the stages it depends on, added before it.
+            wait_for (Iterable[str], optional): The names of the stages it waits for without depending on them, added
+                                                before it.
+        """
+
+        after = tuple(after)
+        wait_for = tuple(wait_for)
+        unknown = [dependency for dependency in after + wait_for if dependency not in self.stages]
+        if name in self.stages or unknown:
+            raise ValueError(f"Stage {name} is already in the graph or depends on unknown stages {unknown}")
+
+        self.stages[name] = (function, after, wait_for)
+
+    def submit(self, name: str, results: dict):
+        """Submits a stage whose dependencies are done to the executor."""
+
+        function, after, _ = self.stages[name]
+        arguments = [results[dependency] for dependency in after]
+
+        return self.executor.submit(contextvars.copy_context().run, function, *arguments)
+
+    def run(self) -> dict:
+        """
+        Runs the stages of the graph, and waits for all of them.
+
+        Returns:
+            dict: The result of each stage, by stage name. Raises StageError if stages failed.
+        """
+
+        start = time.perf_counter()
+
+        results = {}
+        errors = {}
+        skipped = []
+        waiting = dict(self.stages)
+        running = {}
+
+        while waiting or running:
+
+            # Submit the stages whose dependencies are done, and skip the ones depending on a failed stage
+            for name, (_, after, wait_for) in list(waiting.items()):
+                if any(dependency in errors or dependency in skipped for dependency in after):
+                    skipped.append(name)
+                    del waiting[name]
+                elif all(dependency in results for dependency in after) and not any(
+                    dependency in waiting or dependency in running.values() for dependency in wait_for
+                ):
+                    running[self.submit(name, results)] = name
+                    del waiting[name]
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as error:
+                    errors[name] = error
+                    print(json.dumps({"message": "Stage failed", "stage": name, "error": repr(error)}))
+
+        if errors:
+            print(
+                json.dumps(
+                    {
+                        "message": "Task graph failed",
+                        "failed": list(errors),
+                        "skipped": skipped,
+                        "seconds": round(time.perf_counter() - start, 3),
+                    }
+                )
+            )
+            raise StageError(errors) from next(iter(errors.values()))
+
+        return results
@@ -0,0 +1,209 @@
+# Imports
+import json
+import time
+import uuid
+import functools
+import contextlib
+import contextvars
+
+from typing import Callable
+
+
+# Attributes of the current trace, inherited by its spans
+TRACE_CONTEXT = contextvars.ContextVar("trace_context", default=None)
+
+# Number of traces started by the instance, the first one is a cold start
+TRACE_COUNT = {"value": 0}
+
+# OpenTelemetry tracer, set up on first use when the export is enabled
+OPENTELEMETRY = {"enabled": None, "tracer": None, "provider": None}
+
+# Seconds spent by the eager imports of the entry points, see timed_imports
+EAGER_IMPORT_TIMES = {}
+
+
+@contextlib.contextmanager
+def timed_imports(name: str):
+    """
+    Times the imports of a with block, e.g. the eager imports of main, and records it in EAGER_IMPORT_TIMES.
+
+    Args:
+        name (str): The name of the imports in the import time breakdown.
+    """
+
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        EAGER_IMPORT_TIMES[name] = round(time.perf_counter() - start, 4)
+
+
+def setup_opentelemetry(exporter: str):
+    """
+    Returns the OpenTelemetry tracer of the instance, setting it up on first use.
+
+    With "cloud_trace", the spans are exported to Cloud Trace (requires opentelemetry-sdk and
+    opentelemetry-exporter-gcp-trace). With "otel", the globally configured tracer provider is used. The spans are only
+    logged if the packages are missing.
+
+    Args:
+        exporter (str): "log", "otel" or "cloud_trace".
+
+    Returns:
+        opentelemetry.trace.Tracer: The tracer, or None if the spans are only logged.
+    """
+
+    if OPENTELEMETRY["enabled"] is not None:
+        return OPENTELEMETRY["tracer"]
+
+    OPENTELEMETRY["enabled"] = False
+    if exporter not in ("otel", "cloud_trace"):
+        return None
+
+    try:
+        from opentelemetry import trace
+
+        if exporter == "cloud_trace":
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+            from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
+
+            provider = TracerProvider()
+            provider.add_span_processor(BatchSpanProcessor(CloudTraceSpanExporter()))
+            trace.set_tracer_provider(provider)
+            OPENTELEMETRY["provider"] = provider
+
+    except ImportError as error:
+        print(f"OpenTelemetry export disabled: {error}")
+        return None
+
+    OPENTELEMETRY["enabled"] = True
+    OPENTELEMETRY["tracer"] = trace.get_tracer(__name__)
+
+    return OPENTELEMETRY["tracer"]
+
+
+@contextlib.contextmanager
+def trace(name: str, exporter: str = "log", **attributes):
+    """
+    Traces an invocation of the function. The spans opened inside the trace carry its attributes.
+
+    A summary of the trace, with the duration of each stage, is logged when it ends. The OpenTelemetry spans are
+    flushed at the same time, before the instance can be throttled.
+
+    Args:
+        name (str): The name of the invocation, e.g. "get_predictions".
+        exporter (str, optional): "log" only logs the spans, "otel" and "cloud_trace" also export them with
+                                  OpenTelemetry, see setup_opentelemetry.
+        **attributes: The attributes of the trace, e.g. camera_trap_name, media_type and size.
+
+    Yields:
+        dict: The attributes of the trace, that can be completed while it runs.
+    """
+
+    TRACE_COUNT["value"] += 1
+
+    context = {
+        "trace_id": uuid.uuid4().hex,
+        "tracer": setup_opentelemetry(exporter),
+        "attributes": {"invocation": name, "cold_start": TRACE_COUNT["value"] == 1, **attributes},
+        "stages": {},
+    }
+    token = TRACE_CONTEXT.set(context)
+
+    try:
+        with span(name):
+            yield context["attributes"]
+
+    finally:
+        TRACE_CONTEXT.reset(token)
+
+        print(
+            json.dumps(
+                {
+                    "message": "Trace",
+                    "trace_id": context["trace_id"],
+                    **context["attributes"],
+                    "stages_ms": context["stages"],
+                },
+                default=str,
+            )
+        )
+
+        if OPENTELEMETRY["provider"] is not None:
+            OPENTELEMETRY["provider"].force_flush()
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """
+    Times a stage of the current trace, and logs it as a structured log entry.
+
+    Outside of a trace, the stage is not timed.
+
+    Args:
+        name (str): The name of the stage, e.g. "get_image_response".
+        **attributes: Attributes of the span only.
+    """
+
+    context = TRACE_CONTEXT.get()
+    if context is None:
+        yield
+        return
+
+    tracer = context["tracer"]
+    otel_span = tracer.start_as_current_span(name) if tracer is not None else contextlib.nullcontext()
+
+    status = "ok"
+    start = time.perf_counter()
+
+    with otel_span as current:
+        try:
+            yield
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            duration_ms = round(1000 * (time.perf_counter() - start), 3)
+            span_attributes = {**context["attributes"], **attributes, "status": status}
+
+            # Stages called several times in a trace are summed in its summary
+            context["stages"][name] = round(context["stages"].get(name, 0.0) + duration_ms, 3)
+
+            print(
+                json.dumps(
+                    {
+                        "message": "Span",
+                        "trace_id": context["trace_id"],
+                        "span": name,
+                        "duration_ms": duration_ms,
+                        **span_attributes,
+                    },
+                    default=str,
+                )
+            )
+
+            if current is not None:
+                for key, value in span_attributes.items():
+                    if value is not None:
+                        current.set_attribute(key, value if isinstance(value, (bool, int, float, str)) else str(value))
+
+
+def traced(function: Callable) -> Callable:
+    """
+    Decorates a stage of the pipeline, so that each of its calls is timed as a span named after it.
+
+    Args:
+        function (Callable): The stage function.
+
+    Returns:
+        Callable: The traced function.
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with span(function.__name__):
+            return function(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,35 @@
+"""
+Fixtures of the tests: the in-process fakes of the benchmarks, installed on the cloud function.
+"""
+
+# Imports
+import sys
+
+from pathlib import Path
+
+import pytest
+
+# The cloud function modules are imported from the parent folder, as in the Cloud Functions runtime, and the fakes
+# from the benchmarks folder
+FUNCTION_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(FUNCTION_DIR))
+sys.path.insert(0, str(FUNCTION_DIR / "benchmarks"))
+
+# The fixtures shared with the benchmarks
+from fakes import image_response, video_response, cloud_fakes  # noqa: F401
+from fakes import upload_camera_traps_metadata
+
+
+@pytest.fixture
+def cloud(cloud_fakes):
+    """
+    Replaces the Google Cloud clients and the Node-RED endpoint of the cloud function with in-process fakes, with a
+    "test" camera trap.
+
+    Returns:
+        SimpleNamespace: The fake storage, bigquery, vision, video and node_red clients.
+    """
+
+    upload_camera_traps_metadata("test")
+
+    return cloud_fakes
@@ -0,0 +1,58 @@
+"""
+Tests of the camera traps activations and their compaction into the metadata file.
+"""
+
+# Imports
+import csv
+
+from datetime import datetime
+from io import StringIO
+
+import utils
+
+
+def upload_metadata(last_activation: str) -> None:
+    """Replaces the camera traps metadata file with a "test" camera trap activated at the given time."""
+
+    utils.get_output_bucket().blob(utils.CAMERA_TRAPS_METADATA_FILE).upload_from_string(
+        "name,longitude,latitude,url,last_detection,last_activation\n"
+        f"test,23.5,-19.2,https://example.org/test,Zebra,{last_activation}\n"
+    )
+
+
+def get_metadata_row() -> dict:
+    """Returns the row of the "test" camera trap in the metadata file."""
+
+    data = utils.get_output_bucket().blob(utils.CAMERA_TRAPS_METADATA_FILE).download_as_text()
+    (row,) = csv.DictReader(StringIO(data))
+
+    return row
+
+
+def test_activation_time_keeps_microseconds(cloud):
+    """Activation times are written with a fixed format, even when their microseconds are 0."""
+
+    utils.update_metadata("test", "Person", datetime(2024, 1, 1, 10))
+    utils.compact_metadata()
+
+    assert get_metadata_row()["last_activation"] == "2024-01-01 10:00:00.000000"
+
+
+def test_newer_activation_replaces_other_format(cloud):
+    """Activation times are compared as datetimes, whatever the format of the metadata file."""
+
+    upload_metadata("2024-01-01T09:00:00")
+    utils.update_metadata("test", "Person", datetime(2024, 1, 1, 10))
+    utils.compact_metadata()
+
+    assert get_metadata_row()["last_detection"] == "Person"
+
+
+def test_older_activation_is_ignored(cloud):
+    """An activation older than the one of the metadata file does not replace it."""
+
+    upload_metadata("2024-01-01 10:00:00")
+    utils.update_metadata("test", "Person", datetime(2024, 1, 1, 9, 59, 59, 999999))
+    utils.compact_metadata()
+
+    assert get_metadata_row()["last_detection"] == "Zebra"
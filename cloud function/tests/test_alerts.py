@@ -0,0 +1,164 @@
+"""
+Tests of the alert delivery, against a local HTTP stand-in of Node-RED.
+"""
+
+# Imports
+import json
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+
+from alerts import AlertDelivery
+from fakes import FakeBucket
+
+
+OUTBOX_PREFIX = "alerts-outbox/"
+
+
+class NodeRedHandler(BaseHTTPRequestHandler):
+    """Answers the alerts with the next scripted status code, 200 once the script is exhausted."""
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        self.server.alerts.append({key: values[0] for key, values in parse_qs(body).items()})
+
+        status_code = self.server.status_codes.pop(0) if self.server.status_codes else 200
+        self.send_response(status_code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def node_red():
+    """A local HTTP server standing in for Node-RED."""
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), NodeRedHandler)
+    server.alerts = []
+    server.status_codes = []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/alert"
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def outbox():
+    """The in-memory bucket of the outbox."""
+    return FakeBucket("models-output")
+
+
+def get_delivery(url: str, outbox: FakeBucket) -> AlertDelivery:
+    """Returns an alert delivery that does not wait between two attempts."""
+    return AlertDelivery(url, lambda: outbox, OUTBOX_PREFIX, connect_timeout=1, read_timeout=1, sleep=lambda delay: None)
+
+
+def test_transient_failures_are_retried(node_red, outbox):
+    """An alert answered by transient errors is retried, with the same alert_id, until it is delivered."""
+
+    node_red.status_codes = [503, 429]
+    delivery = get_delivery(node_red.url, outbox)
+
+    assert delivery.send({"camera_trap_name": "test", "person_count": 1})
+
+    assert len(node_red.alerts) == 3
+    assert len({alert["alert_id"] for alert in node_red.alerts}) == 1
+    assert node_red.alerts[-1]["person_count"] == "1"
+    assert delivery.stats["retries"] == 2
+    assert delivery.stats["delivered"] == 1
+    assert not outbox.objects
+
+
+def test_rejected_alert_is_dropped(node_red, outbox):
+    """An alert rejected by Node-RED is neither retried nor queued."""
+
+    node_red.status_codes = [400]
+    delivery = get_delivery(node_red.url, outbox)
+
+    assert not delivery.send({"camera_trap_name": "test"})
+
+    assert len(node_red.alerts) == 1
+    assert delivery.stats["dropped"] == 1
+    assert not outbox.objects
+
+
+def test_undelivered_alert_goes_to_outbox_and_is_drained(node_red, outbox):
+    """An alert still failing after the last attempt is queued, and delivered by the next drain."""
+
+    node_red.status_codes = [503, 503, 503]
+    delivery = get_delivery(node_red.url, outbox)
+
+    assert not delivery.send({"camera_trap_name": "test", "alert_id": "abc"})
+
+    assert len(node_red.alerts) == 3
+    assert delivery.stats["queued"] == 1
+    assert delivery.pending
+    (fields,) = [json.loads(data) for data, generation in outbox.objects.values()]
+    assert fields == {"camera_trap_name": "test", "alert_id": "abc"}
+
+    delivery.drain()
+
+    assert node_red.alerts[-1] == {"camera_trap_name": "test", "alert_id": "abc"}
+    assert delivery.stats["drained"] == 1
+    assert not delivery.pending
+    assert not outbox.objects
+
+
+def test_unreachable_node_red_goes_to_outbox(node_red, outbox):
+    """Connection errors are retried, then the alert is queued."""
+
+    url = node_red.url
+    node_red.shutdown()
+    node_red.server_close()
+    delivery = get_delivery(url, outbox)
+
+    assert not delivery.send({"camera_trap_name": "test"})
+
+    assert delivery.stats["retries"] == 2
+    assert delivery.stats["queued"] == 1
+    assert len(outbox.objects) == 1
+
+
+def test_concurrent_alerts_are_counted(node_red, outbox):
+    """The statistics of alerts sent from concurrent threads are all counted."""
+
+    delivery = get_delivery(node_red.url, outbox)
+
+    threads = [threading.Thread(target=delivery.send, args=({"camera_trap_name": "test"},)) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert delivery.stats["delivered"] == 20
+    assert len(node_red.alerts) == 20
+
+
+def test_sent_alert_drains_a_few_queued_alerts(node_red, outbox, monkeypatch):
+    """Once Node-RED answers again, a sent alert only delivers the first queued alerts, the others are kept."""
+
+    import utils
+
+    delivery = get_delivery(node_red.url, outbox)
+    monkeypatch.setattr(utils, "get_alert_delivery", lambda: delivery)
+    monkeypatch.setattr(utils, "ALERTS_ENABLED", True)
+
+    node_red.status_codes = [503] * 3 * 8
+    for _ in range(8):
+        delivery.send({"camera_trap_name": "test"})
+    assert len(outbox.objects) == 8
+
+    assert utils.send_to_node_red({"camera_trap_name": "test"})
+
+    assert delivery.stats["drained"] == utils.ALERTS_OUTBOX_INLINE_DRAIN_MAX
+    assert len(outbox.objects) == 8 - utils.ALERTS_OUTBOX_INLINE_DRAIN_MAX
+    assert delivery.pending
@@ -0,0 +1,143 @@
+"""
+Tests of the BigQuery sink, on the in-memory transport.
+"""
+
+# Imports
+import json
+import threading
+
+from google.api_core import exceptions
+
+from bigquery_sink import BigQuerySink, InMemoryTransport
+from fakes import FakeBucket
+
+
+def make_sink(transport: InMemoryTransport, bucket: FakeBucket = None, **kwargs) -> BigQuerySink:
+    """Returns a sink writing to the transport without waiting between attempts."""
+
+    return BigQuerySink(
+        transport,
+        sleep=lambda seconds: None,
+        bucket_factory=(lambda: bucket) if bucket is not None else None,
+        **kwargs,
+    )
+
+
+def test_flush_writes_every_table():
+    """All the buffered tables are written by a flush."""
+
+    transport = InMemoryTransport()
+    sink = make_sink(transport)
+
+    for index in range(3):
+        sink.add("project.images.camera", {"index": index})
+    sink.add("project.detections.objects", {"index": 0})
+    sink.flush()
+
+    assert len(transport.tables["project.images.camera"]) == 3
+    assert len(transport.tables["project.detections.objects"]) == 1
+    assert sink.stats["rows"] == 4
+    assert sink.buffers == {}
+
+
+def test_transient_errors_are_retried():
+    """A write failing with a transient error is retried."""
+
+    transport = InMemoryTransport([exceptions.ServiceUnavailable("unavailable")])
+    sink = make_sink(transport)
+
+    sink.add("project.images.camera", {"index": 0})
+    sink.flush()
+
+    assert len(transport.tables["project.images.camera"]) == 1
+    assert sink.stats["retries"] == 1
+
+
+def test_transient_row_errors_are_requeued():
+    """Rows still failing with a transient error after the last attempt are kept for the next flush."""
+
+    failure = [{"index": 0, "errors": [{"reason": "backendError", "message": "retry"}]}]
+    transport = InMemoryTransport([failure, failure])
+    sink = make_sink(transport, max_attempts=2)
+
+    sink.add("project.images.camera", {"index": 0})
+    sink.add("project.images.camera", {"index": 1})
+    sink.flush()
+
+    assert transport.tables["project.images.camera"] == [{"index": 1}]
+    assert sink.stats["requeued_rows"] == 1
+
+    sink.flush()
+
+    assert transport.tables["project.images.camera"] == [{"index": 1}, {"index": 0}]
+
+
+def test_rejected_rows_are_not_retried():
+    """Rows rejected by BigQuery are logged, not retried."""
+
+    failure = [{"index": 0, "errors": [{"reason": "invalid", "message": "no such field"}]}]
+    transport = InMemoryTransport([failure])
+    sink = make_sink(transport)
+
+    sink.add("project.images.camera", {"index": 0})
+    sink.flush()
+
+    assert transport.requests == 1
+    assert sink.stats["rejected_rows"] == 1
+    assert sink.buffers == {}
+
+
+def test_permanent_error_does_not_drop_the_other_tables():
+    """A table that does not exist is written to the dead-letter bucket, the tables flushed after it are written."""
+
+    transport = InMemoryTransport([exceptions.NotFound("Table detections.motion_filter not found")])
+    bucket = FakeBucket("models-outputs")
+    sink = make_sink(transport, bucket)
+
+    sink.add("project.detections.motion_filter", {"index": 0})
+    sink.add("project.images.camera", {"index": 0})
+    sink.flush()
+
+    assert transport.tables["project.images.camera"] == [{"index": 0}]
+    assert sink.stats["dead_letter_rows"] == 1
+
+    (name, (content, _)), = bucket.objects.items()
+    assert name.startswith("bigquery-dead-letter/project.detections.motion_filter/")
+    assert json.loads(content)["rows"] == [{"index": 0}]
+
+
+def test_permanent_error_without_dead_letter_bucket_requeues():
+    """Without a dead-letter bucket, a batch failing with a permanent error is kept for the next flush."""
+
+    transport = InMemoryTransport([exceptions.Forbidden("denied")])
+    sink = make_sink(transport)
+
+    sink.add("project.images.camera", {"index": 0})
+    sink.flush()
+
+    assert sink.stats["requeued_rows"] == 1
+
+    sink.flush()
+
+    assert transport.tables["project.images.camera"] == [{"index": 0}]
+
+
+def test_concurrent_writes_count_every_row():
+    """Rows added by concurrent threads are all written and counted."""
+
+    transport = InMemoryTransport()
+    sink = make_sink(transport, max_rows=5)
+
+    def add_rows(table: int):
+        for index in range(100):
+            sink.add(f"project.images.camera{table}", {"index": index})
+
+    threads = [threading.Thread(target=add_rows, args=(table,)) for table in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sink.flush()
+
+    assert sink.stats["rows"] == 800
+    assert sum(len(rows) for rows in transport.tables.values()) == 800
@@ -0,0 +1,46 @@
+"""
+Tests of the camera traps metadata lookups of the cloud function.
+"""
+
+# Imports
+import json
+
+import utils
+
+
+def upload_metadata(rows: str) -> None:
+    """Replaces the camera traps metadata file."""
+
+    utils.get_output_bucket().blob(utils.CAMERA_TRAPS_METADATA_FILE).upload_from_string(
+        "name,longitude,latitude,url,last_detection,last_activation\n" + rows
+    )
+
+
+def test_invalid_coordinates_are_ignored(cloud, capsys):
+    """A camera trap with empty or invalid coordinates is handled as an unknown one."""
+
+    upload_metadata("empty,,,,,\ninvalid,east,-19.2,,,\nvalid,23.5,-19.2,,,\n")
+
+    assert utils.get_camera_trap_metadata("empty") == (None, None)
+    assert utils.get_camera_trap_metadata("invalid") == (None, None)
+    assert utils.get_camera_trap_metadata("valid") == (23.5, -19.2)
+
+    output = capsys.readouterr().out
+    assert "Ignoring the invalid coordinates of camera trap empty" in output
+    assert "Ignoring the invalid coordinates of camera trap invalid" in output
+
+
+def test_cache_stats_are_logged_once(cloud, capsys, monkeypatch):
+    """The lookups do not log, the cache counters are logged once as a structured entry."""
+
+    monkeypatch.setattr(utils, "CAMERA_TRAPS_METADATA_CACHE_STATS", {"hits": 0, "misses": 0, "reloads": 0})
+
+    for _ in range(3):
+        utils.get_camera_trap_metadata("test")
+
+    assert capsys.readouterr().out == ""
+
+    utils.log_camera_traps_metadata_cache_stats()
+
+    (line,) = capsys.readouterr().out.splitlines()
+    assert json.loads(line) == {"message": "Camera traps metadata cache", "hits": 2, "misses": 1, "reloads": 1}
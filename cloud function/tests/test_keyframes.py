@@ -0,0 +1,115 @@
+"""
+Tests of the keyframes analysis of the videos.
+"""
+
+# Imports
+from datetime import datetime
+
+import pytest
+
+import main
+import utils
+
+from fakes import make_video, upload_media
+
+
+def upload_metadata(video_analysis: str, use_cases: str = "") -> None:
+    """Replaces the camera traps metadata file with a "test" camera trap."""
+
+    utils.get_output_bucket().blob(utils.CAMERA_TRAPS_METADATA_FILE).upload_from_string(
+        "name,longitude,latitude,url,last_detection,last_activation,video_analysis,use_cases\n"
+        f"test,23.5,-19.2,https://example.org/test,,,{video_analysis},{use_cases}\n"
+    )
+
+
+@pytest.fixture
+def video_event(cloud, monkeypatch, tmp_path):
+    """Uploads a short video of the "test" camera trap, and returns its upload event payload."""
+
+    monkeypatch.setattr(utils, "CAMERA_TRAPS_METADATA_REVALIDATE_SECONDS", 0)
+
+    path = tmp_path / "video.mp4"
+    make_video(path, 320, 240, 2)
+
+    return upload_media(path, "test/video.mp4", "video/mp4")
+
+
+def get_cached_keys(cloud) -> set:
+    """Returns the keys of the cached responses."""
+
+    prefix = utils.RESPONSE_CACHE_PREFIX
+    return {blob.name[len(prefix) : -len(".json")] for blob in utils.get_output_bucket().list_blobs(prefix=prefix)}
+
+
+def test_keyframes_cache_key_depends_on_mode_and_use_cases(video_event):
+    """The keyframes responses never share a cache key with another mode, profile or the Video Intelligence API."""
+
+    keys = {
+        utils.get_keyframes_cache_key(video_event, "keyframes", ["object_detection", "label_detection"]),
+        utils.get_keyframes_cache_key(video_event, "auto", ["object_detection", "label_detection"]),
+        utils.get_keyframes_cache_key(video_event, "keyframes", ["people_detection"]),
+        utils.get_keyframes_cache_key(video_event, "keyframes", ["object_detection"]),
+        utils.get_response_cache_key("videos", video_event, list(utils.VIDEO_USE_CASES.values())),
+    }
+
+    assert len(keys) == 5
+
+
+def test_keyframes_response_is_not_reused_by_video_intelligence(cloud, video_event):
+    """A keyframes response is reused in keyframes mode only."""
+
+    upload_metadata("keyframes")
+    main.process_media(video_event, datetime.now(), deferred=False)
+    vision_calls = cloud.vision.calls
+    main.process_media(video_event, datetime.now(), deferred=False)
+
+    profile = utils.get_camera_trap_profile("test")
+    keyframes_cache_key = utils.get_keyframes_cache_key(video_event, "keyframes", profile["video_use_cases"])
+    assert get_cached_keys(cloud) == {keyframes_cache_key}
+    assert cloud.vision.calls == vision_calls > 0
+    assert cloud.video.calls == 0
+
+    upload_metadata("video_intelligence")
+    main.process_media(video_event, datetime.now(), deferred=False)
+
+    assert cloud.video.calls == 1
+    assert len(get_cached_keys(cloud)) == 2
+
+
+def test_keyframes_follow_use_cases(cloud, video_event):
+    """With people_detection only, the keyframes only request localized objects and only keep the person tracks."""
+
+    upload_metadata("keyframes", "people_detection")
+    profile = utils.get_camera_trap_profile("test")
+
+    response = main.get_keyframes_response(
+        utils.Media(video_event["name"], video_event["size"]), "keyframes", profile["video_use_cases"]
+    )
+    results = response.annotation_results[0]
+
+    assert utils.get_keyframes_features(profile["video_use_cases"]) == [utils.KEYFRAMES_USE_CASES["people_detection"]]
+    assert {annotation.entity.description for annotation in results.object_annotations} == {"Person"}
+    assert results.person_detection_annotations
+
+
+def test_keyframe_boxes_are_held_until_next_keyframe(cloud, video_event, monkeypatch):
+    """Every frame of the annotated video from the first keyframe on is drawn with the boxes of its keyframe."""
+
+    upload_metadata("keyframes")
+    profile = utils.get_camera_trap_profile("test")
+
+    result = utils.VideoResult(
+        main.get_keyframes_response(
+            utils.Media(video_event["name"], video_event["size"]), "keyframes", profile["video_use_cases"]
+        )
+    )
+
+    drawn = []
+    monkeypatch.setattr(utils, "draw_video_frame_boxes", lambda frame, boxes, width, height: drawn.append(len(boxes)))
+
+    utils.annotate_video(result, video_event["name"])
+
+    first_keyframe = round(result.shots[0] * 30)
+    assert len(result.shots) > 1
+    assert len(drawn) == 60
+    assert all(drawn[first_keyframe:])
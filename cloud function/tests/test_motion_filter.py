@@ -0,0 +1,79 @@
+"""
+Tests of the motion pre-filter of the cloud function.
+"""
+
+# Imports
+from datetime import datetime
+
+import pytest
+
+import utils
+
+from fakes import upload_image
+
+
+BACKGROUND_NAME = f"{utils.BACKGROUNDS_PREFIX}test.png"
+
+
+@pytest.fixture
+def image(cloud, monkeypatch, tmp_path):
+    """Enables the motion pre-filter in audit mode, and returns an uploaded image of the "test" camera trap."""
+
+    monkeypatch.setattr(utils, "MOTION_FILTER_MODE", "audit")
+
+    event = upload_image(tmp_path)
+
+    return utils.Media(event["name"], event["size"])
+
+
+def get_background_generation() -> int:
+    """Returns the generation of the background of the "test" camera trap, None if it has none."""
+    return utils.get_output_bucket().blob(BACKGROUND_NAME).generation
+
+
+def test_decisions_are_written_to_monitoring_dataset(cloud, image):
+    """The decisions go to the monitoring dataset, not to the detections one."""
+
+    utils.passes_motion_filter("project", image, "image", datetime.now())
+    utils.get_bigquery_sink().flush()
+
+    (row,) = cloud.bigquery.rows[f"project.{utils.MONITORING_DATASET}.{utils.MOTION_FILTER_TABLE}"]
+    assert row["camera_trap_name"] == "test"
+    assert not any(table.split(".")[1] == utils.DETECTIONS_DATASET for table in cloud.bigquery.rows)
+
+
+def test_concurrent_background_update_is_retried(cloud, image, monkeypatch):
+    """An image is blended again in a background updated by another invocation since it was read."""
+
+    utils.score_image_motion(image, "test")
+    competing_background = utils.get_output_bucket().blob(BACKGROUND_NAME).download_as_bytes()
+
+    # Another invocation replaces the background while the image is compared to it, once
+    get_changed_fraction = utils.get_changed_fraction
+    comparisons = []
+
+    def compare(previous, current):
+        comparisons.append(get_background_generation())
+        if len(comparisons) == 1:
+            utils.get_output_bucket().blob(BACKGROUND_NAME).upload_from_string(competing_background)
+        return get_changed_fraction(previous, current)
+
+    monkeypatch.setattr(utils, "get_changed_fraction", compare)
+
+    utils.score_image_motion(image, "test")
+
+    assert len(comparisons) == 2
+    assert comparisons[1] > comparisons[0]
+    assert get_background_generation() > comparisons[1]
+
+
+def test_backgrounds_are_read_only_when_disabled(cloud, image, monkeypatch):
+    """Without background updates, e.g. in the backfill, the images are scored but never blended in."""
+
+    utils.score_image_motion(image, "test")
+    generation = get_background_generation()
+
+    monkeypatch.setattr(utils, "MOTION_FILTER_UPDATE_BACKGROUNDS", False)
+
+    assert utils.score_image_motion(image, "test") < 1.0
+    assert get_background_generation() == generation
@@ -0,0 +1,93 @@
+"""
+Tests of the batch annotation of the pending images of the cloud function.
+"""
+
+# Imports
+import json
+
+from datetime import datetime
+
+import pytest
+
+import main
+import utils
+
+from fakes import upload_image
+
+from google.cloud.vision import AnnotateImageResponse, BatchAnnotateImagesResponse
+
+
+PENDING_IMAGE = f"{utils.PENDING_IMAGES_PREFIX}test/image.jpg.json"
+FAILED_IMAGE = f"{utils.FAILED_IMAGES_PREFIX}test/image.jpg.json"
+
+
+@pytest.fixture
+def pending_image(cloud, tmp_path):
+    """Uploads an image to the input bucket and queues it for batch annotation."""
+
+    event = upload_image(tmp_path)
+
+    utils.enqueue_pending_image(event["name"], event["contentType"], event["size"], datetime.now())
+
+
+@pytest.fixture
+def vision_error(cloud, monkeypatch):
+    """Makes the fake Vision API answer every image with an error."""
+
+    def batch_annotate_images(requests=None, **kwargs):
+        cloud.vision.calls += len(requests)
+        error = AnnotateImageResponse(error={"code": 14, "message": "Service unavailable"})
+        return BatchAnnotateImagesResponse(responses=[error for _ in requests])
+
+    monkeypatch.setattr(cloud.vision, "batch_annotate_images", batch_annotate_images)
+
+
+def read_object(name: str) -> dict:
+    """Returns the JSON content of an object of the output bucket."""
+    return json.loads(utils.get_output_bucket().blob(name).download_as_text())
+
+
+def test_processed_image_is_removed(cloud, pending_image):
+    """A pending image is removed once annotated and processed."""
+
+    main.annotate_pending_images({}, None)
+
+    assert not utils.get_output_bucket().blob(PENDING_IMAGE).exists()
+    assert not utils.get_output_bucket().blob(FAILED_IMAGE).exists()
+
+
+def test_failed_image_is_kept_for_retry(cloud, pending_image, vision_error):
+    """A pending image whose annotation failed is kept, with its number of attempts."""
+
+    main.annotate_pending_images({}, None)
+
+    kept = read_object(PENDING_IMAGE)
+    assert kept["attempts"] == 1
+    assert kept["error"] == "Service unavailable"
+    assert kept["name"] == "test/image.jpg"
+
+
+def test_failed_image_is_moved_after_max_attempts(cloud, pending_image, vision_error, monkeypatch):
+    """A pending image is moved under the failed images prefix once it failed too many times."""
+
+    monkeypatch.setattr(utils, "PENDING_IMAGES_MAX_ATTEMPTS", 2)
+
+    main.annotate_pending_images({}, None)
+    main.annotate_pending_images({}, None)
+
+    assert not utils.get_output_bucket().blob(PENDING_IMAGE).exists()
+    assert read_object(FAILED_IMAGE)["attempts"] == 2
+    assert cloud.vision.calls == 2
+
+
+def test_image_failing_processing_is_kept(cloud, pending_image, monkeypatch):
+    """A pending image whose processing raised is kept for the next run."""
+
+    def process_image_response(media, result, metadata):
+        raise RuntimeError("BigQuery unavailable")
+
+    monkeypatch.setattr(main, "process_image_response", process_image_response)
+
+    main.annotate_pending_images({}, None)
+
+    assert read_object(PENDING_IMAGE)["attempts"] == 1
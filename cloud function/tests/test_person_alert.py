@@ -0,0 +1,79 @@
+"""
+Tests of the person fast lane of the cloud function.
+"""
+
+# Imports
+import json
+
+from urllib.parse import parse_qs
+
+import pytest
+
+import main
+import utils
+
+from fakes import upload_image
+
+
+@pytest.fixture
+def image_event(cloud, monkeypatch, tmp_path):
+    """Enables the person fast lane, and returns the upload event payload of an image."""
+
+    monkeypatch.setattr(utils, "PERSON_FAST_LANE_MODE", "on")
+    monkeypatch.setattr(main, "IMAGE_INGESTION_MODE", "single")
+
+    return upload_image(tmp_path)
+
+
+def get_alerts(cloud) -> list:
+    """Returns the alerts received by the fake Node-RED endpoint, without their image."""
+
+    alerts = [{key: values[0] for key, values in parse_qs(body).items()} for body in cloud.node_red.alerts]
+    for alert in alerts:
+        alert.pop("image", None)
+
+    return alerts
+
+
+def test_person_alert_is_sent_first_and_linked(cloud, image_event):
+    """The person alert precedes the full alert, and the rows and activation record carry its alert_id."""
+
+    main.get_predictions(image_event, None)
+
+    person_alert, full_alert = get_alerts(cloud)
+    assert person_alert["alert_type"] == "person"
+    assert full_alert["alert_type"] == "enrichment"
+    assert full_alert["alert_id"] == person_alert["alert_id"]
+
+    rows = [row for table_rows in cloud.bigquery.rows.values() for row in table_rows]
+    assert rows and all(row["alert_id"] == person_alert["alert_id"] for row in rows)
+
+    (activation,) = utils.get_output_bucket().list_blobs(prefix=utils.ACTIVATIONS_PREFIX)
+    assert json.loads(activation.download_as_text())["alert_id"] == person_alert["alert_id"]
+
+
+def test_failed_person_alert_does_not_suppress_full_alert(cloud, image_event, monkeypatch):
+    """The full alert is still sent when the person alert fails."""
+
+    def fail(alert):
+        raise RuntimeError("The alerts outbox cannot be written")
+
+    monkeypatch.setattr(main, "send_person_alert", fail)
+
+    with pytest.raises(Exception):
+        main.get_predictions(image_event, None)
+
+    (full_alert,) = get_alerts(cloud)
+    assert full_alert["alert_type"] == "enrichment"
+
+
+def test_no_person_alert_when_disabled(cloud, image_event, monkeypatch):
+    """Without the fast lane, only the full alert is sent, and the rows carry no alert_id."""
+
+    monkeypatch.setattr(utils, "PERSON_FAST_LANE_MODE", "off")
+
+    main.get_predictions(image_event, None)
+
+    (full_alert,) = get_alerts(cloud)
+    assert "alert_type" not in full_alert
+    assert all("alert_id" not in row for rows in cloud.bigquery.rows.values() for row in rows)
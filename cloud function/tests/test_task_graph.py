@@ -0,0 +1,91 @@
+"""
+Tests of the task graph running the post-annotation stages.
+"""
+
+# Imports
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from task_graph import StageError, TaskGraph
+
+
+@pytest.fixture(scope="module")
+def executor():
+    with ThreadPoolExecutor(4) as executor:
+        yield executor
+
+
+def test_stages_receive_the_results_of_their_dependencies(executor):
+    """A stage is called with the results of the stages it depends on, in order."""
+
+    graph = TaskGraph(executor)
+    graph.add("a", lambda: 1)
+    graph.add("b", lambda: 2)
+    graph.add("c", lambda a, b: a + 10 * b, after=["a", "b"])
+
+    assert graph.run()["c"] == 21
+
+
+def test_dependents_of_a_failed_stage_are_skipped(executor):
+    """The stages depending on a failed stage are skipped, the independent ones still run."""
+
+    calls = []
+
+    def fail():
+        raise ValueError("failed")
+
+    graph = TaskGraph(executor)
+    graph.add("fail", fail)
+    graph.add("dependent", lambda result: calls.append("dependent"), after=["fail"])
+    graph.add("independent", lambda: calls.append("independent"))
+
+    with pytest.raises(StageError) as error:
+        graph.run()
+
+    assert list(error.value.errors) == ["fail"]
+    assert calls == ["independent"]
+
+
+def test_stages_wait_for_failed_stages(executor):
+    """A stage waiting for another one runs after it, even if it failed."""
+
+    calls = []
+
+    def fail_slowly():
+        time.sleep(0.05)
+        calls.append("fail")
+        raise ValueError("failed")
+
+    graph = TaskGraph(executor)
+    graph.add("fail", fail_slowly)
+    graph.add("waiting", lambda: calls.append("waiting"), wait_for=["fail"])
+
+    with pytest.raises(StageError):
+        graph.run()
+
+    assert calls == ["fail", "waiting"]
+
+
+def test_failed_stage_still_flushes_and_logs(cloud, monkeypatch, tmp_path):
+    """When a stage fails, the invocation still writes the due BigQuery rows and logs its counters."""
+
+    import main
+    import utils
+
+    from fakes import upload_image
+
+    calls = []
+    monkeypatch.setattr(main, "IMAGE_INGESTION_MODE", "single")
+    monkeypatch.setattr(main, "draw_bounding_boxes", lambda media, boxes: 1 / 0)
+    monkeypatch.setattr(main, "log_import_times", lambda: calls.append("log_import_times"))
+    monkeypatch.setattr(utils.get_bigquery_sink(), "flush_due", lambda: calls.append("flush_due"))
+
+    event = upload_image(tmp_path)
+
+    with pytest.raises(StageError):
+        main.get_predictions(event, None)
+
+    assert calls == ["flush_due", "log_import_times"]
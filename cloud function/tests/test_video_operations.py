@@ -0,0 +1,111 @@
+"""
+Tests of the asynchronous video pipeline of the cloud function.
+"""
+
+# Imports
+import json
+
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+import utils
+
+from fakes import make_video, upload_media
+
+
+# Result file in the shape written by the Video Intelligence API, whose durations the proto JSON parser rejects
+API_RESULT = {
+    "annotation_results": [
+        {
+            "input_uri": "/camera-traps-media/test/video.mp4",
+            "object_annotations": [
+                {
+                    "entity": {"description": "zebra"},
+                    "confidence": 0.9,
+                    "frames": [
+                        {
+                            "normalized_bounding_box": {"left": 0.1, "top": 0.1, "right": 0.5, "bottom": 0.5},
+                            "time_offset": {"seconds": 1, "nanos": 500000000},
+                        }
+                    ],
+                }
+            ],
+        }
+    ]
+}
+
+
+@pytest.fixture
+def video_event(cloud, monkeypatch, tmp_path):
+    """Submits the annotation of an uploaded video in async mode, and returns its upload event payload."""
+
+    monkeypatch.setattr(main, "VIDEO_PIPELINE_MODE", "async")
+
+    path = tmp_path / "video.mp4"
+    make_video(path, 320, 240, 2)
+    event = upload_media(path, "test/video.mp4", "video/mp4")
+
+    main.get_predictions(event, None)
+
+    return event
+
+
+def write_api_result(media_name: str) -> str:
+    """Writes the result file of a video as the Video Intelligence API does, and returns its name."""
+
+    result_name = f"{utils.VIDEO_RESULTS_PREFIX}{media_name}.json"
+    utils.get_jobs_bucket().blob(result_name).upload_from_string(json.dumps(API_RESULT))
+
+    return result_name
+
+
+def test_get_predictions_submits_video(cloud, video_event):
+    """In async mode, get_predictions only submits the annotation and records its operation."""
+
+    assert cloud.video.calls == 1
+    assert cloud.node_red.alerts == []
+    assert utils.get_video_operation_record(video_event["name"]) is not None
+
+
+def test_handle_job_object_completes_video(cloud, video_event):
+    """The result written by the API triggers the processing of the video, read from the finished operation."""
+
+    result_name = write_api_result(video_event["name"])
+    main.handle_job_object({"name": result_name}, None)
+
+    assert len(cloud.node_red.alerts) == 1
+    assert utils.get_video_operation_record(video_event["name"]) is None
+    assert not utils.get_jobs_bucket().blob(result_name).exists()
+    assert any(table.endswith(".videos.test") for table in cloud.bigquery.rows)
+
+
+def test_check_video_operations_recovers_video(cloud, video_event, monkeypatch):
+    """A done operation whose result did not trigger the function is completed by the sweep."""
+
+    monkeypatch.setattr(main, "VIDEO_OPERATION_STUCK_SECONDS", -1)
+
+    main.check_video_operations({}, None)
+
+    assert len(cloud.node_red.alerts) == 1
+    assert utils.get_video_operation_record(video_event["name"]) is None
+
+
+def test_check_video_operations_keeps_failing_records(cloud, video_event, monkeypatch, capsys):
+    """A record that cannot be completed is logged and left pending, and the other records are still completed."""
+
+    # A second video whose operation is unknown to the API
+    record = json.loads(utils.get_output_bucket().blob(f"{utils.VIDEO_OPERATIONS_PREFIX}{video_event['name']}.json").download_as_text())
+    record.update(name="test/missing.mp4", operation="projects/test/locations/local/operations/missing")
+    record["submitted_at"] = (datetime.now() - timedelta(hours=1)).isoformat()
+    utils.get_output_bucket().blob(f"{utils.VIDEO_OPERATIONS_PREFIX}test/missing.mp4.json").upload_from_string(json.dumps(record))
+
+    monkeypatch.setattr(main, "VIDEO_OPERATION_STUCK_SECONDS", -1)
+
+    main.check_video_operations({}, None)
+
+    assert len(cloud.node_red.alerts) == 1
+    assert utils.get_video_operation_record(video_event["name"]) is None
+    assert utils.get_video_operation_record("test/missing.mp4") is not None
+    assert "Video annotation not completed" in capsys.readouterr().out
@@ -0,0 +1,111 @@
+"""
+Tests of the streamed decoding of the videos stored in Cloud Storage.
+"""
+
+# Imports
+import subprocess
+
+import cv2
+import imageio_ffmpeg
+import pytest
+
+import utils
+
+from fakes import FakeBlob, FakeBucket, make_video
+
+
+FRAME_RATE = 30
+SECONDS = 2
+
+
+@pytest.fixture(params=["moov_at_end", "faststart"])
+def video_blob(request, tmp_path):
+    """A video whose index is at the end, as written by most camera traps, or at the start."""
+
+    path = tmp_path / "video.mp4"
+    make_video(path, 320, 240, SECONDS, FRAME_RATE)
+
+    if request.param == "faststart":
+        faststart_path = tmp_path / "faststart.mp4"
+        subprocess.run(
+            [
+                imageio_ffmpeg.get_ffmpeg_exe(),
+                "-loglevel", "error",
+                "-i", str(path),
+                "-c", "copy",
+                "-movflags", "+faststart",
+                str(faststart_path),
+            ],
+            check=True,
+        )
+        path = faststart_path
+
+    data = path.read_bytes()
+    assert (data.find(b"moov") > data.find(b"mdat")) == (request.param == "moov_at_end")
+
+    blob = FakeBucket("camera-traps-media").blob("test/video.mp4")
+    blob.upload_from_filename(str(path))
+
+    return blob
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    """Records the size of every range downloaded from Cloud Storage, and forbids full downloads."""
+
+    sizes = []
+    download_as_bytes = FakeBlob.download_as_bytes
+
+    def record(blob, start=None, end=None, **kwargs):
+        data = download_as_bytes(blob, start=start, end=end, **kwargs)
+        sizes.append(len(data))
+        return data
+
+    def forbid(*args, **kwargs):
+        raise AssertionError("The video must not be downloaded to a file")
+
+    monkeypatch.setattr(FakeBlob, "download_as_bytes", record)
+    monkeypatch.setattr(FakeBlob, "download_to_filename", forbid)
+
+    return sizes
+
+
+def test_video_is_decoded_in_bounded_chunks(video_blob, downloads, monkeypatch):
+    """Every frame is decoded while the video is downloaded in chunks of at most VIDEO_STREAM_CHUNK_SIZE bytes."""
+
+    monkeypatch.setattr(utils, "VIDEO_STREAM_CHUNK_SIZE", 16 * 1024)
+
+    with utils.open_video_capture(video_blob) as cap:
+        frames = 0
+        while cap.read()[0]:
+            frames += 1
+
+    assert frames == FRAME_RATE * SECONDS
+    assert len(downloads) > 1
+    assert max(downloads) <= 16 * 1024
+
+
+def test_video_capture_seeks(video_blob, downloads):
+    """The capture seeks to a frame without decoding the previous ones."""
+
+    with utils.open_video_capture(video_blob) as cap:
+        assert cap.set(cv2.CAP_PROP_POS_FRAMES, 45)
+        ret, _ = cap.read()
+
+        assert ret
+        assert cap.get(cv2.CAP_PROP_POS_FRAMES) == 46
+
+
+def test_download_error_is_raised(video_blob, monkeypatch):
+    """A Cloud Storage error while the video is streamed is raised, not hidden behind a decoding error."""
+
+    def fail(*args, **kwargs):
+        raise ConnectionError("Cloud Storage is unavailable")
+
+    monkeypatch.setattr(FakeBlob, "download_as_bytes", fail)
+
+    with pytest.raises(RuntimeError) as error:
+        with utils.open_video_capture(video_blob):
+            pass
+
+    assert isinstance(error.value.__cause__, ConnectionError)
@@ -0,0 +1,62 @@
+"""
+Tests of the Vision API batch requests of the cloud function.
+"""
+
+# Imports
+import pytest
+
+import utils
+
+
+@pytest.fixture
+def batches(cloud, monkeypatch):
+    """Records the requests of every batch sent to the fake Vision API."""
+
+    batches = []
+    batch_annotate_images = cloud.vision.batch_annotate_images
+
+    def record(requests=None, **kwargs):
+        batches.append(requests)
+        return batch_annotate_images(requests=requests, **kwargs)
+
+    monkeypatch.setattr(cloud.vision, "batch_annotate_images", record)
+    monkeypatch.setattr(utils, "VISION_BATCH_MAX_INLINE_BYTES", 1000)
+
+    return batches
+
+
+def upload_image(name: str, size: int) -> utils.Media:
+    """Uploads an image of the given size to the input bucket."""
+
+    utils.get_input_bucket().blob(name).upload_from_string(b"\0" * size)
+    return utils.Media(name, size)
+
+
+def get_content_bytes(requests: list) -> int:
+    """Returns the bytes sent as content by the requests of a batch."""
+    return sum(len(request["image"]["content"]) for request in requests if "content" in request["image"])
+
+
+def test_in_memory_images_are_split_under_limit(batches):
+    """The images without GCS URI start a new batch when their content would take it over the limit."""
+
+    medias = [utils.Media.from_bytes(f"keyframe-{index}", b"\0" * 400) for index in range(5)]
+
+    responses = utils.get_image_responses(medias, [utils.IMAGE_USE_CASES["object_detection"]])
+
+    assert len(responses) == 5
+    assert [len(requests) for requests in batches] == [2, 2, 1]
+    assert all(get_content_bytes(requests) <= 1000 for requests in batches)
+
+
+def test_in_memory_images_count_against_inline_budget(batches):
+    """The content of the images without GCS URI leaves less room for the inline content of the other images."""
+
+    medias = [upload_image("test/image.jpg", 700), utils.Media.from_bytes("preprocessed", b"\0" * 400)]
+
+    utils.get_image_responses(medias, [utils.IMAGE_USE_CASES["object_detection"]])
+
+    (requests,) = batches
+    assert requests[0]["image"] == {"source": {"image_uri": medias[0].gcs_uri}}
+    assert "content" in requests[1]["image"]
+    assert get_content_bytes(requests) <= 1000
@@ -1,480 +1,3024 @@
 # Imports
 import os
+import sys
+import csv
+import time
 import base64
+import hashlib
 import json
-import cv2
-import requests
+import threading
+import uuid
+import atexit
+import functools
+import importlib
+import tempfile
+import contextlib
+import subprocess
 
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-import moviepy.editor as moviepy
+from pathlib import Path
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from google.cloud import storage
 from google.cloud import bigquery
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+from alerts import AlertDelivery
+from telemetry import traced
+from response_model import ImageResult, VideoResult
+from task_graph import TaskGraph
+from bigquery_sink import BigQuerySink, InsertAllTransport, StorageWriteTransport
+
+from config import (
+    OUTPUT_BUCKET_NAME,
+    JOBS_BUCKET_NAME,
+    INPUT_BUCKET_NAME,
+    CAMERA_TRAPS_METADATA_PATH,
+    CAMERA_TRAPS_METADATA_FILE,
+    CAMERA_TRAPS_METADATA_REVALIDATE_SECONDS,
+    ACTIVATIONS_PREFIX,
+    ACTIVATION_TIME_FORMAT,
+    COMPACTION_MAX_ATTEMPTS,
+    VIDEO_CONFIDENCE_THRESHOLD,
+    VIDEO_FRAME_TIME_DELTA,
+    VIDEO_ENCODING_PRESET,
+    VIDEO_ENCODING_CRF,
+    VIDEO_STREAM_CHUNK_SIZE,
+    VIDEO_THUMBNAIL_FRAME,
+    RENDER_JOBS_PREFIX,
+    VIDEO_RESULTS_PREFIX,
+    VIDEO_OPERATIONS_PREFIX,
+    VIDEO_ANALYSIS_MODE,
+    KEYFRAMES_MAX_DURATION_SECONDS,
+    KEYFRAMES_COUNT,
+    KEYFRAMES_SELECTION,
+    KEYFRAMES_SAMPLE_FPS,
+    KEYFRAMES_MAX_EDGE,
+    KEYFRAMES_USE_CASES,
+    VISION_INLINE_MAX_BYTES,
+    IMAGE_PREPROCESSING_MODE,
+    IMAGE_PREPROCESSING_MAX_EDGE,
+    IMAGE_PREPROCESSING_JPEG_QUALITY,
+    PENDING_IMAGES_PREFIX,
+    PENDING_IMAGES_MAX_ATTEMPTS,
+    FAILED_IMAGES_PREFIX,
+    VISION_BATCH_SIZE,
+    VISION_BATCH_MAX_INLINE_BYTES,
+    RESPONSE_CACHE_PREFIX,
+    RESPONSE_CACHE_TTL_SECONDS,
+    MOTION_FILTER_MODE,
+    MOTION_FILTER_DEFAULT_THRESHOLD,
+    MOTION_FILTER_WIDTH,
+    MOTION_FILTER_PIXEL_DELTA,
+    MOTION_FILTER_VIDEO_FPS,
+    BACKGROUNDS_PREFIX,
+    MOTION_FILTER_BACKGROUND_ALPHA,
+    MOTION_FILTER_TABLE,
+    MOTION_FILTER_BACKGROUND_MAX_ATTEMPTS,
+    MOTION_FILTER_UPDATE_BACKGROUNDS,
+    MONITORING_DATASET,
+    PREVIEW_MAX_EDGE,
+    PREVIEW_MAX_BYTES,
+    PREVIEW_QUALITIES,
+    BIGQUERY_SINK_TRANSPORT,
+    BIGQUERY_SINK_MAX_ROWS,
+    BIGQUERY_SINK_MAX_BYTES,
+    BIGQUERY_SINK_MAX_AGE_SECONDS,
+    BIGQUERY_SINK_MAX_ATTEMPTS,
+    BIGQUERY_DEAD_LETTER_PREFIX,
+    DETECTIONS_DATASET,
+    DETECTIONS_TABLE,
+    FACE_LIKELIHOOD_THRESHOLD,
+    NODE_RED_URL,
+    ALERTS_ENABLED,
+    PERSON_FAST_LANE_MODE,
+    PERSON_FAST_LANE_THRESHOLD,
+    NODE_RED_CONNECT_TIMEOUT,
+    NODE_RED_READ_TIMEOUT,
+    NODE_RED_MAX_ATTEMPTS,
+    ALERTS_OUTBOX_PREFIX,
+    ALERTS_OUTBOX_INLINE_DRAIN_MAX,
+    POST_ANNOTATION_WORKERS,
+    IMAGE_USE_CASES,
+    VIDEO_USE_CASES,
+    POST_PROCESSING_STEPS,
+)
 
-from config import OUTPUT_BUCKET_NAME, INPUT_BUCKET_NAME, CAMERA_TRAPS_METADATA_PATH
+from google.cloud import vision, videointelligence
+
+from google.cloud.videointelligence import AnnotateVideoResponse
+
+from io import BytesIO, StringIO
+
+from typing import Tuple, List
+
+
+# Seconds spent importing each module, the heavy dependencies (pandas, Pillow, OpenCV, imageio-ffmpeg) are only
+# imported by the code paths that need them
+IMPORT_TIMES = {}
+REPORTED_IMPORT_TIMES = set()
+
+
+def lazy_import(module_name: str):
+    """
+    Imports a module on first use and records how long the import took.
+
+    Args:
+      module_name (str): The dotted name of the module, e.g. "cv2" or "PIL.Image".
+
+    Returns:
+      module: The imported module.
+    """
+
+    module = sys.modules.get(module_name)
+
+    if module is None:
+        start = time.perf_counter()
+        module = importlib.import_module(module_name)
+        IMPORT_TIMES[module_name] = round(time.perf_counter() - start, 4)
+
+    return module
+
+
+def log_import_times() -> None:
+    """
+    Logs the import time breakdown as a structured log entry, whenever new modules were imported.
+
+    Returns:
+      None
+    """
+
+    if set(IMPORT_TIMES) <= REPORTED_IMPORT_TIMES:
+        return
+
+    print(
+        json.dumps(
+            {
+                "message": "Import times",
+                "cold_start": not REPORTED_IMPORT_TIMES,
+                "import_times": IMPORT_TIMES,
+                "total_seconds": round(sum(IMPORT_TIMES.values()), 4),
+            }
+        )
+    )
+
+    REPORTED_IMPORT_TIMES.update(IMPORT_TIMES)
+
+
+# Bounds the concurrent calls to the Vision and Video Intelligence APIs. The function handles one event at a time, the
+# backfill tool replaces it with a semaphore shared by its worker processes.
+API_SEMAPHORE = contextlib.nullcontext()
+
+
+# API clients and buckets are created on first use and reused across warm invocations.
+@functools.lru_cache(maxsize=None)
+def get_storage_client() -> storage.Client:
+    """Returns the Cloud Storage client of the instance."""
+    return storage.Client()
+
+
+@functools.lru_cache(maxsize=None)
+def get_bigquery_client() -> bigquery.Client:
+    """Returns the BigQuery client of the instance."""
+    return bigquery.Client()
+
+
+@functools.lru_cache(maxsize=None)
+def get_bigquery_sink() -> BigQuerySink:
+    """Returns the BigQuery sink of the instance, its buffered rows are flushed when the instance shuts down."""
+
+    if BIGQUERY_SINK_TRANSPORT == "storage_write":
+        transport = StorageWriteTransport(get_bigquery_client)
+    else:
+        transport = InsertAllTransport(get_bigquery_client)
+
+    sink = BigQuerySink(
+        transport,
+        max_rows=BIGQUERY_SINK_MAX_ROWS,
+        max_bytes=BIGQUERY_SINK_MAX_BYTES,
+        max_age=BIGQUERY_SINK_MAX_AGE_SECONDS,
+        max_attempts=BIGQUERY_SINK_MAX_ATTEMPTS,
+        bucket_factory=get_output_bucket,
+        dead_letter_prefix=BIGQUERY_DEAD_LETTER_PREFIX,
+    )
+    atexit.register(sink.flush)
+
+    return sink
+
+
+@functools.lru_cache(maxsize=None)
+def get_vision_client() -> vision.ImageAnnotatorClient:
+    """Returns the Vision API client of the instance."""
+    return vision.ImageAnnotatorClient()
+
+
+@functools.lru_cache(maxsize=None)
+def get_video_client() -> videointelligence.VideoIntelligenceServiceClient:
+    """Returns the Video Intelligence API client of the instance."""
+    return videointelligence.VideoIntelligenceServiceClient()
+
+
+@functools.lru_cache(maxsize=None)
+def get_alert_delivery() -> AlertDelivery:
+    """Returns the Node-RED alert delivery of the instance, with its pooled HTTP session."""
+    return AlertDelivery(
+        NODE_RED_URL,
+        get_output_bucket,
+        ALERTS_OUTBOX_PREFIX,
+        connect_timeout=NODE_RED_CONNECT_TIMEOUT,
+        read_timeout=NODE_RED_READ_TIMEOUT,
+        max_attempts=NODE_RED_MAX_ATTEMPTS,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_stage_executor() -> ThreadPoolExecutor:
+    """Returns the thread pool of the instance running the stages that follow an API response, see get_task_graph."""
+    return ThreadPoolExecutor(max_workers=POST_ANNOTATION_WORKERS, thread_name_prefix="stage")
+
+
+def get_task_graph() -> TaskGraph:
+    """Returns an empty task graph running its stages on the thread pool of the instance."""
+    return TaskGraph(get_stage_executor())
+
+
+@functools.lru_cache(maxsize=None)
+def get_input_bucket() -> storage.Bucket:
+    """Returns the bucket of the camera traps media, without any API call."""
+    return get_storage_client().bucket(INPUT_BUCKET_NAME)
+
+
+@functools.lru_cache(maxsize=None)
+def get_output_bucket() -> storage.Bucket:
+    """Returns the bucket of the models outputs, without any API call."""
+    return get_storage_client().bucket(OUTPUT_BUCKET_NAME)
+
+
+@functools.lru_cache(maxsize=None)
+def get_jobs_bucket() -> storage.Bucket:
+    """Returns the bucket of the render jobs and video annotation results, without any API call."""
+    return get_storage_client().bucket(JOBS_BUCKET_NAME)
+
+
+class Media:
+    """
+    A media file uploaded to the input bucket, downloaded at most once per event.
+
+    The same bytes are shared by the API call, the drawing of the bounding boxes and the upload of the annotated media.
+    """
+
+    def __init__(self, name: str, size: int) -> None:
+        """
+        Args:
+            name (str): The name of the media file in the input bucket.
+            size (int): The size of the media file in bytes, as given by the event payload.
+        """
+
+        self.name = name
+        self.size = int(size)
+        self.gcs_uri = f"gs://{INPUT_BUCKET_NAME}/{name}"
+        self._content = None
+        self._lock = threading.Lock()
+
+    @property
+    def content(self) -> bytes:
+        """The bytes of the media file, downloaded on first access."""
+
+        with self._lock:
+            if self._content is None:
+                self._content = get_input_bucket().blob(self.name).download_as_bytes()
+
+        return self._content
+
+    @classmethod
+    def from_bytes(cls, name: str, content: bytes) -> "Media":
+        """
+        Creates a media from bytes already in memory, e.g. a keyframe of a video, that is only sent inline.
+
+        Args:
+            name (str): The name of the media, used in the logs.
+            content (bytes): The bytes of the media.
+
+        Returns:
+            Media: The media.
+        """
+
+        media = cls(name, len(content))
+        media.gcs_uri = None
+        media._content = content
+
+        return media
+
+    @property
+    def inline(self) -> bool:
+        """Whether the media file is small enough to be sent to the Vision API as inline content, or only in memory."""
+
+        return self.gcs_uri is None or self.size <= VISION_INLINE_MAX_BYTES
+
+
+# In-process cache of the camera traps metadata, keyed by camera trap name.
+# It is built once per warm instance and reloaded only when the generation of the metadata file changes.
+CAMERA_TRAPS_METADATA_CACHE = {"generation": None, "checked_at": 0.0, "cameras": {}}
+CAMERA_TRAPS_METADATA_CACHE_STATS = {"hits": 0, "misses": 0, "reloads": 0}
+CAMERA_TRAPS_METADATA_CACHE_LOCK = threading.Lock()
+
+
+def load_camera_traps_metadata() -> Tuple[dict, bool]:
+    """
+    Returns the cached metadata of all the camera traps, reloading it from Cloud Storage if it changed.
+
+    The generation of the metadata file is checked at most every CAMERA_TRAPS_METADATA_REVALIDATE_SECONDS
+    seconds with a metadata-only request, and the csv is only downloaded and parsed when the generation differs
+    from the cached one.
+
+    Returns:
+      Tuple[dict, bool]: A dictionary mapping each camera trap name to its metadata row, and whether the
+                         metadata had to be reloaded.
+    """
+
+    cache = CAMERA_TRAPS_METADATA_CACHE
+
+    with CAMERA_TRAPS_METADATA_CACHE_LOCK:
+
+        # Serve the cached metadata if its generation was checked recently
+        now = time.monotonic()
+        if (
+            cache["generation"] is not None
+            and now - cache["checked_at"] < CAMERA_TRAPS_METADATA_REVALIDATE_SECONDS
+        ):
+            return cache["cameras"], False
+
+        # Get the current generation of the metadata file without downloading it
+        blob = get_output_bucket().get_blob(CAMERA_TRAPS_METADATA_FILE)
+        if blob is None:
+            raise FileNotFoundError(f"{CAMERA_TRAPS_METADATA_PATH} does not exist")
+
+        cache["checked_at"] = now
+
+        if blob.generation == cache["generation"]:
+            return cache["cameras"], False
+
+        # Download and parse the exact generation we just checked, the csv module is enough for a lookup table
+        rows = csv.DictReader(
+            StringIO(blob.download_as_text(if_generation_match=blob.generation))
+        )
+
+        cache["cameras"] = {row["name"]: row for row in rows}
+        cache["generation"] = blob.generation
+        CAMERA_TRAPS_METADATA_CACHE_STATS["reloads"] += 1
+
+        return cache["cameras"], True
+
+
+@traced
+def get_camera_trap_metadata(camera_trap_name: str) -> Tuple[float, float]:
+    """
+    This function retrieves the metadata for a given camera trap.
+
+    Args:
+      camera_trap_name (str): The name of the camera trap for which to retrieve metadata.
+
+    Returns:
+      Tuple[float, float]: A tuple of longitude, and latitude. Both are None if the camera trap is unknown.
+    """
+
+    # Get the metadata information for all camera traps
+    cameras, reloaded = load_camera_traps_metadata()
+    camera_trap = cameras.get(camera_trap_name)
+
+    # Count the lookup as a hit only if it was served from the cache
+    if camera_trap is None or reloaded:
+        CAMERA_TRAPS_METADATA_CACHE_STATS["misses"] += 1
+    else:
+        CAMERA_TRAPS_METADATA_CACHE_STATS["hits"] += 1
+
+    if camera_trap is None:
+        return None, None
+
+    # Return the metadata as a tuple, a camera trap without valid coordinates is handled as an unknown one
+    try:
+        return float(camera_trap["longitude"]), float(camera_trap["latitude"])
+    except (TypeError, ValueError):
+        print(
+            f"Ignoring the invalid coordinates of camera trap {camera_trap_name}: "
+            f"{camera_trap.get('longitude')!r}, {camera_trap.get('latitude')!r}"
+        )
+        return None, None
+
+
+def log_camera_traps_metadata_cache_stats() -> None:
+    """
+    Logs the camera traps metadata cache counters of the instance as a structured log entry.
+
+    Returns:
+      None
+    """
+
+    if not any(CAMERA_TRAPS_METADATA_CACHE_STATS.values()):
+        return
+
+    print(json.dumps({"message": "Camera traps metadata cache", **CAMERA_TRAPS_METADATA_CACHE_STATS}))
+
+
+def parse_profile_column(camera_trap_name: str, column: str, value: str, choices: List[str]) -> tuple:
+    """
+    Parses a ";" separated list of a profile column of the camera traps metadata.
+
+    Args:
+      camera_trap_name (str): The name of the camera trap, to report the unknown names.
+      column (str): The name of the column.
+      value (str): The value of the column.
+      choices (List[str]): The names allowed in the column, in order.
+
+    Returns:
+      tuple: The selected names in the order of the choices, all of them if the value is empty or only has unknown names.
+    """
+
+    names = {name.strip() for name in value.split(";") if name.strip()}
+
+    unknown = names.difference(choices)
+    if unknown:
+        print(f"Ignoring the unknown {column} of camera trap {camera_trap_name}: {sorted(unknown)}")
+
+    return tuple(name for name in choices if name in names) or tuple(choices)
+
+
+@functools.lru_cache(maxsize=256)
+def build_camera_trap_profile(camera_trap_name: str, use_cases: str, steps: str) -> dict:
+    """
+    Builds the analysis profile of a camera trap from its profile columns, once per distinct value.
+
+    Args:
+      camera_trap_name (str): The name of the camera trap.
+      use_cases (str): The use_cases column of the camera trap.
+      steps (str): The steps column of the camera trap.
+
+    Returns:
+      dict: The profile, see get_camera_trap_profile. It is shared by the callers and must not be modified.
+    """
+
+    image_use_cases = parse_profile_column(camera_trap_name, "use_cases", use_cases, list(IMAGE_USE_CASES))
+    video_use_cases = parse_profile_column(camera_trap_name, "use_cases", use_cases, list(VIDEO_USE_CASES))
+
+    return {
+        "image_use_cases": image_use_cases,
+        "video_use_cases": video_use_cases,
+        "image_features": [IMAGE_USE_CASES[use_case] for use_case in image_use_cases],
+        "video_features": [VIDEO_USE_CASES[use_case] for use_case in video_use_cases],
+        "steps": frozenset(parse_profile_column(camera_trap_name, "steps", steps, POST_PROCESSING_STEPS)),
+    }
+
+
+def get_camera_trap_profile(camera_trap_name: str) -> dict:
+    """
+    Returns the analysis profile of a camera trap, from the use_cases and steps columns of the camera traps metadata.
+
+    Args:
+      camera_trap_name (str): The name of the camera trap.
+
+    Returns:
+      dict: The image_use_cases and video_use_cases requested for the media of the camera trap, the matching
+            image_features and video_features, and the post-processing steps run on them, see POST_PROCESSING_STEPS.
+    """
+
+    cameras, _ = load_camera_traps_metadata()
+    camera_trap = cameras.get(camera_trap_name, {})
+
+    return build_camera_trap_profile(camera_trap_name, camera_trap.get("use_cases") or "", camera_trap.get("steps") or "")
+
+
+@traced
+def update_metadata(camera_trap_name: str, last_detection: str, last_activation: datetime, alert_id: str = None):
+
+    """
+    Record a camera trap activation.
+
+    Instead of rewriting metadata.csv, every activation is appended as a small, create-only object under
+    ACTIVATIONS_PREFIX, so that concurrent invocations never overwrite each other. The latest activation of each
+    camera trap is materialized into metadata.csv by compact_metadata.
+
+    Args:
+        camera_trap_name (str): The name of the activated camera trap.
+        last_detection (str): The best detection of the activation.
+        last_activation (datetime): The timestamp of the activation.
+        alert_id (str, optional): The ID of the person alert of the activation, see get_person_alert.
+
+    Returns:
+        None: appends the activation record
+    """
+
+    # Object names sort chronologically within a camera trap, and are unique across invocations
+    blob_name = (
+        f"{ACTIVATIONS_PREFIX}{camera_trap_name}/"
+        f"{last_activation.strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex}.json"
+    )
+
+    record = {
+        "name": camera_trap_name,
+        "last_detection": last_detection,
+        "last_activation": last_activation.strftime(ACTIVATION_TIME_FORMAT),
+    }
+    if alert_id is not None:
+        record["alert_id"] = alert_id
+
+    get_output_bucket().blob(blob_name).upload_from_string(
+        json.dumps(record), content_type="application/json", if_generation_match=0
+    )
+
+
+def parse_activation_time(value) -> datetime:
+    """
+    Parses an activation time of the metadata file or of an activation record.
+
+    Args:
+        value: The activation time, an ISO 8601 string with or without microseconds.
+
+    Returns:
+        datetime: The activation time, None if the value is empty or invalid.
+    """
+
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def compact_metadata() -> dict:
+    """
+    Materialize the latest activation of each camera trap into metadata.csv.
+
+    Only the newest activation record of each camera trap is downloaded. The metadata file is rewritten with a
+    generation precondition so that concurrent edits (e.g. from the web app) are never overwritten, and the
+    compacted activation records are deleted afterwards.
+
+    Returns:
+        dict: The latest activation record of each compacted camera trap.
+    """
+
+    pd = lazy_import("pandas")
+
+    output_bucket = get_output_bucket()
+
+    # List the pending activation records
+    blobs = list(output_bucket.list_blobs(prefix=ACTIVATIONS_PREFIX))
+
+    # Keep the newest record of each camera trap
+    latest = {}
+    for blob in blobs:
+        camera_trap_name = blob.name[len(ACTIVATIONS_PREFIX) :].split("/")[0]
+        if camera_trap_name not in latest or blob.name > latest[camera_trap_name].name:
+            latest[camera_trap_name] = blob
+
+    if not latest:
+        return {}
+
+    state = {
+        camera_trap_name: json.loads(blob.download_as_text())
+        for camera_trap_name, blob in latest.items()
+    }
+
+    for _ in range(COMPACTION_MAX_ATTEMPTS):
+
+        # Get the dataframe of metadata information for all camera traps, at a known generation
+        metadata_blob = output_bucket.get_blob(CAMERA_TRAPS_METADATA_FILE)
+        df = pd.read_csv(
+            BytesIO(
+                metadata_blob.download_as_bytes(
+                    if_generation_match=metadata_blob.generation
+                )
+            ),
+            dtype={"last_detection": str, "last_activation": str},
+        )
+
+        for camera_trap_name, record in state.items():
+            mask = df["name"] == camera_trap_name
+
+            # Never replace a more recent activation with an older one, compared as datetimes since the strings of
+            # the metadata file may have another format, e.g. without the microseconds
+            last_activation = parse_activation_time(record["last_activation"])
+            current = [parse_activation_time(value) for value in df.loc[mask, "last_activation"]]
+            if any(value is not None and value >= last_activation for value in current):
+                continue
+
+            df.loc[mask, "last_detection"] = record["last_detection"]
+            df.loc[mask, "last_activation"] = record["last_activation"]
+
+        try:
+            output_bucket.blob(CAMERA_TRAPS_METADATA_FILE).upload_from_string(
+                df.to_csv(index=None),
+                content_type="text/csv",
+                if_generation_match=metadata_blob.generation,
+            )
+            break
+        except PreconditionFailed:
+            # The metadata file changed in the meantime, start over from its new generation
+            continue
+    else:
+        raise RuntimeError(
+            f"Could not compact {CAMERA_TRAPS_METADATA_PATH} after {COMPACTION_MAX_ATTEMPTS} attempts"
+        )
+
+    # Delete the compacted records, records appended after the listing are kept for the next compaction
+    output_bucket.delete_blobs(blobs, on_error=lambda blob: None)
+
+    return state
+
+
+@traced
+def send_to_node_red(metadata: dict) -> bool:
+    """
+    Sends metadata to Node-RED API
+
+    The alert is retried with strict timeouts, and written to the alerts outbox if Node-RED cannot be reached.
+    Once Node-RED is reachable again, the first ALERTS_OUTBOX_INLINE_DRAIN_MAX alerts of the outbox are delivered, the
+    others are left to drain_alerts_outbox.
+
+    Args:
+      metadata (dict): metadata to be sent
+
+    Returns:
+      bool: Whether the alert was delivered right away
+    """
+
+    if not ALERTS_ENABLED:
+        print("Alerts are disabled, the alert was not sent.")
+        return False
+
+    delivery = get_alert_delivery()
+    delivered = delivery.send(metadata)
+
+    # Log the latency of the alert since the media was received, the person alerts are logged apart
+    if isinstance(metadata.get("timestamp"), datetime):
+        print(
+            json.dumps(
+                {
+                    "message": "Alert latency",
+                    "alert_type": metadata.get("alert_type", "full"),
+                    "alert_id": metadata.get("alert_id"),
+                    "camera_trap_name": metadata.get("camera_trap_name"),
+                    "latency_ms": round(1000 * (datetime.now() - metadata["timestamp"]).total_seconds(), 3),
+                    "delivered": delivered,
+                }
+            )
+        )
+
+    # Deliver a few of the alerts this instance queued, without holding the alert stage for the whole outbox
+    if delivered and delivery.pending:
+        delivery.drain(ALERTS_OUTBOX_INLINE_DRAIN_MAX)
+
+    return delivered
+
+
+def get_person_confidence(result) -> float:
+    """
+    Returns the confidence of the most confident person of an API response, from the persons localized or tracked and
+    the faces detected.
+
+    Args:
+      result (ImageResult or VideoResult): The parsed response of the Vision or Video Intelligence API.
+
+    Returns:
+      float: The confidence, 0 if the response shows no person.
+    """
+
+    if isinstance(result, ImageResult):
+        confidences = [item.score for item in result.objects if item.label.lower() == "person"]
+        confidences += [face.confidence for face in result.faces]
+    else:
+        confidences = [track.confidence for track in result.tracks if track.label.lower() == "person"]
+        confidences += [person.confidence for person in result.people]
+
+    return max(confidences, default=0.0)
+
+
+def get_person_alert(metadata: dict, result) -> dict:
+    """
+    Builds the minimal alert sent before the enrichment of a media whose API response shows a person, when
+    PERSON_FAST_LANE_MODE is "on".
+
+    The alert_id of the person alert is added to the metadata dictionary, so that the full alert, the BigQuery rows and
+    the activation record of the media are linked to it. Call it before the stages reading the metadata run.
+
+    Args:
+      metadata (dict): The metadata dictionary of the media, see get_media_metadata.
+      result (ImageResult or VideoResult): The parsed response of the Vision or Video Intelligence API.
+
+    Returns:
+      dict: The person alert, a new dictionary, or None if the response shows no person.
+    """
+
+    if PERSON_FAST_LANE_MODE != "on":
+        return None
+
+    confidence = get_person_confidence(result)
+    if not confidence or confidence < PERSON_FAST_LANE_THRESHOLD:
+        return None
+
+    metadata["alert_id"] = uuid.uuid4().hex
+    metadata["alert_type"] = "enrichment"
+
+    # Only send what identifies the camera trap and the media, the enrichment follows with the full alert
+    alert = {
+        key: metadata[key]
+        for key in ["alert_id", "camera_trap_name", "longitude", "latitude", "timestamp", "media_name", "type", "input_url"]
+    }
+    alert["alert_type"] = "person"
+    alert["summary"] = f"Person detected {round(confidence*100, 2)}%"
+
+    return alert
+
+
+@traced
+def send_person_alert(alert: dict) -> bool:
+    """
+    Sends the person alert of a media to Node-RED, see get_person_alert.
+
+    Args:
+      alert (dict): The person alert.
+
+    Returns:
+      bool: Whether the person alert was delivered right away.
+    """
+
+    return send_to_node_red(alert)
+
+
+@traced
+def bigquery_insert(
+    project: str,
+    dataset: str,
+    camera_trap_name: str,
+    timestamp: datetime,
+    uri: str,
+    response: json,
+    alert_id: str = None,
+):
+    """
+    Inserts a new row into a BigQuery table.
+
+    The row is buffered by the BigQuery sink of the instance, which writes it with the other rows of the table when
+    its buffer is full or when get_predictions flushes the rows that are due.
+
+    Args:
+        project (str): The ID of the project containing the BigQuery table.
+        dataset (str): The ID of the dataset containing the BigQuery table.
+        camera_trap_name (str): The ID of the table to insert the row into.
+        timestamp (datetime): The timestamp for the new row.
+        uri (str): The URI for the new row.
+        response (json): The response for the new row.
+        alert_id (str, optional): The ID of the person alert of the media, see get_person_alert. The column is only
+                                  written when it is set.
+
+    Returns:
+        None: The function does not return a value.
+    """
+
+    # Set the ID of the table to insert the row into
+    table_id = f"{project}.{dataset}.{camera_trap_name}"
+
+    # Create a dictionary with the new row's values
+    row_to_insert = {
+        "timestamp": timestamp,
+        "uri": uri,
+        "response": response,
+    }
+    if alert_id is not None:
+        row_to_insert["alert_id"] = alert_id
+
+    # Buffer the new row, it is written with the other rows of the table
+    get_bigquery_sink().add(table_id, row_to_insert)
+
+
+def get_normalized_box(vertices: tuple) -> dict:
+    """
+    Converts normalized polygon vertices to a (left, top, right, bottom) box.
+
+    Args:
+        vertices (tuple): The normalized (x, y) vertices.
+
+    Returns:
+        dict: The left, top, right and bottom coordinates of the box.
+    """
+
+    xs = [x for x, _ in vertices]
+    ys = [y for _, y in vertices]
+
+    return {"left": min(xs), "top": min(ys), "right": max(xs), "bottom": max(ys)}
+
+
+def get_normalized_box_from_box(box: tuple) -> dict:
+    """
+    Names the coordinates of a normalized bounding box.
+
+    Args:
+        box (tuple): The normalized (left, top, right, bottom) bounding box.
+
+    Returns:
+        dict: The left, top, right and bottom coordinates of the box.
+    """
+
+    return dict(zip(["left", "top", "right", "bottom"], box))
+
+
+def get_image_detections(result: ImageResult) -> List[dict]:
+    """
+    Flattens the detections of a Vision API response into one record per object and per face.
+
+    Faces have no box, as the API returns their vertices in pixels, but their likely emotions and headwear as tags.
+
+    Args:
+        result (ImageResult): The parsed response of the Vision API.
+
+    Returns:
+        List[dict]: The detections, with their kind, label, score, box and tags.
+    """
+
+    detections = []
+
+    for image_object in result.objects:
+        detections.append(
+            {
+                "kind": "object",
+                "label": image_object.label,
+                "score": image_object.score,
+                **get_normalized_box(image_object.vertices),
+                "frame_time": None,
+                "tags": [],
+            }
+        )
+
+    for face in result.faces:
+        detections.append(
+            {
+                "kind": "face",
+                "label": "face",
+                "score": face.confidence,
+                "left": None,
+                "top": None,
+                "right": None,
+                "bottom": None,
+                "frame_time": None,
+                "tags": [tag for tag, likelihood in face.likelihoods.items() if likelihood >= FACE_LIKELIHOOD_THRESHOLD],
+            }
+        )
+
+    return detections
+
+
+def get_video_detections(result: VideoResult) -> List[dict]:
+    """
+    Flattens the detections of a Video Intelligence API response into one record per object track and per person.
+
+    The box and frame time of a record are the ones of the first frame of its track.
+
+    Args:
+        result (VideoResult): The parsed response of the Video Intelligence API.
+
+    Returns:
+        List[dict]: The detections, with their kind, label, score, box, frame time and tags.
+    """
+
+    detections = []
+
+    for track in result.tracks:
+        detections.append(
+            {
+                "kind": "object",
+                "label": track.label,
+                "score": track.confidence,
+                **get_normalized_box_from_box(track.boxes[:4] if track.times else (0.0, 0.0, 0.0, 0.0)),
+                "frame_time": track.times[0] if track.times else 0.0,
+                "tags": [],
+            }
+        )
+
+    for person in result.people:
+        detections.append(
+            {
+                "kind": "person",
+                "label": "person",
+                "score": person.confidence,
+                **get_normalized_box_from_box(person.box),
+                "frame_time": person.time,
+                "tags": [],
+            }
+        )
+
+    return detections
+
+
+@traced
+def bigquery_insert_detections(
+    project: str,
+    camera_trap_name: str,
+    timestamp: str,
+    uri: str,
+    media_type: str,
+    detections: List[dict],
+    alert_id: str = None,
+) -> None:
+    """
+    Inserts the flattened detections of a media into the detections table, so that they can be queried
+    without parsing the API responses.
+
+    Args:
+        project (str): The ID of the project containing the BigQuery table.
+        camera_trap_name (str): The name of the camera trap.
+        timestamp (str): The timestamp of the media.
+        uri (str): The URI of the media.
+        media_type (str): "image" or "video".
+        detections (List[dict]): The detections returned by get_image_detections or get_video_detections.
+        alert_id (str, optional): The ID of the person alert of the media, see get_person_alert. The column is only
+                                  written when it is set.
+
+    Returns:
+        None: The function does not return a value.
+    """
+
+    table_id = f"{project}.{DETECTIONS_DATASET}.{DETECTIONS_TABLE}"
+    link = {"alert_id": alert_id} if alert_id is not None else {}
+
+    for detection in detections:
+        get_bigquery_sink().add(
+            table_id,
+            {
+                "camera_trap_name": camera_trap_name,
+                "timestamp": timestamp,
+                "uri": uri,
+                "media_type": media_type,
+                **detection,
+                **link,
+            },
+        )
+
+
+def encode_preview(
+    image, max_edge: int = PREVIEW_MAX_EDGE, max_bytes: int = PREVIEW_MAX_BYTES
+) -> bytes:
+    """
+    This function encodes a downscaled preview of an image for the alerts, so that
+    they stay small on the rangers' constrained links.
+
+    The image is resized to at most max_edge pixels on its longest edge and saved as
+    a progressive JPEG, with decreasing qualities and then smaller sizes until it fits
+    in max_bytes.
+
+    Parameters:
+    image (PIL.Image.Image): The image to preview, it is not modified.
+    max_edge (int, optional): The maximum width and height of the preview in pixels.
+    max_bytes (int, optional): The byte budget of the JPEG preview, before base64 encoding.
+
+    Returns:
+    encoded_preview (bytes): Base64 encoded JPEG preview.
+    """
+
+    preview = image.convert("RGB")
+
+    while True:
+        # Downscale the preview, keeping its aspect ratio
+        preview.thumbnail((max_edge, max_edge))
+
+        for quality in PREVIEW_QUALITIES:
+            buffered = BytesIO()
+            preview.save(
+                buffered, format="JPEG", quality=quality, optimize=True, progressive=True
+            )
+
+            if buffered.tell() <= max_bytes:
+                return base64.b64encode(buffered.getvalue())
+
+        # Even the lowest quality is too large, try again with a smaller preview
+        if max(preview.size) <= 64:
+            return base64.b64encode(buffered.getvalue())
+
+        max_edge = int(max(preview.size) * 0.75)
+
+
+def encode_frame_preview(frame) -> bytes:
+    """
+    This function encodes the preview of an OpenCV video frame for the alerts.
+
+    Parameters:
+    frame (np.ndarray): The BGR frame.
+
+    Returns:
+    encoded_preview (bytes): Base64 encoded JPEG preview.
+    """
+
+    Image = lazy_import("PIL.Image")
+    cv2 = lazy_import("cv2")
+
+    return encode_preview(Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+
+
+@traced
+def draw_bounding_boxes(
+    media: Media, vertices_list: List[tuple], display_text: str = ""
+) -> bytes:
+    """
+    This function draws bounding boxes around specified regions in an image
+    of the Google Cloud Storage bucket, uploads the full resolution annotated
+    image and returns its preview as a base64 encoded string.
+
+    Parameters:
+    media (Media): The image file in the Google Cloud Storage bucket, downloaded only if it was not already.
+    vertices_list (list of tuples): List of the normalized (x, y) vertices of the bounding boxes.
+    display_text (str, optional): Text to display on the image. Default is "".
+
+    Returns:
+    encoded_image (bytes): Base64 encoded preview of the image with the bounding boxes drawn.
+    """
+
+    Image = lazy_import("PIL.Image")
+    ImageDraw = lazy_import("PIL.ImageDraw")
+
+    # Reuse the bytes of the image, they were already downloaded if the image was sent inline to the Vision API
+    encoded_image = BytesIO(media.content)
+
+    # Open the image using Pillow library
+    pillow_img = Image.open(encoded_image).convert("RGB")
+
+    # Create a draw object to draw on the image
+    draw = ImageDraw.Draw(pillow_img)
+
+    # Get the width and height of the image
+    width, height = pillow_img.size
+
+    # Draw the bounding boxes on the image
+    for vertices in vertices_list:
+        # Calculate the start and end points of the rectangle
+        rect_start = (vertices[0][0] * width, vertices[0][1] * height)
+        rect_end = (vertices[2][0] * width, vertices[2][1] * height)
+        draw.rectangle((rect_start, rect_end), outline="green", width=2)
+
+    # Save the image with the bounding boxes
+    buffered = BytesIO()
+    pillow_img.save(buffered, format="JPEG")
+
+    get_output_bucket().blob(f"{media.name}").upload_from_string(
+        buffered.getvalue(), content_type="image/jpeg"
+    )
+
+    # Encode a size-bounded preview of the image as a base64 string
+    encoded_image = encode_preview(pillow_img)
+
+    return encoded_image
+
+
+########################################################################## IMAGES ##########################################################################
+
+
+def get_motion_threshold(camera_trap_name: str) -> float:
+    """
+    Returns the motion threshold of a camera trap, from the motion_threshold column of the camera traps metadata.
+
+    Args:
+      camera_trap_name (str): The name of the camera trap.
+
+    Returns:
+      float: The fraction of changed pixels under which a media of the camera trap is considered empty.
+    """
+
+    cameras, _ = load_camera_traps_metadata()
+    threshold = cameras.get(camera_trap_name, {}).get("motion_threshold")
+
+    return float(threshold) if threshold else MOTION_FILTER_DEFAULT_THRESHOLD
+
+
+def prepare_motion_frame(frame):
+    """
+    Downsamples a frame to a blurred grayscale frame of MOTION_FILTER_WIDTH pixels, centered on its mean intensity so
+    that global lighting changes are not counted as motion.
+
+    Args:
+      frame (np.ndarray): A BGR or grayscale frame.
+
+    Returns:
+      np.ndarray: The prepared float32 frame.
+    """
+
+    np = lazy_import("numpy")
+    cv2 = lazy_import("cv2")
+
+    if frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+    height, width = frame.shape
+    frame = cv2.resize(
+        frame, (MOTION_FILTER_WIDTH, max(1, round(height * MOTION_FILTER_WIDTH / width))), interpolation=cv2.INTER_AREA
+    )
+    frame = cv2.GaussianBlur(frame.astype(np.float32), (5, 5), 0)
+
+    return frame - frame.mean()
+
+
+def get_changed_fraction(previous, current) -> float:
+    """
+    Returns the fraction of pixels that changed between two frames prepared by prepare_motion_frame.
+
+    Isolated changed pixels, e.g. noise or leaves, are removed with a morphological opening.
+
+    Args:
+      previous (np.ndarray): The previous frame.
+      current (np.ndarray): The current frame.
+
+    Returns:
+      float: The fraction of changed pixels.
+    """
+
+    np = lazy_import("numpy")
+    cv2 = lazy_import("cv2")
+
+    if previous.shape != current.shape:
+        previous = cv2.resize(previous, (current.shape[1], current.shape[0]), interpolation=cv2.INTER_AREA)
+
+    mask = (np.abs(current - previous) > MOTION_FILTER_PIXEL_DELTA).astype(np.uint8)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+
+    return float(mask.mean())
+
+
+def score_image_motion(media: Media, camera_trap_name: str) -> float:
+    """
+    Scores the motion of an image against the background of its camera trap, and blends the image in the background.
+
+    The background is only replaced if no other invocation updated it since it was read, otherwise the image is scored
+    and blended again against the new background. It is left untouched with MOTION_FILTER_UPDATE_BACKGROUNDS off.
+
+    Args:
+      media (Media): The image file in the input bucket.
+      camera_trap_name (str): The name of the camera trap.
+
+    Returns:
+      float: The fraction of pixels that differ from the background, 1.0 if the camera trap has no background yet.
+    """
+
+    np = lazy_import("numpy")
+    cv2 = lazy_import("cv2")
+
+    # Decode the image at a quarter of its resolution
+    image = cv2.imdecode(np.frombuffer(media.content, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if image is None:
+        return 1.0
+    frame = prepare_motion_frame(image)
+
+    bucket = get_output_bucket()
+    background_name = f"{BACKGROUNDS_PREFIX}{camera_trap_name}.png"
+    score = 1.0
+
+    for _ in range(MOTION_FILTER_BACKGROUND_MAX_ATTEMPTS):
+
+        # Get the background of the camera trap at a known generation, 0 if it has none yet
+        blob = bucket.get_blob(background_name)
+        generation = blob.generation if blob is not None else 0
+        try:
+            data = blob.download_as_bytes(if_generation_match=generation) if blob is not None else None
+        except (NotFound, PreconditionFailed):
+            # The background changed in the meantime, start over from its new generation
+            continue
+
+        # Compare the image to the background
+        background = None if data is None else cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+        if background is None or background.shape != frame.shape:
+            score = 1.0
+            background = frame
+        else:
+            # The background is stored shifted by 128 to fit in 8 bits
+            background = background.astype(np.float32) - 128
+            score = get_changed_fraction(background, frame)
+            background = (1 - MOTION_FILTER_BACKGROUND_ALPHA) * background + MOTION_FILTER_BACKGROUND_ALPHA * frame
+
+        if not MOTION_FILTER_UPDATE_BACKGROUNDS:
+            return score
+
+        # Store the updated background, unless another invocation updated it since it was read
+        _, png = cv2.imencode(".png", np.clip(background + 128, 0, 255).astype(np.uint8))
+        try:
+            bucket.blob(background_name).upload_from_string(
+                png.tobytes(), content_type="image/png", if_generation_match=generation
+            )
+            return score
+        except PreconditionFailed:
+            continue
+
+    print(
+        f"Could not update the background of camera trap {camera_trap_name} after "
+        f"{MOTION_FILTER_BACKGROUND_MAX_ATTEMPTS} attempts"
+    )
+
+    return score
+
+
+def score_video_motion(media: Media, threshold: float) -> float:
+    """
+    Scores the motion of a video by differencing downsampled grayscale frames, MOTION_FILTER_VIDEO_FPS per second.
+
+    Decoding stops as soon as the score reaches the threshold.
+
+    Args:
+      media (Media): The video file in the input bucket.
+      threshold (float): The motion threshold of the camera trap.
+
+    Returns:
+      float: The largest fraction of pixels that changed between two compared frames.
+    """
+
+    cv2 = lazy_import("cv2")
+
+    score = 0.0
+    with open_video_capture(get_input_bucket().blob(media.name)) as cap:
+
+        step = max(1, round((cap.get(cv2.CAP_PROP_FPS) or 30) / MOTION_FILTER_VIDEO_FPS))
+        previous = None
+        index = 0
+
+        while True:
+            # Only decode the compared frames
+            if index % step:
+                if not cap.grab():
+                    break
+                index += 1
+                continue
+
+            ret, frame = cap.read()
+            if not ret:
+                break
+            index += 1
+
+            frame = prepare_motion_frame(frame)
+            if previous is not None:
+                score = max(score, get_changed_fraction(previous, frame))
+                if score >= threshold:
+                    break
+            previous = frame
+
+    return score
+
+
+@traced
+def passes_motion_filter(project: str, media: Media, media_type: str, timestamp: datetime) -> bool:
+    """
+    Scores the motion of a media locally and decides whether it is worth calling the APIs, per MOTION_FILTER_MODE.
+
+    The decision is logged as a structured log entry and inserted into the motion filter table for later audit.
+
+    Args:
+      project (str): The ID of the project containing the BigQuery table.
+      media (Media): The image/video file in the input bucket.
+      media_type (str): "image" or "video".
+      timestamp (datetime): The time at which the upload was processed.
+
+    Returns:
+      bool: Whether the media should be annotated.
+    """
+
+    if MOTION_FILTER_MODE == "off":
+        return True
+
+    start = time.perf_counter()
+    camera_trap_name = media.name.split("/")[0]
+    threshold = get_motion_threshold(camera_trap_name)
+
+    # Score the media, a media that cannot be scored is annotated
+    try:
+        if media_type == "image":
+            score = score_image_motion(media, camera_trap_name)
+        else:
+            score = score_video_motion(media, threshold)
+    except Exception as error:
+        print(f"Could not score the motion of {media.name}: {error!r}")
+        score = None
+
+    passed = score is None or score >= threshold or MOTION_FILTER_MODE != "skip"
+
+    decision = {
+        "camera_trap_name": camera_trap_name,
+        "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+        "uri": media.gcs_uri,
+        "media_type": media_type,
+        "score": None if score is None else round(score, 6),
+        "threshold": threshold,
+        "motion": score is None or score >= threshold,
+        "skipped": not passed,
+        "mode": MOTION_FILTER_MODE,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+    # Log the decision
+    print(json.dumps({"message": "Motion pre-filter", **decision}))
+    get_bigquery_sink().add(f"{project}.{MONITORING_DATASET}.{MOTION_FILTER_TABLE}", decision)
+
+    return passed
+
+
+# Counters of the response cache lookups of the instance
+RESPONSE_CACHE_STATS = {"hits": 0, "misses": 0, "expired": 0}
+
+
+def get_response_cache_key(kind: str, event: dict, features: List[str], variant: str = None) -> str:
+    """
+    Returns the key of the cached API response of a media file, from the hashes of its upload event.
+
+    The key depends on the content of the media file and on the requested features, not on its name, so that the
+    same media uploaded twice gets the same key.
+
+    Args:
+      kind (str): The kind of response, "images" or "videos".
+      event (dict): The upload event payload, or any dict with its md5Hash, crc32c and size fields.
+      features (List[str]): The requested features.
+      variant (str, optional): Anything else the response depends on, e.g. the preprocessing of the image.
+
+    Returns:
+      str: The cache key, or None if the event has no hash (the response is then not cached).
+    """
+
+    # Composite objects have no MD5 hash, their CRC32C is used instead
+    content_hash = event.get("md5Hash") or event.get("crc32c")
+    if not content_hash:
+        return None
+
+    content_hash = base64.b64decode(content_hash).hex()
+    features_hash = ",".join(sorted(str(feature) for feature in features)) + (f"|{variant}" if variant else "")
+    features_hash = hashlib.sha1(features_hash.encode()).hexdigest()[:8]
+
+    return f"{kind}/{content_hash}-{event.get('size')}-{features_hash}"
+
+
+@traced
+def get_cached_response(cache_key: str, result_type):
+    """
+    Returns the cached API response of a cache key, or None if there is none or it expired.
+
+    Expired responses are deleted when they are looked up. A lifecycle rule on RESPONSE_CACHE_PREFIX can delete the
+    ones that are never looked up again.
+
+    Args:
+      cache_key (str): The cache key, see get_response_cache_key.
+      result_type: The parsed response type, ImageResult or VideoResult.
+
+    Returns:
+      The cached response, that keeps its JSON.
+    """
+
+    if cache_key is None:
+        return None
+
+    blob = get_output_bucket().blob(f"{RESPONSE_CACHE_PREFIX}{cache_key}.json")
+
+    try:
+        entry = json.loads(blob.download_as_text())
+    except NotFound:
+        RESPONSE_CACHE_STATS["misses"] += 1
+        return None
+
+    # Evict the expired response
+    age = (datetime.now() - datetime.fromisoformat(entry["cached_at"])).total_seconds()
+    if age > RESPONSE_CACHE_TTL_SECONDS:
+        RESPONSE_CACHE_STATS["expired"] += 1
+        try:
+            blob.delete()
+        except NotFound:
+            pass
+        return None
+
+    RESPONSE_CACHE_STATS["hits"] += 1
+
+    return result_type.from_json(entry["response"])
+
+
+@traced
+def put_cached_response(cache_key: str, response_json: str) -> None:
+    """
+    Caches an API response.
+
+    Args:
+      cache_key (str): The cache key, see get_response_cache_key.
+      response_json (str): The response serialized with to_json.
+
+    Returns:
+      None
+    """
+
+    if cache_key is None:
+        return
+
+    entry = {"cached_at": datetime.now().isoformat(), "response": response_json}
+
+    get_output_bucket().blob(f"{RESPONSE_CACHE_PREFIX}{cache_key}.json").upload_from_string(
+        json.dumps(entry), content_type="application/json"
+    )
+
+
+def log_response_cache_stats() -> None:
+    """
+    Logs the response cache counters of the instance and its hit rate as a structured log entry.
+
+    Returns:
+      None
+    """
+
+    lookups = sum(RESPONSE_CACHE_STATS.values())
+    if not lookups:
+        return
+
+    print(
+        json.dumps(
+            {
+                "message": "Response cache",
+                **RESPONSE_CACHE_STATS,
+                "hit_rate": round(RESPONSE_CACHE_STATS["hits"] / lookups, 4),
+            }
+        )
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def parse_normalized_boxes(camera_trap_name: str, column: str, value: str) -> tuple:
+    """
+    Parses the ";" separated normalized boxes of a column of the camera traps metadata, e.g. "0,0.9,1,1;0,0,0.2,0.1".
+
+    Args:
+      camera_trap_name (str): The name of the camera trap, to report the invalid boxes.
+      column (str): The name of the column.
+      value (str): The value of the column.
+
+    Returns:
+      tuple: The valid (left, top, right, bottom) boxes, with coordinates between 0 and 1.
+    """
+
+    boxes = []
+    for box in value.split(";"):
+        if not box.strip():
+            continue
+
+        try:
+            left, top, right, bottom = (min(max(float(coordinate), 0.0), 1.0) for coordinate in box.split(","))
+        except ValueError:
+            print(f"Ignoring the invalid {column} box of camera trap {camera_trap_name}: {box}")
+            continue
+
+        if left < right and top < bottom:
+            boxes.append((left, top, right, bottom))
+
+    return tuple(boxes)
+
+
+def get_image_preprocessing(camera_trap_name: str) -> dict:
+    """
+    Returns the preprocessing of the images of a camera trap, from the roi and masks columns of the camera traps
+    metadata.
+
+    Args:
+      camera_trap_name (str): The name of the camera trap.
+
+    Returns:
+      dict: The max_edge of the images, the roi they are cropped to, the masks filled, as normalized (left, top, right,
+            bottom) boxes, and a signature of the preprocessing for the response cache key. None if
+            IMAGE_PREPROCESSING_MODE is "off".
+    """
+
+    if IMAGE_PREPROCESSING_MODE != "on":
+        return None
+
+    cameras, _ = load_camera_traps_metadata()
+    camera_trap = cameras.get(camera_trap_name, {})
+
+    roi = parse_normalized_boxes(camera_trap_name, "roi", camera_trap.get("roi") or "")
+    masks = parse_normalized_boxes(camera_trap_name, "masks", camera_trap.get("masks") or "")
+
+    preprocessing = {
+        "max_edge": IMAGE_PREPROCESSING_MAX_EDGE,
+        "roi": roi[0] if roi else (0.0, 0.0, 1.0, 1.0),
+        "masks": masks,
+    }
+    preprocessing["signature"] = json.dumps(preprocessing, sort_keys=True)
+
+    return preprocessing
+
+
+@traced
+def preprocess_image(media: Media, preprocessing: dict) -> Tuple[Media, dict]:
+    """
+    Prepares an image for the Vision API: fills its masks, crops it to its region of interest and downscales it.
+
+    Large JPEG images are decoded at a reduced scale when the downscaled image allows it.
+
+    Args:
+      media (Media): The image file in the input bucket.
+      preprocessing (dict): The preprocessing of the image, see get_image_preprocessing, None to send the original.
+
+    Returns:
+      Tuple[Media, dict]: The image to send to the Vision API, and the transform mapping its coordinates back to the
+                          original image, see restore_image_response. The original image and None if it is not
+                          preprocessed, e.g. when it cannot be decoded.
+    """
+
+    if preprocessing is None:
+        return media, None
+
+    Image = lazy_import("PIL.Image")
+    ImageDraw = lazy_import("PIL.ImageDraw")
+
+    try:
+        image = Image.open(BytesIO(media.content))
+        width, height = image.size
+    except Exception as error:
+        print(f"Sending the original image {media.name}, it could not be decoded: {error!r}")
+        return media, None
+
+    left, top, right, bottom = preprocessing["roi"]
+    max_edge = preprocessing["max_edge"]
+
+    # Decode JPEG images at the smallest scale still larger than the downscaled region of interest
+    roi_edge = max((right - left) * width, (bottom - top) * height)
+    if roi_edge > max_edge:
+        scale = max_edge / roi_edge
+        image.draft("RGB", (int(width * scale) + 1, int(height * scale) + 1))
+
+    image = image.convert("RGB")
+    decoded_width, decoded_height = image.size
+
+    # Fill the masks, e.g. a timestamp banner or the sky
+    draw = ImageDraw.Draw(image)
+    for mask in preprocessing["masks"]:
+        draw.rectangle(
+            (
+                mask[0] * decoded_width,
+                mask[1] * decoded_height,
+                mask[2] * decoded_width - 1,
+                mask[3] * decoded_height - 1,
+            ),
+            fill=(0, 0, 0),
+        )
+
+    # Crop the region of interest, the transform keeps the exact cropped region
+    crop = (
+        round(left * decoded_width),
+        round(top * decoded_height),
+        round(right * decoded_width),
+        round(bottom * decoded_height),
+    )
+    image = image.crop(crop)
+
+    # Downscale the image, keeping its aspect ratio
+    image.thumbnail((max_edge, max_edge))
+
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG", quality=IMAGE_PREPROCESSING_JPEG_QUALITY)
+
+    transform = {
+        "roi": (
+            crop[0] / decoded_width,
+            crop[1] / decoded_height,
+            crop[2] / decoded_width,
+            crop[3] / decoded_height,
+        ),
+        "size": (width, height),
+        "sent_size": image.size,
+    }
+
+    print(
+        json.dumps(
+            {
+                "message": "Image preprocessed",
+                "media_name": media.name,
+                "size": [width, height],
+                "sent_size": list(image.size),
+                "bytes": media.size,
+                "sent_bytes": buffered.tell(),
+            }
+        )
+    )
+
+    return Media.from_bytes(media.name, buffered.getvalue()), transform
+
+
+def restore_image_response(response, transform: dict):
+    """
+    Maps the coordinates of a Vision API response on a preprocessed image back to the original image, in place.
+
+    The normalized vertices of the objects are mapped to the original image, and so are the vertices in pixels and
+    the landmarks of the faces.
+
+    Args:
+      response (AnnotateImageResponse): The response of the Vision API on the preprocessed image.
+      transform (dict): The transform returned by preprocess_image, None if the image was not preprocessed.
+
+    Returns:
+      AnnotateImageResponse: The response, with the coordinates of the original image.
+    """
+
+    if transform is None:
+        return response
+
+    left, top, right, bottom = transform["roi"]
+    width, height = transform["size"]
+    sent_width, sent_height = transform["sent_size"]
+
+    # Edit the raw protobuf message, the proto-plus response wraps it
+    message = type(response).pb(response)
+
+    for annotation in message.localized_object_annotations:
+        for vertex in annotation.bounding_poly.normalized_vertices:
+            vertex.x = left + vertex.x * (right - left)
+            vertex.y = top + vertex.y * (bottom - top)
+
+    # Pixels of the sent image to pixels of the original image
+    scale_x = (right - left) * width / sent_width
+    scale_y = (bottom - top) * height / sent_height
+
+    for annotation in message.face_annotations:
+        for vertex in list(annotation.bounding_poly.vertices) + list(annotation.fd_bounding_poly.vertices):
+            vertex.x = round(left * width + vertex.x * scale_x)
+            vertex.y = round(top * height + vertex.y * scale_y)
+
+        for landmark in annotation.landmarks:
+            landmark.position.x = left * width + landmark.position.x * scale_x
+            landmark.position.y = top * height + landmark.position.y * scale_y
+
+    return response
+
+
+def get_image_request(media: Media, features: List[str], inline: bool = None) -> dict:
+    """
+    Builds the Vision API request annotating an image.
+
+    Parameters:
+    media (Media): The image file in the Google Cloud Storage bucket.
+    features (List[str]): The features to extract from the image.
+    inline (bool, optional): Whether to send the image as inline content, media.inline by default.
+
+    Returns:
+    dict: The annotate image request.
+    """
+
+    if inline is None:
+        inline = media.inline
+
+    # Set the content or the source for the image
+    if inline or media.gcs_uri is None:
+        image = {"content": media.content}
+    else:
+        source = {"image_uri": media.gcs_uri}
+        image = {"source": source}
+
+    # Specify the feature type to extract
+    return {
+        "image": image,
+        "features": [{"type_": feature} for feature in features],
+    }
+
+
+@traced
+def get_image_response(media: Media, features: List[str]):
+    """
+    This function uses the Google Cloud Vision API to extract image features and annotate an image located in a Google Cloud Storage bucket.
+
+    Images up to VISION_INLINE_MAX_BYTES are downloaded once and sent as inline content, so that their bytes can be reused
+    to draw the bounding boxes. Larger images are read by the API from their GCS URI.
+
+    Parameters:
+    media (Media): The image file in the Google Cloud Storage bucket.
+    features (List[str]): The features to extract from the image. Can be one of: 'FACE_DETECTION', 'LANDMARK_DETECTION', 'LOGO_DETECTION', 'LABEL_DETECTION', 'DOCUMENT_TEXT_DETECTION', 'SAFE_SEARCH_DETECTION', 'IMAGE_PROPERTIES', or 'CROP_HINTS'.
+
+    Returns:
+    response: A response object from the Google Cloud Vision API.
+    """
+
+    # Get the client for the Google Cloud Vision API
+    client = get_vision_client()
+
+    # Use the API to annotate the image
+    with API_SEMAPHORE:
+        response = client.annotate_image(get_image_request(media, features))
+
+    return response
+
+
+@traced
+def get_image_responses(medias: List[Media], features: List[str]) -> list:
+    """
+    Annotates several images with batch requests to the Google Cloud Vision API.
+
+    The images are sent VISION_BATCH_SIZE at a time. The images only held in memory, e.g. preprocessed images or
+    keyframes, are always sent as inline content, and start a new batch request when their content would take it over
+    VISION_BATCH_MAX_INLINE_BYTES. Other small images are sent as inline content as long as the batch request stays
+    under VISION_BATCH_MAX_INLINE_BYTES, the others are read by the API from their GCS URI. The throughput of each
+    batch request is logged as a structured log entry.
+
+    Parameters:
+    medias (List[Media]): The image files in the Google Cloud Storage bucket.
+    features (List[str]): The features to extract from the images.
+
+    Returns:
+    list: The response of each image, in the order of medias. A response whose error.message is set failed.
+    """
+
+    # Get the client for the Google Cloud Vision API
+    client = get_vision_client()
+    features = list(features)
+
+    # Split the images into batches, keeping the content of the images without GCS URI under the request size limit
+    batches = []
+    content_bytes = 0
+    for media in medias:
+        size = media.size if media.gcs_uri is None else 0
+        if not batches or len(batches[-1]) == VISION_BATCH_SIZE or content_bytes + size > VISION_BATCH_MAX_INLINE_BYTES:
+            batches.append([])
+            content_bytes = 0
+        batches[-1].append(media)
+        content_bytes += size
+
+    responses = []
+    for batch in batches:
+        batch_start = time.perf_counter()
+
+        # Build the requests, counting every content payload against the request size limit, starting with the
+        # images that can only be sent as content
+        requests = []
+        inline_bytes = sum(media.size for media in batch if media.gcs_uri is None)
+        for media in batch:
+            if media.gcs_uri is None:
+                inline = True
+            else:
+                inline = media.inline and inline_bytes + media.size <= VISION_BATCH_MAX_INLINE_BYTES
+                inline_bytes += media.size if inline else 0
+            requests.append(get_image_request(media, features, inline))
+
+        # Use the API to annotate the images of the batch
+        with API_SEMAPHORE:
+            response = client.batch_annotate_images(requests=requests)
+        responses.extend(response.responses)
+
+        # Log the throughput of the batch
+        seconds = time.perf_counter() - batch_start
+        print(
+            json.dumps(
+                {
+                    "message": "Vision batch",
+                    "images": len(batch),
+                    "inline_images": sum(1 for request in requests if "content" in request["image"]),
+                    "inline_bytes": inline_bytes,
+                    "bytes": sum(media.size for media in batch),
+                    "seconds": round(seconds, 3),
+                    "images_per_second": round(len(batch) / seconds, 2) if seconds else None,
+                }
+            )
+        )
+
+    return responses
+
+
+def enqueue_pending_image(
+    media_name: str,
+    content_type: str,
+    size: int,
+    timestamp: datetime,
+    cache_key: str = None,
+    use_cases: List[str] = None,
+) -> None:
+    """
+    Queues an uploaded image to be annotated in batch by annotate_pending_images.
+
+    The pending image is an object of the output bucket named after the image, so that a retried event does not queue
+    the image twice.
+
+    Args:
+      media_name (str): The name of the image in the input bucket.
+      content_type (str): The content type of the image, as given by the event payload.
+      size (int): The size of the image in bytes, as given by the event payload.
+      timestamp (datetime): The time at which the upload was processed.
+      cache_key (str, optional): The response cache key of the image, see get_response_cache_key.
+      use_cases (List[str], optional): The use cases requested for the image, all of them by default.
+
+    Returns:
+      None
+    """
+
+    pending_image = {
+        "name": media_name,
+        "contentType": content_type,
+        "size": int(size),
+        "timestamp": timestamp.isoformat(),
+        "cache_key": cache_key,
+        "use_cases": list(use_cases or IMAGE_USE_CASES),
+    }
+
+    get_output_bucket().blob(f"{PENDING_IMAGES_PREFIX}{media_name}.json").upload_from_string(
+        json.dumps(pending_image), content_type="application/json"
+    )
+
+
+def list_pending_images(max_images: int) -> List[Tuple[storage.Blob, dict]]:
+    """
+    Lists the images queued by enqueue_pending_image.
+
+    Args:
+      max_images (int): The maximum number of pending images to return.
+
+    Returns:
+      List[Tuple[storage.Blob, dict]]: The object of each pending image and its content.
+    """
+
+    pending_images = []
+    for blob in get_output_bucket().list_blobs(prefix=PENDING_IMAGES_PREFIX, max_results=max_images):
+        try:
+            pending_image = json.loads(blob.download_as_text())
+        except NotFound:
+            # Already annotated by another run
+            continue
+        pending_image["timestamp"] = datetime.fromisoformat(pending_image["timestamp"])
+        pending_images.append((blob, pending_image))
+
+    return pending_images
+
+
+def retry_pending_image(blob: storage.Blob, pending_image: dict, error: str) -> None:
+    """
+    Keeps a pending image whose annotation or processing failed for the next annotate_pending_images run.
+
+    The number of attempts is counted in the pending image, which is moved under FAILED_IMAGES_PREFIX after
+    PENDING_IMAGES_MAX_ATTEMPTS attempts. Nothing is done when the image was queued again or removed by another run
+    meanwhile.
+
+    Args:
+      blob (storage.Blob): The object of the pending image, as listed by list_pending_images.
+      pending_image (dict): The content of the pending image, as listed by list_pending_images.
+      error (str): The error of the failed attempt.
+
+    Returns:
+      None
+    """
+
+    # Count the failed attempt
+    attempts = pending_image.get("attempts", 0) + 1
+    content = json.dumps(
+        {**pending_image, "timestamp": pending_image["timestamp"].isoformat(), "attempts": attempts, "error": error}
+    )
+
+    try:
+        if attempts < PENDING_IMAGES_MAX_ATTEMPTS:
+            # Keep the image queued for the next run
+            blob.upload_from_string(content, content_type="application/json", if_generation_match=blob.generation)
+        else:
+            # Give up on the image and move it out of the queue
+            failed_name = FAILED_IMAGES_PREFIX + blob.name[len(PENDING_IMAGES_PREFIX) :]
+            get_output_bucket().blob(failed_name).upload_from_string(content, content_type="application/json")
+            blob.delete(if_generation_match=blob.generation)
+    except (NotFound, PreconditionFailed):
+        return
+
+    print(
+        json.dumps(
+            {
+                "message": "Pending image failed",
+                "media": pending_image["name"],
+                "attempts": attempts,
+                "failed": attempts >= PENDING_IMAGES_MAX_ATTEMPTS,
+                "error": error,
+            }
+        )
+    )
+
+
+@traced
+def get_image_outputs(image_result: ImageResult) -> dict:
+    """
+    Get image response from given response and use case.
+
+    This function takes the parsed response of the Vision API. The function performs the relevant annotations, computes relevant statistics and summarizes the results.
+
+    Args:
+    image_result (ImageResult): The response to be processed, parsed once from the API response.
+
+    Returns:
+    dict: A dictionary containing the predictions, prediction count, summary and additional information depending on the use case.
+    """
+
+    result = {}
+
+    labels = sorted(image_result.objects, key=lambda x: x.score, reverse=True)
+
+    # Object localization may not be requested for the camera trap
+    best_detection = labels[0].label if labels else ("person" if image_result.faces else None)
+
+    result["predictions"] = labels
+    result["predictions_count"] = len(labels)
+
+    summary = str(len(labels)) + " objects detected: "
+    bounding_boxes = []
+    for label in labels:
+        summary += f"{label.label} {round(label.score*100, 2)}%     "
+        bounding_boxes.append(label.vertices)
+
+    result["bounding_boxes"] = bounding_boxes
+
+    labels = image_result.faces
+
+    joy_detected = 0
+    sorrow_detected = 0
+    anger_detected = 0
+    surprise_detected = 0
+    headwear_detected = 0
+
+    summary += str(len(labels)) + " people detected: "
+    for label in labels:
+        if label.likelihoods["joy"] >= FACE_LIKELIHOOD_THRESHOLD:
+            joy_detected += 1
+        if label.likelihoods["sorrow"] >= FACE_LIKELIHOOD_THRESHOLD:
+            sorrow_detected += 1
+        if label.likelihoods["anger"] >= FACE_LIKELIHOOD_THRESHOLD:
+            anger_detected += 1
+        if label.likelihoods["surprise"] >= FACE_LIKELIHOOD_THRESHOLD:
+            surprise_detected += 1
+        if label.likelihoods["headwear"] >= FACE_LIKELIHOOD_THRESHOLD:
+            headwear_detected += 1
+
+    summary += f"{joy_detected} joy, {sorrow_detected} sorrow, {anger_detected} anger, {surprise_detected} surprise, {headwear_detected} headwear"
+    result["summary"] = summary
+
+    return best_detection, result
+
+
+########################################################################## VIDEOS ##########################################################################
+
+
+@traced
+def get_video_response(gcs_uri: str, features: List[str]):
+    """
+    This function analyzes a video stored in a Google Cloud Storage (GCS) bucket using Google's Video Intelligence API and returns the API's response.
+
+    Args:
+      gcs_uri (str): The URI of the video file in the GCS bucket.
+      features (List[str]): The types of analysis to be performed on the video, such as "LABEL_DETECTION".
+
+    Returns:
+      response: The response from the Video Intelligence API, containing the results of the video analysis.
+    """
+
+    # Get the client for the Video Intelligence API
+    client = get_video_client()
+
+    with API_SEMAPHORE:
+        # Analyze the video using the specified feature
+        response = client.annotate_video(
+            request={"features": features, "input_uri": gcs_uri}
+        )
+
+        # Return the result of the video analysis, with a timeout of 500 seconds
+        return response.result(timeout=500)
+
+
+@traced
+def submit_video_annotation(
+    media_name: str,
+    features: List[str],
+    content_type: str,
+    size: int,
+    timestamp: datetime,
+    cache_key: str = None,
+) -> str:
+    """
+    Submits the annotation of a video to the Video Intelligence API without waiting for its result.
+
+    The API writes the result to VIDEO_RESULTS_PREFIX in the jobs bucket, which triggers handle_job_object. The
+    operation is recorded under VIDEO_OPERATIONS_PREFIX with the event fields needed to process the result, until the
+    result is processed.
+
+    Args:
+      media_name (str): The name of the video file in the input bucket.
+      features (List[str]): The types of analysis to be performed on the video, such as "LABEL_DETECTION".
+      content_type (str): The content type of the video, as given by the event payload.
+      size (int): The size of the video in bytes, as given by the event payload.
+      timestamp (datetime): The time at which the upload was processed.
+      cache_key (str, optional): The response cache key of the video, see get_response_cache_key.
+
+    Returns:
+      str: The name of the long running operation.
+    """
+
+    # Get the client for the Video Intelligence API
+    client = get_video_client()
+
+    # Submit the analysis of the video, its result is written to the output bucket
+    output_uri = f"gs://{JOBS_BUCKET_NAME}/{VIDEO_RESULTS_PREFIX}{media_name}.json"
+    operation = client.annotate_video(
+        request={
+            "features": list(features),
+            "input_uri": f"gs://{INPUT_BUCKET_NAME}/{media_name}",
+            "output_uri": output_uri,
+        }
+    )
+    operation_name = operation.operation.name
+
+    # Record the operation
+    record = {
+        "operation": operation_name,
+        "name": media_name,
+        "contentType": content_type,
+        "size": int(size),
+        "timestamp": timestamp.isoformat(),
+        "output_uri": output_uri,
+        "submitted_at": datetime.now().isoformat(),
+        "cache_key": cache_key,
+    }
+    get_output_bucket().blob(f"{VIDEO_OPERATIONS_PREFIX}{media_name}.json").upload_from_string(
+        json.dumps(record), content_type="application/json"
+    )
+
+    print(f"Submitted the annotation of {media_name}: {operation_name}.")
+
+    return operation_name
+
+
+def get_video_operation_record(media_name: str) -> dict:
+    """
+    Returns the record of the video annotation submitted by submit_video_annotation, or None if there is none.
+
+    Args:
+      media_name (str): The name of the video file in the input bucket.
+
+    Returns:
+      dict: The operation record, with its timestamp and submitted_at fields parsed.
+    """
+
+    try:
+        record = json.loads(get_output_bucket().blob(f"{VIDEO_OPERATIONS_PREFIX}{media_name}.json").download_as_text())
+    except NotFound:
+        return None
+
+    record["timestamp"] = datetime.fromisoformat(record["timestamp"])
+    record["submitted_at"] = datetime.fromisoformat(record["submitted_at"])
+
+    return record
+
+
+@traced
+def load_video_result(record: dict) -> VideoResult:
+    """
+    Loads the result of a video annotation submitted by submit_video_annotation from its finished operation.
+
+    The result file written by the API to the output bucket only signals that the operation is done: its durations
+    are {"seconds": ..., "nanos": ...} objects, that the proto JSON parser rejects.
+
+    Args:
+      record (dict): The operation record of the video, see get_video_operation_record.
+
+    Returns:
+      VideoResult: The parsed API response. Raises RuntimeError if the operation is not done or failed.
+    """
+
+    operation = get_video_operation(record["operation"])
+
+    if not operation.done or operation.error.code:
+        raise RuntimeError(f"Operation {record['operation']} of {record['name']} is not done or failed: {operation.error.message}")
+
+    # Unpack the response from the operation
+    message = AnnotateVideoResponse.pb()()
+    operation.response.Unpack(message)
+
+    return VideoResult(AnnotateVideoResponse.wrap(message))
+
+
+def finish_video_operation(media_name: str) -> None:
+    """
+    Deletes the record of a video annotation whose result was processed, and the result file written by the API.
+
+    The response is read from the finished operation, the result file is only kept until then.
+
+    Args:
+      media_name (str): The name of the video file in the input bucket.
+
+    Returns:
+      None
+    """
+
+    for blob in [
+        get_output_bucket().blob(f"{VIDEO_OPERATIONS_PREFIX}{media_name}.json"),
+        get_jobs_bucket().blob(f"{VIDEO_RESULTS_PREFIX}{media_name}.json"),
+    ]:
+        try:
+            blob.delete()
+        except NotFound:
+            pass
+
+
+def list_video_operation_records() -> List[dict]:
+    """
+    Lists the records of the video annotations whose result was not processed yet.
+
+    Returns:
+      List[dict]: The operation records, see get_video_operation_record.
+    """
+
+    records = []
+    for blob in get_output_bucket().list_blobs(prefix=VIDEO_OPERATIONS_PREFIX):
+        record = get_video_operation_record(blob.name[len(VIDEO_OPERATIONS_PREFIX) : -len(".json")])
+        if record is not None:
+            records.append(record)
+
+    return records
+
+
+def get_video_operation(operation_name: str):
+    """
+    Gets the current state of a Video Intelligence API long running operation.
+
+    Args:
+      operation_name (str): The name of the operation.
+
+    Returns:
+      google.longrunning.operations_pb2.Operation: The operation, with its done, error and metadata fields.
+    """
+
+    return get_video_client().transport.operations_client.get_operation(operation_name)
+
+
+def get_video_analysis_mode(camera_trap_name: str) -> str:
+    """
+    Returns the video analysis mode of a camera trap, from the video_analysis column of the camera traps metadata.
+
+    Args:
+      camera_trap_name (str): The name of the camera trap.
+
+    Returns:
+      str: "video_intelligence", "keyframes" or "auto", VIDEO_ANALYSIS_MODE by default.
+    """
+
+    cameras, _ = load_camera_traps_metadata()
+
+    return cameras.get(camera_trap_name, {}).get("video_analysis") or VIDEO_ANALYSIS_MODE
+
+
+def extract_keyframes(media: Media, count: int, max_duration: float = None) -> Tuple[List[Tuple[float, bytes]], float]:
+    """
+    Extracts keyframes of a video as JPEG images.
+
+    The video is sampled KEYFRAMES_SAMPLE_FPS frames per second. Depending on KEYFRAMES_SELECTION, the keyframes are
+    evenly spaced samples, or the first sample and the samples that differ the most from the previous one.
+
+    Args:
+      media (Media): The video file in the input bucket.
+      count (int): The number of keyframes.
+      max_duration (float, optional): Nothing is extracted from the videos longer than this many seconds, or whose
+                                      length is unknown.
+
+    Returns:
+      Tuple[List[Tuple[float, bytes]], float]: The time in seconds and JPEG bytes of each keyframe, and the duration of
+                                               the video. The keyframes are None if the video is too long.
+    """
+
+    np = lazy_import("numpy")
+    cv2 = lazy_import("cv2")
+
+    samples = []
+    with open_video_capture(get_input_bucket().blob(media.name)) as cap:
+
+        frame_rate = cap.get(cv2.CAP_PROP_FPS) or 30
+        frame_total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        duration = frame_total / frame_rate if frame_total > 0 else None
+
+        if max_duration is not None and (duration is None or duration > max_duration):
+            return None, duration
+
+        step = max(1, round(frame_rate / KEYFRAMES_SAMPLE_FPS))
+        index = 0
+        previous = None
+
+        while True:
+            # Only decode the sampled frames
+            if index % step:
+                if not cap.grab():
+                    break
+                index += 1
+                continue
+
+            ret, frame = cap.read()
+            if not ret:
+                break
+
+            # Score the scene change since the previous sample
+            prepared = prepare_motion_frame(frame)
+            change = 1.0 if previous is None else get_changed_fraction(previous, prepared)
+            previous = prepared
+
+            # Keep the sample as a JPEG image of at most KEYFRAMES_MAX_EDGE pixels
+            height, width = frame.shape[:2]
+            scale = KEYFRAMES_MAX_EDGE / max(height, width)
+            if scale < 1:
+                frame = cv2.resize(frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+            _, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
+
+            samples.append((index / frame_rate, change, jpeg.tobytes()))
+            index += 1
+
+    if duration is None:
+        duration = index / frame_rate
+
+    # Select the keyframes among the samples
+    if len(samples) <= count:
+        selected = samples
+    elif KEYFRAMES_SELECTION == "scene":
+        selected = sorted(sorted(samples, key=lambda sample: sample[1], reverse=True)[:count])
+    else:
+        selected = [samples[i] for i in np.linspace(0, len(samples) - 1, count).round().astype(int)]
+
+    return [(time_offset, jpeg) for time_offset, _, jpeg in selected], duration
+
+
+def build_keyframes_response(
+    gcs_uri: str,
+    keyframes: List[Tuple[float, bytes]],
+    responses: list,
+    duration: float,
+    use_cases: List[str] = None,
+) -> AnnotateVideoResponse:
+    """
+    Builds a Video Intelligence API shaped response from the Vision API responses of the keyframes of a video, so that
+    it goes through the same steps as the responses of the Video Intelligence API.
+
+    The localized objects of a label are grouped into as many tracks as the largest number of objects of this label
+    in a keyframe, the k-th track taking the k-th leftmost object of each keyframe. The person tracks also become person
+    detections, and the labels become segment labels with their highest score. Each keyframe becomes a shot lasting
+    until the next keyframe, so that its boxes are held on the annotated video until then, see get_held_time.
+
+    Args:
+      gcs_uri (str): The URI of the video.
+      keyframes (List[Tuple[float, bytes]]): The keyframes, see extract_keyframes.
+      responses (list): The Vision API response of each keyframe.
+      duration (float): The duration of the video in seconds.
+      use_cases (List[str], optional): The video use cases requested for the video, all of them by default. Only the
+                                       Person tracks are kept without object_detection, and no person detections
+                                       are built without people_detection.
+
+    Returns:
+      AnnotateVideoResponse: The video response.
+    """
+
+    use_cases = use_cases or list(VIDEO_USE_CASES)
+
+    # The frames of each track, by label and rank of the object in the keyframe
+    tracks = {}
+    labels = {}
+
+    for (time_offset, _), response in zip(keyframes, responses):
+        if response.error.message:
+            print(f"Vision API error for the keyframe at {time_offset:.3f}s of {gcs_uri}: {response.error.message}")
+            continue
+
+        offset = timedelta(seconds=time_offset)
+
+        # Rank the objects of each label from left to right
+        objects = {}
+        for annotation in response.localized_object_annotations:
+            xs = [vertex.x for vertex in annotation.bounding_poly.normalized_vertices]
+            ys = [vertex.y for vertex in annotation.bounding_poly.normalized_vertices]
+            box = videointelligence.NormalizedBoundingBox(left=min(xs), top=min(ys), right=max(xs), bottom=max(ys))
+            objects.setdefault((annotation.mid, annotation.name), []).append((box, annotation.score))
+
+        for entity, boxes in objects.items():
+            for rank, (box, score) in enumerate(sorted(boxes, key=lambda item: item[0].left)):
+                tracks.setdefault((entity, rank), []).append((offset, box, score))
+
+        # Keep the highest score of each label
+        for annotation in response.label_annotations:
+            if annotation.score > labels.get(annotation.description, (None, 0.0))[1]:
+                labels[annotation.description] = (annotation.mid, annotation.score)
+
+    object_annotations = []
+    person_detection_annotations = []
+
+    for ((mid, name), _), frames in tracks.items():
+        if "object_detection" not in use_cases and name != "Person":
+            continue
+
+        segment = videointelligence.VideoSegment(start_time_offset=frames[0][0], end_time_offset=frames[-1][0])
+        confidence = sum(score for _, _, score in frames) / len(frames)
+
+        object_annotations.append(
+            videointelligence.ObjectTrackingAnnotation(
+                entity=videointelligence.Entity(entity_id=mid, description=name),
+                confidence=confidence,
+                segment=segment,
+                frames=[
+                    videointelligence.ObjectTrackingFrame(normalized_bounding_box=box, time_offset=offset)
+                    for offset, box, _ in frames
+                ],
+            )
+        )
+
+        if name == "Person" and "people_detection" in use_cases:
+            person_detection_annotations.append(
+                videointelligence.PersonDetectionAnnotation(
+                    tracks=[
+                        videointelligence.Track(
+                            segment=segment,
+                            timestamped_objects=[
+                                videointelligence.TimestampedObject(normalized_bounding_box=box, time_offset=offset)
+                                for offset, box, _ in frames
+                            ],
+                            confidence=confidence,
+                        )
+                    ]
+                )
+            )
+
+    video_segment = videointelligence.VideoSegment(start_time_offset=timedelta(0), end_time_offset=timedelta(seconds=duration))
+
+    # Each keyframe stands for the frames until the next keyframe
+    starts = sorted(time_offset for time_offset, _ in keyframes)
+    shot_annotations = [
+        videointelligence.VideoSegment(start_time_offset=timedelta(seconds=start), end_time_offset=timedelta(seconds=end))
+        for start, end in zip(starts, starts[1:] + [duration])
+    ]
+
+    return AnnotateVideoResponse(
+        annotation_results=[
+            videointelligence.VideoAnnotationResults(
+                input_uri=gcs_uri,
+                segment=video_segment,
+                segment_label_annotations=[
+                    videointelligence.LabelAnnotation(
+                        entity=videointelligence.Entity(entity_id=mid, description=description),
+                        segments=[videointelligence.LabelSegment(segment=video_segment, confidence=score)],
+                    )
+                    for description, (mid, score) in labels.items()
+                ],
+                shot_annotations=shot_annotations,
+                object_annotations=object_annotations,
+                person_detection_annotations=person_detection_annotations,
+            )
+        ]
+    )
 
-from google.cloud import vision, videointelligence
 
-from google.cloud.vision import AnnotateImageResponse
-from google.cloud.videointelligence import AnnotateVideoResponse
+def get_keyframes_features(use_cases: List[str]) -> List[int]:
+    """
+    Returns the Vision API features requested for the keyframes of a video.
 
-from PIL import Image, ImageDraw
-from io import BytesIO
+    Args:
+      use_cases (List[str]): The video use cases requested for the video.
 
-from typing import Tuple, List
+    Returns:
+      List[int]: The features of the use cases, see KEYFRAMES_USE_CASES.
+    """
 
+    return list(dict.fromkeys(KEYFRAMES_USE_CASES[use_case] for use_case in use_cases))
 
-# Construct a BigQuery client object.
-bigquery_client = bigquery.Client()
 
-# Construct a Cloud Storage client object.
-storage_client = storage.Client()
+def get_keyframes_cache_key(event: dict, mode: str, use_cases: List[str]) -> str:
+    """
+    Returns the key of the cached keyframes response of a video.
 
-OUTPUT_BUCKET = storage_client.get_bucket(OUTPUT_BUCKET_NAME)
-INPUT_BUCKET = storage_client.get_bucket(INPUT_BUCKET_NAME)
+    The keyframes response depends on the analysis mode, the requested use cases, their features and the keyframes
+    selection, so that it is never reused by another mode or profile, nor by the Video Intelligence API path.
 
+    Args:
+      event (dict): The upload event payload.
+      mode (str): The video analysis mode, "keyframes" or "auto".
+      use_cases (List[str]): The video use cases requested for the video.
 
-def get_camera_trap_metadata(camera_trap_name: str) -> Tuple[float, float]:
+    Returns:
+      str: The cache key, see get_response_cache_key.
     """
-    This function retrieves the metadata for a given camera trap.
+
+    variant = f"keyframes|{mode}|{KEYFRAMES_SELECTION}|{KEYFRAMES_COUNT}|{';'.join(use_cases)}"
+
+    return get_response_cache_key("videos", event, get_keyframes_features(use_cases), variant)
+
+
+@traced
+def get_keyframes_response(media: Media, mode: str, use_cases: List[str]) -> AnnotateVideoResponse:
+    """
+    Analyzes a video with the Vision API on a few keyframes, if its analysis mode and length call for it.
 
     Args:
-      camera_trap_name (str): The name of the camera trap for which to retrieve metadata.
+      media (Media): The video file in the input bucket.
+      mode (str): The video analysis mode of its camera trap, see get_video_analysis_mode.
+      use_cases (List[str]): The video use cases requested for the video.
 
     Returns:
-      Tuple[float, float]: A tuple of longitude, and latitude.
+      AnnotateVideoResponse: The video response built from the keyframes, see build_keyframes_response, or None if the
+                             video should be analyzed by the Video Intelligence API.
     """
 
-    # Get the dataframe of metadata information for all camera traps
-    df = pd.read_csv(CAMERA_TRAPS_METADATA_PATH)
+    if mode not in ("keyframes", "auto"):
+        return None
 
-    # Get the values of the longitude, and latitude for the camera trap
-    longitude = df.loc[df["name"] == camera_trap_name, "longitude"]
-    latitude = df.loc[df["name"] == camera_trap_name, "latitude"]
+    start = time.perf_counter()
 
-    # Return the metadata as a tuple
-    return longitude, latitude
+    # Extract the keyframes, in auto mode only for the short videos
+    keyframes, duration = extract_keyframes(
+        media, KEYFRAMES_COUNT, KEYFRAMES_MAX_DURATION_SECONDS if mode == "auto" else None
+    )
+    if not keyframes:
+        return None
+
+    # Annotate the keyframes with Vision batch requests
+    medias = [Media.from_bytes(f"{media.name}@{time_offset:.3f}s", jpeg) for time_offset, jpeg in keyframes]
+    responses = get_image_responses(medias, get_keyframes_features(use_cases))
+
+    print(
+        json.dumps(
+            {
+                "message": "Keyframes analysis",
+                "media_name": media.name,
+                "mode": mode,
+                "use_cases": list(use_cases),
+                "keyframes": len(keyframes),
+                "duration": round(duration, 3),
+                "seconds": round(time.perf_counter() - start, 3),
+            }
+        )
+    )
 
+    return build_keyframes_response(media.gcs_uri, keyframes, responses, duration, use_cases)
 
-def update_metadata(camera_trap_name: str, last_detection: str, last_activation: str):
 
+@traced
+def get_video_outputs(response: VideoResult):
     """
-    Update the camera traps metadata.
+    Extracts object and person detection annotations from a Google Cloud Video Intelligence API response.
+
+    Args:
+      response (VideoResult): The response returned by the Google Cloud Video Intelligence API, parsed once.
 
     Returns:
-        None: updates the metadata
+      best_detection (str): The label of the most confidently detected object.
+      summary (str): A summary of the object and person detection annotations in the response.
+                     The summary includes the number of objects detected and their average confidence, as well as the number of people detected.
     """
+    # Extract object annotations
+    labels = response.tracks
+
+    # initialize the dictionary
+    average_dict = {}
+
+    for item in labels:
+        # if the item is not in the dictionary, initialize its sum and count
+        label = item.label
+        if label not in average_dict:
+            average_dict[label] = {"sum": 0, "count": 0}
+        # add the item value to the sum and increment the count
+        average_dict[label]["sum"] += item.confidence
+        average_dict[label]["count"] += 1
 
-    # Get the dataframe of metadata information for all camera traps
-    df = pd.read_csv(CAMERA_TRAPS_METADATA_PATH)
+    # Create summary string
+    summary = str(len(average_dict)) + " objects detected: "
 
-    df.loc[df["name"] == camera_trap_name, "last_detection"] = last_detection
-    df.loc[df["name"] == camera_trap_name, "last_activation"] = last_activation
+    # Object tracking may not be requested for the camera trap
+    best_detection = next(iter(average_dict), "person" if response.people else None)
 
-    OUTPUT_BUCKET.blob("metadata.csv").upload_from_string(
-        df.to_csv(index=None), content_type="text/csv"
-    )
+    # calculate the average and update the summary
+    for item, item_info in average_dict.items():
+        average = item_info["sum"] / item_info["count"]
+        summary += f"{item} {round(average*100, 2)}%     "
+
+    # Extract person detection annotations
+    labels = response.people
+
+    # Create summary string
+    if len(labels) != 1:
+        summary += str(len(labels)) + " people detected"
+    else:
+        summary += str(len(labels)) + " person detected"
+
+    return best_detection, summary
 
 
-def send_to_node_red(metadata: dict) -> None:
+def build_annotation_index(
+    tracks: list,
+    confidence_threshold: float = VIDEO_CONFIDENCE_THRESHOLD,
+):
     """
-    Sends metadata to Node-RED API
+    Merges the frames of the object tracks into a time-sorted, array-backed index.
 
     Args:
-      metadata (dict): metadata to be sent
+      tracks (List[VideoTrack]): The object tracks of a parsed response, see VideoResult.
+      confidence_threshold (float): Only the tracks with a higher confidence are indexed.
 
     Returns:
-      None
+      Tuple[np.ndarray, np.ndarray]: The sorted frame times in seconds, of shape (n,), and the matching
+                                     normalized boxes as (left, top, right, bottom), of shape (n, 4).
     """
-    # node-red API url
-    url = "https://nodered-xgwild.smartparks.org/artefact"
-    response = requests.post(url, metadata)
 
-    print(response.status_code)
+    np = lazy_import("numpy")
 
+    tracks = [track for track in tracks if track.confidence > confidence_threshold]
 
-def bigquery_insert(
-    project: str,
-    dataset: str,
-    camera_trap_name: str,
-    timestamp: datetime,
-    uri: str,
-    response: json,
-):
+    # The frames of each track are already held in flat arrays, they are viewed without copy before being merged
+    times = np.concatenate([np.frombuffer(track.times, dtype=np.float64) for track in tracks] or [np.empty(0)])
+    boxes = np.concatenate(
+        [np.frombuffer(track.boxes, dtype=np.float32) for track in tracks] or [np.empty(0, dtype=np.float32)]
+    ).reshape(-1, 4)
+
+    # Sort the frames by time so that each video frame can be matched with a binary search
+    order = np.argsort(times, kind="stable")
+
+    return times[order], boxes[order]
+
+
+def get_held_time(shots, video_time: float) -> float:
     """
-    Inserts a new row into a BigQuery table.
+    Returns the time of the annotated frames drawn on a video frame.
+
+    The responses of the Video Intelligence API are annotated on most frames, each video frame is drawn with the
+    annotated frames at its own time. The responses built from keyframes are only annotated on the keyframes, each
+    video frame is drawn with the keyframe starting its shot, until the next keyframe.
 
     Args:
-        project (str): The ID of the project containing the BigQuery table.
-        dataset (str): The ID of the dataset containing the BigQuery table.
-        camera_trap_name (str): The ID of the table to insert the row into.
-        timestamp (datetime): The timestamp for the new row.
-        uri (str): The URI for the new row.
-        response (json): The response for the new row.
+      shots (array): The start time of each shot of a parsed response, see VideoResult.
+      video_time (float): The time of the video frame in seconds.
 
     Returns:
-        None: The function does not return a value.
-
-    Raises:
-        google.api_core.exceptions.GoogleAPIError: If an error occurs while inserting the row.
+      float: The time of the annotated frames in seconds.
     """
 
-    # Set the ID of the table to insert the row into
-    table_id = f"{project}.{dataset}.{camera_trap_name}"
+    if not shots:
+        return video_time
 
-    # Create a list containing a dictionary with the new row's values
-    row_to_insert = [
-        {
-            "timestamp": timestamp,
-            "uri": uri,
-            "response": response,
-        }
-    ]
+    np = lazy_import("numpy")
 
-    # Call the BigQuery client's insert_rows_json() method to insert the new row
-    errors = bigquery_client.insert_rows_json(table_id, row_to_insert)
+    index = np.searchsorted(np.frombuffer(shots, dtype=np.float64), video_time, side="right") - 1
 
-    # Check if there were any errors while inserting the row
-    if errors == []:
-        print("New rows have been added.")
-    else:
-        # Print any errors to the console
-        print("Encountered errors while inserting rows: {}".format(errors))
+    return shots[index] if index >= 0 else video_time
 
 
-def draw_bounding_boxes(
-    file_name: str, vertices_list: List[dict], display_text: str = ""
-) -> bytes:
+def draw_video_frame_boxes(frame, boxes, width: int, height: int) -> None:
     """
-    This function downloads an image from a Google Cloud Storage bucket,
-    draws bounding boxes around specified regions in the image and returns
-    the image as a base64 encoded string.
+    Draws all the bounding boxes of a video frame with a single OpenCV call.
 
-    Parameters:
-    file_name (str): The uri of the image file in the Google Cloud Storage bucket.
-    vertices_list (list of dicts): List of dictionaries containing the vertices of the bounding boxes.
-    display_text (str, optional): Text to display on the image. Default is "".
+    Args:
+      frame (np.ndarray): The BGR frame to draw on, modified in place.
+      boxes (np.ndarray): The normalized boxes as (left, top, right, bottom), of shape (n, 4).
+      width (int): The width of the frame in pixels.
+      height (int): The height of the frame in pixels.
 
     Returns:
-    encoded_image (bytes): Base64 encoded image with the bounding boxes drawn.
+      None
     """
 
-    # Download the image from the Google Cloud Storage bucket
-    blob = INPUT_BUCKET.get_blob(file_name)
-    encoded_image = BytesIO(blob.download_as_string())
+    if len(boxes) == 0:
+        return
 
-    # Open the image using Pillow library
-    pillow_img = Image.open(encoded_image)
+    np = lazy_import("numpy")
+    cv2 = lazy_import("cv2")
 
-    # Create a draw object to draw on the image
-    draw = ImageDraw.Draw(pillow_img)
+    # Convert the normalized coordinates to pixel coordinates
+    pixels = (boxes * np.array([width, height, width, height], dtype=np.float32)).astype(
+        np.int32
+    )
+    left, top, right, bottom = pixels.T
+
+    # Draw every rectangle as a closed polygon in one batch
+    polygons = np.stack(
+        [
+            np.stack([left, top], axis=1),
+            np.stack([right, top], axis=1),
+            np.stack([right, bottom], axis=1),
+            np.stack([left, bottom], axis=1),
+        ],
+        axis=1,
+    )
+    cv2.polylines(frame, list(polygons), True, (0, 255, 0), 2)
 
-    # Get the width and height of the image
-    width, height = pillow_img.size
 
-    # Draw the bounding boxes on the image
-    for vertices in vertices_list:
-        # Calculate the start and end points of the rectangle
-        rect_start = (vertices[0]["x"] * width, vertices[0]["y"] * height)
-        rect_end = (vertices[2]["x"] * width, vertices[2]["y"] * height)
-        draw.rectangle((rect_start, rect_end), outline="green", width=2)
+class VideoRangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves the byte ranges of the video blob of its server, see serve_video_ranges.
 
-    # Save the image with the bounding boxes
-    buffered = BytesIO()
-    pillow_img.save(buffered, format="JPEG")
+    Each range is downloaded from Cloud Storage in chunks of VIDEO_STREAM_CHUNK_SIZE bytes, written to the decoder as
+    soon as they arrive.
+    """
 
-    OUTPUT_BUCKET.blob(f"{file_name}").upload_from_string(
-        buffered.getvalue(), content_type="image/jpeg"
-    )
+    def do_GET(self) -> None:
+        blob, size = self.server.blob, self.server.size
 
-    # Encode the image as a base64 string
-    encoded_image = base64.b64encode(buffered.getvalue())
+        # Parse the "bytes=start-end" range requested by the decoder, the whole video by default
+        start, end = 0, size - 1
+        requested = self.headers.get("Range", "")
+        if requested.startswith("bytes="):
+            first, _, last = requested[len("bytes="):].partition("-")
+            start = int(first) if first else max(0, size - int(last))
+            end = min(int(last), size - 1) if first and last else size - 1
 
-    return encoded_image
+        if start >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
 
+        self.send_response(206 if requested else 200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
 
-########################################################################## IMAGES ##########################################################################
+        try:
+            for offset in range(start, end + 1, VIDEO_STREAM_CHUNK_SIZE):
+                chunk = blob.download_as_bytes(start=offset, end=min(end, offset + VIDEO_STREAM_CHUNK_SIZE - 1))
+                self.wfile.write(chunk)
 
+                with self.server.lock:
+                    self.server.stats["bytes"] += len(chunk)
 
-def get_image_response(gcs_uri: str, features: List[str]):
+        except (BrokenPipeError, ConnectionResetError):
+            # The decoder seeked elsewhere or stopped reading
+            pass
+
+        except Exception as error:
+            self.server.errors.append(error)
+
+        finally:
+            with self.server.lock:
+                self.server.stats["requests"] += 1
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@contextlib.contextmanager
+def serve_video_ranges(blob: storage.Blob):
     """
-    This function uses the Google Cloud Vision API to extract image features and annotate an image located in a Google Cloud Storage bucket.
+    Serves a video stored in Cloud Storage over HTTP on the loopback interface, with range requests.
 
-    Parameters:
-    gcs_uri (str): The URI of the image in the Google Cloud Storage bucket.
-    features (List[str]): The features to extract from the image. Can be one of: 'FACE_DETECTION', 'LANDMARK_DETECTION', 'LOGO_DETECTION', 'LABEL_DETECTION', 'DOCUMENT_TEXT_DETECTION', 'SAFE_SEARCH_DETECTION', 'IMAGE_PROPERTIES', or 'CROP_HINTS'.
+    FFmpeg reads the video through HTTP range requests, so it can seek to the index (the "moov" atom) of MP4 files
+    that store it at the end, without downloading the whole video. At most VIDEO_STREAM_CHUNK_SIZE bytes of the video
+    are held in memory per request.
 
-    Returns:
-    response: A response object from the Google Cloud Vision API.
+    Args:
+      blob (storage.Blob): The video blob.
+
+    Yields:
+      Tuple[str, ThreadingHTTPServer]: The URL of the video, and the server, with the download errors in its errors
+                                       list and the number of requests and bytes served in its stats.
     """
 
-    # Initialize the client for the Google Cloud Vision API
-    client = vision.ImageAnnotatorClient()
+    # Pin the size and generation of the video, so that every range comes from the same object
+    if blob.size is None:
+        blob.reload()
 
-    # Set the source for the image
-    source = {"image_uri": gcs_uri}
-    image = {"source": source}
+    server = ThreadingHTTPServer(("127.0.0.1", 0), VideoRangeHandler)
+    server.blob = blob
+    server.size = blob.size
+    server.errors = []
+    server.lock = threading.Lock()
+    server.stats = {"requests": 0, "bytes": 0}
 
-    # Specify the feature type to extract
-    requests = {
-        "image": image,
-        "features": [{"type_": feature} for feature in features],
-    }
+    # Poll often, the server is shut down as soon as the video is decoded
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True)
+    thread.start()
 
-    # Use the API to annotate the image
-    response = client.annotate_image(requests)
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/video{Path(blob.name).suffix.lower()}", server
 
-    return response
+    finally:
+        server.shutdown()
+        server.server_close()
 
 
-def get_image_outputs(response: str) -> dict:
+@contextlib.contextmanager
+def open_video_capture(blob: storage.Blob):
     """
-    Get image response from given response and use case.
+    Opens a video stored in Cloud Storage with OpenCV, decoding it while it is downloading.
 
-    This function takes a response in the form of a json string. The function performs the relevant annotations, computes relevant statistics and summarizes the results.
+    The video is read through HTTP range requests, see serve_video_ranges, so that the capture supports seeking
+    whatever the position of the index of the video. The capture is released on exit.
 
     Args:
-    response (str): The response to be processed in the form of a json string.
+      blob (storage.Blob): The video blob.
 
-    Returns:
-    dict: A dictionary containing the predictions, prediction count, summary and additional information depending on the use case.
+    Yields:
+      cv2.VideoCapture: The opened video capture.
     """
 
-    response = json.loads(AnnotateImageResponse.to_json(response))
-    result = {}
+    cv2 = lazy_import("cv2")
 
-    labels = response["localizedObjectAnnotations"]
-    labels = sorted(labels, key=lambda x: x["score"], reverse=True)
+    with serve_video_ranges(blob) as (url, server):
+        cap = cv2.VideoCapture(url, cv2.CAP_FFMPEG)
 
-    best_detection = labels[0]["name"]
+        try:
+            if not cap.isOpened():
+                raise RuntimeError(f"Could not decode the video {blob.name}") from (
+                    server.errors[0] if server.errors else None
+                )
 
-    result["predictions"] = labels
-    result["predictions_count"] = len(labels)
+            yield cap
 
-    summary = str(len(labels)) + " objects detected: "
-    bounding_boxes = []
-    for label in labels:
-        summary += f"{label['name']} {round(label['score']*100, 2)}%     "
-        bounding_boxes.append(label["boundingPoly"]["normalizedVertices"])
+        finally:
+            cap.release()
 
-    result["bounding_boxes"] = bounding_boxes
+            print(
+                json.dumps(
+                    {
+                        "message": "Video stream",
+                        "media_name": blob.name,
+                        "size": server.size,
+                        **server.stats,
+                    }
+                )
+            )
 
-    labels = response["faceAnnotations"]
+    if server.errors:
+        raise server.errors[0]
 
-    joy_detected = 0
-    sorrow_detected = 0
-    anger_detected = 0
-    surprise_detected = 0
-    headwear_detected = 0
 
-    summary += str(len(labels)) + " people detected: "
-    for label in labels:
-        if label["joyLikelihood"] >= 3:
-            joy_detected += 1
-        if label["sorrowLikelihood"] >= 3:
-            sorrow_detected += 1
-        if label["angerLikelihood"] >= 3:
-            anger_detected += 1
-        if label["surpriseLikelihood"] >= 3:
-            surprise_detected += 1
-        if label["headwearLikelihood"] >= 3:
-            headwear_detected += 1
+def open_video_encoder(path: str, width: int, height: int, frame_rate: float) -> subprocess.Popen:
+    """
+    Starts an ffmpeg process encoding the raw BGR frames written to its stdin into a browser-playable
+    H.264 MP4, in a single pass.
 
-    summary += f"{joy_detected} joy, {sorrow_detected} sorrow, {anger_detected} anger, {surprise_detected} surprise, {headwear_detected} headwear"
-    result["summary"] = summary
+    Args:
+      path (str): The path of the MP4 file to write.
+      width (int): The width of the frames in pixels.
+      height (int): The height of the frames in pixels.
+      frame_rate (float): The frame rate of the video.
 
-    return best_detection, result
+    Returns:
+      subprocess.Popen: The ffmpeg process, frames are written to its stdin.
+    """
 
+    # ffmpeg binary shipped with the imageio-ffmpeg wheel
+    imageio_ffmpeg = lazy_import("imageio_ffmpeg")
+
+    command = [
+        imageio_ffmpeg.get_ffmpeg_exe(),
+        "-y",
+        "-loglevel",
+        "error",
+        # Raw OpenCV frames on stdin
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "bgr24",
+        "-s",
+        f"{width}x{height}",
+        "-r",
+        str(frame_rate),
+        "-i",
+        "pipe:0",
+        # H.264 in yuv420p, which requires even dimensions, with the index at the start for progressive playback
+        "-an",
+        "-c:v",
+        "libx264",
+        "-preset",
+        VIDEO_ENCODING_PRESET,
+        "-crf",
+        str(VIDEO_ENCODING_CRF),
+        "-vf",
+        "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+        "-pix_fmt",
+        "yuv420p",
+        "-movflags",
+        "+faststart",
+        path,
+    ]
 
-########################################################################## VIDEOS ##########################################################################
+    return subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
 
 
-def get_video_response(gcs_uri: str, features: List[str]):
+def close_video_encoder(encoder: subprocess.Popen) -> None:
     """
-    This function analyzes a video stored in a Google Cloud Storage (GCS) bucket using Google's Video Intelligence API and returns the API's response.
+    Waits for an ffmpeg process started by open_video_encoder to finish writing the video.
 
     Args:
-      gcs_uri (str): The URI of the video file in the GCS bucket.
-      features (List[str]): The types of analysis to be performed on the video, such as "LABEL_DETECTION".
+      encoder (subprocess.Popen): The ffmpeg process.
 
     Returns:
-      response: The response from the Video Intelligence API, containing the results of the video analysis.
-    """
+      None
 
-    # Create a client for the Video Intelligence API
-    client = videointelligence.VideoIntelligenceServiceClient()
+    Raises:
+      RuntimeError: If ffmpeg failed to encode the video.
+    """
 
-    # Analyze the video using the specified feature
-    response = client.annotate_video(
-        request={"features": features, "input_uri": gcs_uri}
-    )
+    encoder.stdin.close()
+    error = encoder.stderr.read()
 
-    # Return the result of the video analysis, with a timeout of 500 seconds
-    return response.result(timeout=500)
+    if encoder.wait() != 0:
+        raise RuntimeError(f"ffmpeg failed to encode the video: {error.decode()}")
 
 
-def get_video_outputs(response):
+@traced
+def annotate_video(response, file_name):
     """
-    Extracts object and person detection annotations from a Google Cloud Video Intelligence API response.
+    This function takes the parsed `AnnotateVideoResponse` containing video annotations and the name of the video file as input.
+    It opens the video file using OpenCV, decoding it while it is downloading when the container allows it, loops over the
+    frames of the video, and draws bounding boxes around detected objects in each frame. The annotated frames are piped to ffmpeg, which encodes
+    them to an MP4 file in a single pass, and the annotated video file is uploaded to a GCS bucket.
 
     Args:
-      response (AnnotateVideoResponse object): The response object returned by the Google Cloud Video Intelligence API.
+       response (VideoResult): The parsed `AnnotateVideoResponse` containing video annotations.
+       file_name (str): The name of the video file.
 
     Returns:
-      best_detection (str): The label of the most confidently detected object.
-      summary (str): A summary of the object and person detection annotations in the response.
-                     The summary includes the number of objects detected and their average confidence, as well as the number of people detected.
+      annotated_frame (str): The annotated frame in base64 format.
     """
-    # Convert AnnotateVideoResponse to a dictionary and extract the first annotation result
-    response = json.loads(AnnotateVideoResponse.to_json(response))["annotationResults"][
-        0
-    ]
 
-    # Extract object annotations
-    labels = response["objectAnnotations"]
+    # Video-only dependencies
+    np = lazy_import("numpy")
+    cv2 = lazy_import("cv2")
 
-    # initialize the dictionary
-    average_dict = {}
+    # Index the annotated frames by time once, instead of scanning them for every video frame
+    times, boxes = build_annotation_index(response.tracks)
 
-    for item in labels:
-        # if the item is not in the dictionary, initialize its sum and count
-        label = item["entity"]["description"]
-        if label not in average_dict:
-            average_dict[label] = {"sum": 0, "count": 0}
-        # add the item value to the sum and increment the count
-        average_dict[label]["sum"] += item["confidence"]
-        average_dict[label]["count"] += 1
+    # Get the video file from the GCS bucket
+    blob = get_input_bucket().blob(file_name)
 
-    # Create summary string
-    summary = str(len(average_dict)) + " objects detected: "
+    # Keep the temporary files of the invocation apart, they are deleted even if the annotation fails
+    with tempfile.TemporaryDirectory(prefix="annotate-video-") as directory:
 
-    best_detection = list(average_dict.keys())[0]
+        # Open the video file, decoding it while it is downloading
+        with open_video_capture(blob) as cap:
 
-    # calculate the average and update the summary
-    for item, item_info in average_dict.items():
-        average = item_info["sum"] / item_info["count"]
-        summary += f"{item} {round(average*100, 2)}%     "
+            # Get the video dimensions
+            width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
-    # Extract person detection annotations
-    labels = response["personDetectionAnnotations"]
+            # Get the video frame rate
+            frame_rate = cap.get(cv2.CAP_PROP_FPS)
 
-    # Create summary string
-    if len(labels) != 1:
-        summary += str(len(labels)) + " people detected"
-    else:
-        summary += str(len(labels)) + " person detected"
+            # Start encoding the annotated video
+            annotated_video_path = os.path.join(directory, "annotated_video.mp4")
+            encoder = open_video_encoder(
+                annotated_video_path, width, height, frame_rate
+            )
 
-    return best_detection, summary
+            delta = VIDEO_FRAME_TIME_DELTA
 
+            frame_count = 0
+            thumbnail = None
 
-def annotate_video(response, file_name):
+            try:
+                # Loop over the frames of the video
+                while True:
+                    ret, frame = cap.read()
+
+                    if not ret:
+                        break
+
+                    video_time = get_held_time(response.shots, frame_count / frame_rate)
+
+                    # Find the annotated frames within delta seconds of the video frame
+                    start = np.searchsorted(times, video_time - delta, side="left")
+                    end = np.searchsorted(times, video_time + delta, side="right")
+
+                    # Draw the bounding boxes on the frame
+                    draw_video_frame_boxes(frame, boxes[start:end], width, height)
+
+                    # Keep the thumbnail frame, or the last one of shorter videos
+                    if frame_count <= VIDEO_THUMBNAIL_FRAME:
+                        thumbnail = frame
+
+                    # Write the annotated frame to the video encoder
+                    encoder.stdin.write(frame.tobytes())
+
+                    frame_count += 1
+
+            except BaseException:
+                encoder.kill()
+                raise
+
+        if thumbnail is None:
+            encoder.kill()
+            raise RuntimeError(f"The video {file_name} has no frames")
+
+        # Wait for the encoder to finish the mp4 file
+        close_video_encoder(encoder)
+
+        # Convert the preview of the annotated thumbnail frame to base64
+        annotated_frame = encode_frame_preview(thumbnail)
+
+        # Save the video in Cloud Storage
+        get_output_bucket().blob(file_name).upload_from_filename(annotated_video_path)
+
+    return annotated_frame
+
+
+def get_thumbnail_time(tracks: list) -> float:
     """
-    This function takes an `AnnotateVideoResponse` object containing video annotations and the name of the video file as input.
-    It saves the video file to the `/tmp` directory, opens the video file using OpenCV, loops over the frames of the video,
-    and draws bounding boxes around detected objects in each frame. It then saves the annotated video file to the `/tmp` directory,
-    converts the annotated video file to the MP4 format, and uploads the annotated video file to a GCS bucket.
+    Chooses the time of the video frame sent with the alert: the middle frame of the most confident object track.
 
     Args:
-       response (AnnotateVideoResponse): An `AnnotateVideoResponse` object containing video annotations.
-       file_name (str): The name of the video file.
+      tracks (List[VideoTrack]): The object tracks of a parsed response, see VideoResult.
 
     Returns:
-      annotated_frame (str): The annotated frame in base64 format.
+      float: The time of the frame in seconds, or None if no track is above VIDEO_CONFIDENCE_THRESHOLD.
     """
 
-    data = json.loads(AnnotateVideoResponse.to_json(response))["annotationResults"][0][
-        "objectAnnotations"
-    ]
+    tracks = [track for track in tracks if track.confidence > VIDEO_CONFIDENCE_THRESHOLD and track.times]
 
-    # Get the video file from the GCS bucket
-    blob = INPUT_BUCKET.get_blob(file_name)
+    if not tracks:
+        return None
+
+    times = max(tracks, key=lambda track: track.confidence).times
 
-    # Save the video to the /tmp directory
-    blob.download_to_filename("/tmp/video.mp4")
+    return times[len(times) // 2]
 
-    # Open the video file
-    cap = cv2.VideoCapture("/tmp/video.mp4")
 
-    # Get the video dimensions
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+@traced
+def annotate_video_thumbnail(response, file_name):
+    """
+    This function draws the bounding boxes on a single frame of a video, without decoding the rest of the video.
 
-    # Define the codec for the output video file
-    fourcc = cv2.VideoWriter_fourcc(*"XVID")
+    The frame is the middle frame of the most confident object track, or frame VIDEO_THUMBNAIL_FRAME when no track is
+    confident enough. Seekable videos are seeked directly to it, streamed videos are only decoded up to it.
 
-    # Get the video frame rate
-    frame_rate = int(cap.get(cv2.CAP_PROP_FPS))
+    Args:
+       response (VideoResult): The parsed `AnnotateVideoResponse` containing video annotations.
+       file_name (str): The name of the video file.
 
-    # Create the VideoWriter object
-    out = cv2.VideoWriter(
-        "/tmp/annotated_video.avi", fourcc, frame_rate, (width, height)
-    )
+    Returns:
+      annotated_frame (str): The annotated frame in base64 format.
+    """
+
+    # Video-only dependencies
+    np = lazy_import("numpy")
+    cv2 = lazy_import("cv2")
 
-    if not out.isOpened():
-        print("Failed to open output video file")
+    times, boxes = build_annotation_index(response.tracks)
+    thumbnail_time = get_thumbnail_time(response.tracks)
 
-    delta = 0.05
+    # Get the video file from the GCS bucket
+    blob = get_input_bucket().blob(file_name)
 
-    frame_count = 0
+    with open_video_capture(blob) as cap:
+
+        # Get the video dimensions and frame rate
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        frame_rate = cap.get(cv2.CAP_PROP_FPS)
+
+        # Get the index of the thumbnail frame, within the video when its length is known
+        if thumbnail_time is None:
+            frame_index = VIDEO_THUMBNAIL_FRAME
+        else:
+            frame_index = int(round(thumbnail_time * frame_rate))
+
+        frame_total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if frame_total > 0:
+            frame_index = min(frame_index, frame_total - 1)
+
+        # Go to the thumbnail frame
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
 
-    # Loop over the frames of the video
-    while True:
         ret, frame = cap.read()
 
         if not ret:
-            break
+            raise RuntimeError(f"Could not decode frame {frame_index} of {file_name}")
+
+    # Draw the bounding boxes of the annotated frames close to the thumbnail frame
+    video_time = get_held_time(response.shots, frame_index / frame_rate)
+    start = np.searchsorted(times, video_time - VIDEO_FRAME_TIME_DELTA, side="left")
+    end = np.searchsorted(times, video_time + VIDEO_FRAME_TIME_DELTA, side="right")
+    draw_video_frame_boxes(frame, boxes[start:end], width, height)
 
-        video_time = frame_count / frame_rate
+    # Convert the preview of the annotated frame to base64
+    annotated_frame = encode_frame_preview(frame)
 
-        for annotation in data:
-            if annotation["confidence"] > 0.6:
+    return annotated_frame
 
-                # Loop over the object annotations in the JSON file
-                for frame_data in annotation["frames"]:
 
-                    frame_time = float(frame_data["timeOffset"].split("s")[0])
+@traced
+def defer_annotated_video(response, file_name) -> None:
+    """
+    Queues the rendering of an annotated video, by writing a render job to the jobs bucket.
 
-                    if video_time - delta <= frame_time <= video_time + delta:
-                        box = frame_data["normalizedBoundingBox"]
+    The job is picked up by render_annotated_video when the object creation triggers handle_job_object.
 
-                        # Get the normalized bounding box coordinates and convert them to pixel coordinates
-                        left = int(box["left"] * width)
-                        top = int(box["top"] * height)
-                        right = int(box["right"] * width)
-                        bottom = int(box["bottom"] * height)
+    Args:
+       response (VideoResult): The parsed `AnnotateVideoResponse` containing video annotations.
+       file_name (str): The name of the video file.
 
-                        # Draw the bounding box on the frame
-                        cv2.rectangle(
-                            frame, (left, top), (right, bottom), (0, 255, 0), 2
-                        )
+    Returns:
+      None
+    """
+
+    # The response was already serialized to be stored in BigQuery
+    get_jobs_bucket().blob(f"{RENDER_JOBS_PREFIX}{file_name}.json").upload_from_string(
+        response.json, content_type="application/json"
+    )
 
-        # Convert an annotated frame to base64
-        if frame_count == 60:
-            _, buffer = cv2.imencode(".jpg", frame)
-            annotated_frame = base64.b64encode(buffer)
 
-        # Write the annotated frame to the output video file
-        out.write(frame)
+@traced
+def render_annotated_video(job_name: str) -> None:
+    """
+    Renders the annotated video of a render job written by defer_annotated_video, and deletes the job.
 
-        frame_count += 1
+    Args:
+       job_name (str): The name of the render job in the jobs bucket.
 
-    # Release the video capture and video writer objects, and destroy the OpenCV windows
-    cap.release()
-    out.release()
-    cv2.destroyAllWindows()
+    Returns:
+      None
+    """
 
-    # Convert the video to mp4
-    mp4_video = moviepy.VideoFileClip("/tmp/annotated_video.avi")
-    mp4_video.write_videofile("/tmp/annotated_video.mp4")
+    job = get_jobs_bucket().blob(job_name)
 
-    # Save the video in Cloud Storage
-    OUTPUT_BUCKET.blob(file_name).upload_from_filename("/tmp/annotated_video.mp4")
+    response = VideoResult.from_json(job.download_as_text())
+    file_name = job_name[len(RENDER_JOBS_PREFIX) : -len(".json")]
 
-    # Delete the temporary video files
-    os.remove("/tmp/video.mp4")
-    os.remove("/tmp/annotated_video.avi")
-    os.remove("/tmp/annotated_video.mp4")
+    annotate_video(response, file_name)
 
-    return annotated_frame
+    job.delete()
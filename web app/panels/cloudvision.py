@@ -9,7 +9,8 @@ from utils import (
     read_media,
     get_labels,
     get_face_annotations,
-    read_media,
+    get_labels_from_detections,
+    get_face_annotations_from_detections,
 )
 
 # load config file
@@ -23,6 +24,7 @@ CAMERA_NAMES = config["CAMERA_NAMES"]
 PROJECT = config["PROJECT"]
 TIME_ZONE = config["TIME_ZONE"]
 USE_CASES = config["USE_CASES"]
+DETECTIONS_TABLE = config["DETECTIONS_TABLE"]
 
 
 def app():
@@ -53,12 +55,34 @@ def app():
 
     if len(selected_date) == 2:
 
+        # the raw response is only needed for the images ingested before the detections table
         df = run_query(
-            f"SELECT * FROM `{PROJECT}.images.{selected_camera_trap}` ORDER BY timestamp DESC"
+            f"""
+            SELECT images.timestamp, images.uri, IF(detections.uri IS NULL, images.response, NULL) AS response
+            FROM `{PROJECT}.images.{selected_camera_trap}` AS images
+            LEFT JOIN (
+                SELECT DISTINCT uri, timestamp FROM `{PROJECT}.{DETECTIONS_TABLE}`
+                WHERE camera_trap_name = '{selected_camera_trap}' AND media_type = 'image'
+                AND DATE(timestamp) BETWEEN '{selected_date[0]}' AND '{selected_date[1]}'
+            ) AS detections
+            USING (uri, timestamp)
+            ORDER BY timestamp DESC
+            """
         )
 
         df = filter_dataframe_by_date_time_range(df, selected_date, selected_time)
 
+        # get the flattened detections of the selected images, grouped by image and processing, so that an image
+        # processed twice is not counted twice
+        detections = run_query(
+            f"""
+            SELECT uri, timestamp, kind, label, score, tags FROM `{PROJECT}.{DETECTIONS_TABLE}`
+            WHERE camera_trap_name = '{selected_camera_trap}' AND media_type = 'image'
+            AND DATE(timestamp) BETWEEN '{selected_date[0]}' AND '{selected_date[1]}'
+            """
+        )
+        detections_by_media = dict(tuple(detections.groupby(["uri", "timestamp"])))
+
         for _, row in df.iterrows():
 
             image = row["uri"].replace(f"gs://{BUCKET_NAME}/", "")
@@ -78,17 +102,25 @@ def app():
             annotated_img = read_media(OUTPUT_BUCKET_NAME, image)
             img_col.image(annotated_img)
 
-            # get labels
-            labels = get_labels(json.loads(row["response"]))
+            # get labels and annotations, from the detections or from the raw response of older images
+            media_key = (row["uri"], row["timestamp"])
+            if media_key in detections_by_media:
+                labels = get_labels_from_detections(detections_by_media[media_key])
+                face_annotations = get_face_annotations_from_detections(
+                    detections_by_media[media_key]
+                )
+            elif isinstance(row["response"], str):
+                response = json.loads(row["response"])
+                labels = get_labels(response)
+                face_annotations = get_face_annotations(response)
+            else:
+                labels, face_annotations = {}, None
 
             # display labels
             for label in labels:
                 col2.text(label + ": " + str(round(labels[label] * 100, 2)) + "%")
                 col2.progress(labels[label])
 
-            # get annotations
-            face_annotations = get_face_annotations(json.loads(row["response"]))
-
             # display annotations
             if face_annotations is not None:
                 for annotation in face_annotations:
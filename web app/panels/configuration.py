@@ -14,6 +14,40 @@ OUTPUT_BUCKET_NAME = config["OUTPUT_BUCKET_NAME"]
 CAMERA_NAMES = config["CAMERA_NAMES"]
 USE_CASES = config["USE_CASES"]
 CAMERAS_METADATA_FILE = config["CAMERAS_METADATA_FILE"]
+ANALYSIS_USE_CASES = config["ANALYSIS_USE_CASES"]
+POST_PROCESSING_STEPS = config["POST_PROCESSING_STEPS"]
+VIDEO_ANALYSIS_MODES = config["VIDEO_ANALYSIS_MODES"]
+
+# columns of the analysis profile of each camera trap, read by the cloud function
+PROFILE_COLUMNS = ["use_cases", "steps", "video_analysis", "motion_threshold", "roi", "masks"]
+
+
+def split_profile_list(value):
+    """
+    Splits a ";" separated list of a profile column of the metadata.
+
+    Args:
+        value (str): The value of the column, empty or NaN for the default.
+
+    Returns:
+        list: The names of the list, empty for the default.
+    """
+    if pd.isna(value):
+        return []
+    return [name for name in str(value).split(";") if name]
+
+
+def format_profile_value(value):
+    """
+    Formats the value of a profile column of the metadata for a text input.
+
+    Args:
+        value: The value of the column, NaN for the default.
+
+    Returns:
+        str: The value, empty for the default.
+    """
+    return "" if pd.isna(value) else str(value)
 
 
 def app():
@@ -24,6 +58,12 @@ def app():
     # get the metadata of the cameras
     df = get_metadata(OUTPUT_BUCKET_NAME, CAMERAS_METADATA_FILE)
 
+    # the profile columns are optional, empty values select the defaults of the cloud function
+    for column in PROFILE_COLUMNS:
+        if column not in df.columns:
+            df[column] = ""
+        df[column] = df[column].astype(object)
+
     # define a container to store the cameras details
     camera_traps_container = st.container()
 
@@ -55,6 +95,62 @@ def app():
                 key=f"lat_{i}",
             )
 
+            # create 4 columns to display the analysis profile of the camera trap
+            col5, col6, col7, col8 = single_camera_contaier.columns(4)
+
+            col5.multiselect(
+                "Use cases",
+                ANALYSIS_USE_CASES,
+                [
+                    name
+                    for name in split_profile_list(df[df["name"] == camera_trap]["use_cases"].values[0])
+                    if name in ANALYSIS_USE_CASES
+                ],
+                key=f"use_cases_{i}",
+                help="Features requested from the APIs, all of them if empty",
+            )
+            col6.multiselect(
+                "Steps",
+                POST_PROCESSING_STEPS,
+                [
+                    name
+                    for name in split_profile_list(df[df["name"] == camera_trap]["steps"].values[0])
+                    if name in POST_PROCESSING_STEPS
+                ],
+                key=f"steps_{i}",
+                help="Post-processing steps run on the media, all of them if empty",
+            )
+            video_analysis = format_profile_value(df[df["name"] == camera_trap]["video_analysis"].values[0])
+            col7.selectbox(
+                "Video analysis",
+                VIDEO_ANALYSIS_MODES,
+                VIDEO_ANALYSIS_MODES.index(video_analysis) if video_analysis in VIDEO_ANALYSIS_MODES else 0,
+                key=f"video_analysis_{i}",
+                help="Default of the cloud function if empty",
+            )
+            col8.text_input(
+                "Motion threshold",
+                format_profile_value(df[df["name"] == camera_trap]["motion_threshold"].values[0]),
+                key=f"motion_threshold_{i}",
+                help="Fraction of changed pixels under which a media is considered empty, default if empty",
+            )
+
+            # create 2 columns to display the region of interest and the masks of the images of the camera trap
+            col9, col10 = single_camera_contaier.columns(2)
+
+            col9.text_input(
+                "Region of interest",
+                format_profile_value(df[df["name"] == camera_trap]["roi"].values[0]),
+                key=f"roi_{i}",
+                help="Normalized box left,top,right,bottom the images are cropped to before the analysis, whole image if empty",
+            )
+            col10.text_input(
+                "Masks",
+                format_profile_value(df[df["name"] == camera_trap]["masks"].values[0]),
+                key=f"masks_{i}",
+                help="Normalized boxes left,top,right,bottom separated by ; hidden before the analysis, e.g. a timestamp banner",
+            )
+
     with buttons_container:
         button1, button2, _ = st.columns([10, 10, 150])
 
@@ -80,12 +176,41 @@ def app():
 
     # if the save button is clicked, update the metadata file
     if save:
+        # the cloud function reads the motion thresholds as numbers
+        for i, _ in enumerate(df["name"].values):
+            threshold = st.session_state[f"motion_threshold_{i}"].strip()
+            if not threshold:
+                continue
+            try:
+                float(threshold)
+            except ValueError:
+                st.error(f"Invalid motion threshold: {threshold}")
+                return
+
+        # the cloud function reads the regions of interest and the masks as normalized boxes
+        for i, _ in enumerate(df["name"].values):
+            for column in ["roi", "masks"]:
+                for box in split_profile_list(st.session_state[f"{column}_{i}"].strip()):
+                    try:
+                        coordinates = [float(coordinate) for coordinate in box.split(",")]
+                    except ValueError:
+                        coordinates = []
+                    if len(coordinates) != 4 or not all(0 <= coordinate <= 1 for coordinate in coordinates):
+                        st.error(f"Invalid box: {box}")
+                        return
+
         st.write("New camera trap added! 🎉")
         for i, camera_trap in enumerate(df["name"].values):
             df.at[i, "name"] = st.session_state[f"name_{i}"]
             df.at[i, "url"] = st.session_state[f"url_{i}"]
             df.at[i, "longitude"] = st.session_state[f"lon_{i}"]
             df.at[i, "latitude"] = st.session_state[f"lat_{i}"]
+            df.at[i, "use_cases"] = ";".join(st.session_state[f"use_cases_{i}"])
+            df.at[i, "steps"] = ";".join(st.session_state[f"steps_{i}"])
+            df.at[i, "video_analysis"] = st.session_state[f"video_analysis_{i}"]
+            df.at[i, "motion_threshold"] = st.session_state[f"motion_threshold_{i}"]
+            df.at[i, "roi"] = st.session_state[f"roi_{i}"]
+            df.at[i, "masks"] = st.session_state[f"masks_{i}"]
 
         # add a new row to the dataframe
         if st.session_state.new_row:
@@ -96,6 +221,7 @@ def app():
                 "url": url,
                 "last_detection": "",
                 "last_activation": "",
+                **{column: "" for column in PROFILE_COLUMNS},
             }
             new_row = pd.DataFrame(data=d, index=[0])
             df = df.append(new_row, ignore_index=True)
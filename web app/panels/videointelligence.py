@@ -3,12 +3,15 @@ import yaml
 import pytz
 import streamlit as st
 from datetime import datetime, time
+from google.api_core.exceptions import NotFound
 from utils import (
     run_query,
     filter_dataframe_by_date_time_range,
     read_media,
     get_video_labels,
     get_number_of_people,
+    get_labels_from_detections,
+    get_number_of_people_from_detections,
 )
 
 # load config file
@@ -22,6 +25,7 @@ CAMERA_NAMES = config["CAMERA_NAMES"]
 PROJECT = config["PROJECT"]
 TIME_ZONE = config["TIME_ZONE"]
 USE_CASES = config["USE_CASES"]
+DETECTIONS_TABLE = config["DETECTIONS_TABLE"]
 
 
 def app():
@@ -52,12 +56,34 @@ def app():
 
     if len(selected_date) == 2:
 
+        # the raw response is only needed for the videos ingested before the detections table
         df = run_query(
-            f"SELECT * FROM `{PROJECT}.videos.{selected_camera_trap}` ORDER BY timestamp DESC"
+            f"""
+            SELECT videos.timestamp, videos.uri, IF(detections.uri IS NULL, videos.response, NULL) AS response
+            FROM `{PROJECT}.videos.{selected_camera_trap}` AS videos
+            LEFT JOIN (
+                SELECT DISTINCT uri, timestamp FROM `{PROJECT}.{DETECTIONS_TABLE}`
+                WHERE camera_trap_name = '{selected_camera_trap}' AND media_type = 'video'
+                AND DATE(timestamp) BETWEEN '{selected_date[0]}' AND '{selected_date[1]}'
+            ) AS detections
+            USING (uri, timestamp)
+            ORDER BY timestamp DESC
+            """
         )
 
         df = filter_dataframe_by_date_time_range(df, selected_date, selected_time)
 
+        # get the flattened detections of the selected videos, grouped by video and processing, so that a video
+        # processed twice is not counted twice
+        detections = run_query(
+            f"""
+            SELECT uri, timestamp, kind, label, score FROM `{PROJECT}.{DETECTIONS_TABLE}`
+            WHERE camera_trap_name = '{selected_camera_trap}' AND media_type = 'video'
+            AND DATE(timestamp) BETWEEN '{selected_date[0]}' AND '{selected_date[1]}'
+            """
+        )
+        detections_by_media = dict(tuple(detections.groupby(["uri", "timestamp"])))
+
         for _, row in df.iterrows():
 
             video = row["uri"].replace(f"gs://{BUCKET_NAME}/", "")
@@ -71,21 +97,35 @@ def app():
             # create 2 columns to display the video and the predictions alongside
             vid_col, col2 = container.columns([2, 1])
 
-            # get video
-            annotated_vid = read_media(OUTPUT_BUCKET_NAME, video)
-            vid_col.video(annotated_vid)
-
-            # get labels
-            labels = get_video_labels(json.loads(row["response"]))
+            # get video, the annotated video may still be rendering
+            try:
+                annotated_vid = read_media(OUTPUT_BUCKET_NAME, video)
+                vid_col.video(annotated_vid)
+            except NotFound:
+                vid_col.video(read_media(BUCKET_NAME, video))
+                vid_col.caption("⏳ The annotated video is being rendered")
+
+            # get labels and annotations, from the detections or from the raw response of older videos
+            media_key = (row["uri"], row["timestamp"])
+            if media_key in detections_by_media:
+                labels = get_labels_from_detections(
+                    detections_by_media[media_key], average=True
+                )
+                number_of_people = get_number_of_people_from_detections(
+                    detections_by_media[media_key]
+                )
+            elif isinstance(row["response"], str):
+                response = json.loads(row["response"])
+                labels = get_video_labels(response)
+                number_of_people = get_number_of_people(response)
+            else:
+                labels, number_of_people = {}, None
 
             # display labels
             for label in labels:
                 col2.text(label + ": " + str(round(labels[label] * 100, 2)) + "%")
                 col2.progress(labels[label])
 
-            # get annotations
-            number_of_people = get_number_of_people(json.loads(row["response"]))
-
             # display annotations
             if number_of_people != None:
                 col2.text(number_of_people)
@@ -3,6 +3,7 @@ import pandas as pd
 import streamlit as st
 from google.oauth2 import service_account
 from google.cloud import storage
+from google.api_core.exceptions import PreconditionFailed
 import yaml
 
 
@@ -17,6 +18,9 @@ client = storage.Client(credentials=credentials)
 with open("config.yml") as f:
     config = yaml.load(f, Loader=yaml.FullLoader)
 
+# Maximum number of attempts to save the metadata while the cloud function compacts activations into it
+METADATA_UPDATE_MAX_ATTEMPTS = 5
+
 # Perform query.
 @st.cache_data(ttl=600)
 def run_query(query: str) -> pd.DataFrame:
@@ -197,6 +201,77 @@ def get_number_of_people(response):
         return str(len(labels)) + " people detected"
 
 
+def get_labels_from_detections(detections, average=False):
+    """
+    Extracts object labels and their scores from the flattened detections of a media and returns them in a sorted dictionary.
+
+    Args:
+        detections (pandas DataFrame): The rows of the detections table of a media.
+        average (bool): Whether to average the scores of each label, as for videos, or to keep their best score.
+
+    Returns:
+        dict: A sorted dictionary containing the object labels as keys and their scores as values.
+    """
+
+    objects = detections[detections["kind"] == "object"]
+
+    # Aggregate the scores of each label
+    scores = objects.groupby("label")["score"]
+    result = scores.mean() if average else scores.max()
+
+    # Sort the labels and their scores in descending order of score
+    sorted_dict = result.sort_values(ascending=False).to_dict()
+
+    return sorted_dict
+
+
+def get_face_annotations_from_detections(detections):
+    """
+    Counts the faces of the flattened detections of a media that express each emotion (joy, sorrow, anger, surprise) or wear headwear.
+
+    Args:
+        detections (pandas DataFrame): The rows of the detections table of a media.
+
+    Returns:
+        dict: A dictionary containing the number of faces that express each of the specified emotions (joy, sorrow, anger, surprise) and the presence of headwear.
+        If none of the emotions or headwear are detected, returns None.
+    """
+
+    faces = detections[detections["kind"] == "face"]
+
+    annotations_dict = {"people": len(faces)}
+    for tag in ["joy", "sorrow", "anger", "surprise", "headwear"]:
+        annotations_dict[tag] = sum(tag in list(tags) for tags in faces["tags"])
+
+    # Check if none of the emotions or headwear are detected
+    if all(value == 0 for value in annotations_dict.values()):
+        return None
+    else:
+        return annotations_dict
+
+
+def get_number_of_people_from_detections(detections):
+    """
+    Counts the people detected in a video from its flattened detections.
+
+    Args:
+        detections (pandas DataFrame): The rows of the detections table of a video.
+
+    Returns:
+        str or None: If people are detected, returns a string with the number of people detected (e.g., "1 person detected",
+        "2 people detected"). Otherwise, returns None.
+    """
+
+    people = int((detections["kind"] == "person").sum())
+
+    if people == 0:
+        return None
+    elif people == 1:
+        return "1 person detected"
+    else:
+        return str(people) + " people detected"
+
+
 # Retrieve media content.
 # Uses st.cache_data to only rerun when the query changes or after 10 min.
 @st.cache_data(ttl=600)
@@ -244,6 +319,34 @@ def update_metadata(bucket_name, file_name, df):
         None: updates the metadata
     """
     bucket = client.bucket(bucket_name)
-    bucket.blob(file_name).upload_from_string(
-        df.to_csv(index=None), content_type="text/csv"
+
+    for _ in range(METADATA_UPDATE_MAX_ATTEMPTS):
+
+        # Read the current metadata at a known generation
+        blob = bucket.get_blob(file_name)
+        current = pd.read_csv(
+            io.BytesIO(blob.download_as_bytes(if_generation_match=blob.generation)),
+            dtype={"last_detection": str, "last_activation": str},
+        ).set_index("name")
+
+        # Keep the activations compacted by the cloud function since the metadata were read
+        for column in ["last_detection", "last_activation"]:
+            if column in current.columns:
+                df[column] = df["name"].map(current[column]).where(
+                    df["name"].isin(current.index), df[column]
+                )
+
+        try:
+            bucket.blob(file_name).upload_from_string(
+                df.to_csv(index=None),
+                content_type="text/csv",
+                if_generation_match=blob.generation,
+            )
+            return
+        except PreconditionFailed:
+            # The metadata changed in the meantime, start over from its new generation
+            continue
+
+    raise RuntimeError(
+        f"Could not update {file_name} after {METADATA_UPDATE_MAX_ATTEMPTS} attempts"
     )